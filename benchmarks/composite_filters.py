@@ -0,0 +1,110 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""Compares chained neutron filters with one CompositeFilter hosting them.
+
+LastIpCheck, DefaultIPPolicy, TrustedSharedNetwork and NovaInteraction
+wrap a stub Neutron app, once as a chain of paste layers and once in a
+CompositeFilter. Each kind of request below is sent --requests times to
+both, and to both again with metrics on, and the mean microseconds per
+request are printed as JSON.
+NovaInteraction only handles port creates, which are left out so no call
+leaves the process. Usage:
+
+    python benchmarks/composite_filters.py --requests 5000
+"""
+
+import argparse
+import json
+import logging
+import time
+
+import webob
+import webob.dec
+
+from wafflehaus.neutron.composite import composite
+from wafflehaus.neutron.ip_policy import create_default
+from wafflehaus.neutron.last_ip_check import last_ip_check
+from wafflehaus.neutron import nova_interaction
+from wafflehaus.neutron.shared_network import trusted
+
+
+CONF = {"enabled": "true",
+        "trusted": "net-0",
+        "resources": "POST /v2.0/ports",
+        "nova_url": "http://127.0.0.1:1",
+        "neutron_url": "http://127.0.0.1:1"}
+REQUESTS = (
+    ("unmatched_get_port", "GET", "/v2.0/ports/p", None),
+    ("unmatched_list_subnets", "GET", "/v2.0/subnets", None),
+    ("shared_networks", "GET", "/v2.0/networks?shared=true", None),
+    ("create_subnet", "POST", "/v2.0/subnets", {"subnet": {
+        "cidr": "10.0.0.0/24", "ip_version": 4}}),
+    ("update_port", "PUT", "/v2.0/ports/p", {"port": {
+        "fixed_ips": [{"ip_address": "10.0.0.9"}]}}),
+)
+NETWORKS = json.dumps({"networks": [{"id": "net-%d" % i, "shared": True}
+                                    for i in range(10)]})
+
+
+@webob.dec.wsgify
+def neutron_app(req):
+    if req.path.startswith("/v2.0/networks"):
+        return webob.Response(body=NETWORKS, content_type="application/json")
+    return webob.Response(body="{}", content_type="application/json")
+
+
+def chained(conf):
+    app = neutron_app
+    for module in (nova_interaction, trusted, create_default, last_ip_check):
+        app = module.filter_factory(conf)(app)
+    return app
+
+
+def hosted(conf):
+    conf = dict(conf, filters="last_ip_check ip_policy shared_network "
+                              "nova_interaction")
+    return composite.filter_factory(conf)(neutron_app)
+
+
+def timed(app, method, path, body, requests):
+    body = json.dumps(body) if body is not None else ""
+    start = time.time()
+    for _ in range(requests):
+        req = webob.Request.blank(path, method=method, body=body)
+        req.get_response(app)
+    return (time.time() - start) / requests * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=2000)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    metered = dict(CONF, metrics="true")
+    layouts = (("chained", chained(CONF)), ("composite", hosted(CONF)),
+               ("chained_metrics", chained(metered)),
+               ("composite_metrics", hosted(metered)))
+    results = {}
+    for name, method, path, body in REQUESTS:
+        results[name] = dict(
+            ("%s_us" % layout, round(timed(app, method, path, body,
+                                           args.requests), 1))
+            for layout, app in layouts)
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""Measures what logging costs the neutron filters per request.
+
+TrustedSharedNetwork filters a --networks long networks response and
+DefaultIPPolicy fixes the pools of a --subnets long bulk subnet create.
+Each runs --requests times with INFO filtered out, with INFO written to
+an in-memory stream, with every payload logged whole, with only
+--sample-rate of the requests logged and with INFO written through the
+log_async queue. Usage:
+
+    python benchmarks/filter_logging.py --requests 500 --networks 2000
+"""
+
+import argparse
+import json
+import logging
+import time
+
+import webob
+import webob.dec
+
+from wafflehaus.neutron.ip_policy import create_default
+from wafflehaus.neutron import log
+from wafflehaus.neutron.shared_network import trusted
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+
+MODES = (("info_off", logging.WARNING, {}),
+         ("info_on", logging.INFO, {}),
+         ("info_on_unlimited", logging.INFO, {"log_payload_limit": "0"}),
+         ("info_on_sampled", logging.INFO, None),
+         ("info_on_async", logging.INFO, {"log_async": "true"}))
+
+
+def networks_app(count):
+    body = json.dumps({"networks": [{"id": "net-%d" % i,
+                                     "name": "network %d" % i,
+                                     "shared": i % 3 == 0,
+                                     "subnets": ["subnet-%d" % i]}
+                                    for i in range(count)]})
+
+    @webob.dec.wsgify
+    def app(req):
+        return webob.Response(body=body, content_type="application/json")
+    return app
+
+
+@webob.dec.wsgify
+def ok_app(req):
+    return webob.Response()
+
+
+def timed(filter, make_request, requests):
+    start = time.time()
+    for _ in range(requests):
+        make_request().get_response(filter)
+    return (time.time() - start) / requests * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=300)
+    parser.add_argument("--networks", type=int, default=2000)
+    parser.add_argument("--subnets", type=int, default=50)
+    parser.add_argument("--sample-rate", type=float, default=0.01)
+    args = parser.parse_args()
+
+    subnets = json.dumps({"subnets": [
+        {"cidr": "10.%d.0.0/24" % i, "ip_version": 4,
+         "allocation_pools": [{"start": "10.%d.0.2" % i,
+                               "end": "10.%d.0.200" % i}]}
+        for i in range(args.subnets)]})
+
+    def networks_request():
+        return webob.Request.blank("/v2.0/networks?shared=true")
+
+    def subnets_request():
+        return webob.Request.blank("/v2.0/subnets", method="POST",
+                                   body=subnets)
+
+    results = {}
+    for name, level, extra in MODES:
+        stream = StringIO()
+        handler = logging.StreamHandler(stream)
+        root = logging.getLogger()
+        root.addHandler(handler)
+        root.setLevel(level)
+        conf = {"enabled": "true", "trusted": "net-0 net-3",
+                "log_sample_rate": str(args.sample_rate)}
+        if extra is not None:
+            conf.update(extra, log_sample_rate="1")
+        nets = trusted.filter_factory(conf)(networks_app(args.networks))
+        policy = create_default.filter_factory(conf)(ok_app)
+        try:
+            results[name] = {
+                "shared_networks_us": round(timed(
+                    nets, networks_request, args.requests), 1),
+                "default_ip_policy_us": round(timed(
+                    policy, subnets_request, args.requests), 1)}
+        finally:
+            for logger in set([nets.log, policy.log]):
+                for queued in list(logger.handlers):
+                    if isinstance(queued, log.QueueHandler):
+                        queued.flush()
+                        results[name]["log_queue"] = queued.stats()
+                        logger.removeHandler(queued)
+                        queued.close()
+                logger.propagate = True
+            root.removeHandler(handler)
+        results[name]["logged_bytes"] = len(stream.getvalue())
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == "__main__":
+    main()
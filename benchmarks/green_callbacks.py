@@ -0,0 +1,92 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""Compares how many Nova callbacks one worker keeps in flight per backend.
+
+A stand-in Nova answering after --latency seconds runs in a child process.
+Callbacks are then made from --concurrency greenthreads of this process,
+which is not monkey patched, first with the requests backend and then with
+the eventlet one. Usage:
+
+    python benchmarks/green_callbacks.py --calls 200 --concurrency 50
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import time
+
+import eventlet
+import eventlet.wsgi
+
+from wafflehaus.neutron.nova_interaction import common
+
+
+def serve(sock, latency):
+    def nova(environ, start_response):
+        eventlet.sleep(latency)
+        body = json.dumps({"virtual_interface": {}})
+        start_response("200 OK", [("Content-Type", "application/json"),
+                                  ("Content-Length", str(len(body)))])
+        return [body]
+
+    eventlet.wsgi.server(sock, nova, log=open(os.devnull, "w"),
+                         max_size=10000)
+
+
+def run(backend, url, calls, concurrency):
+    conn = common.NovaConnection(log=logging.getLogger(__name__), url=url,
+                                 pool_name="bench-%s" % backend,
+                                 pool_maxsize=concurrency, backend=backend,
+                                 read_timeout=30)
+    pool = eventlet.GreenPool(concurrency)
+    start = time.time()
+    statuses = list(pool.imap(
+        lambda i: conn.admin_virtual_interfaces(
+            action="create", port_id="port-%d" % i, tenant_id="tenant",
+            instance_id="instance-%d" % i)[0], range(calls)))
+    elapsed = time.time() - start
+    stats = common.pool_stats(conn.pool_name)
+    return {"backend": backend,
+            "ok": statuses.count(200),
+            "seconds": round(elapsed, 3),
+            "calls_per_second": round(calls / elapsed, 1),
+            "peak_in_flight": stats.get("peak_in_flight")}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--calls", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--backends", default="requests,eventlet")
+    args = parser.parse_args()
+
+    sock = eventlet.listen(("127.0.0.1", 0), backlog=1024)
+    url = "http://127.0.0.1:%d" % sock.getsockname()[1]
+    server = multiprocessing.Process(target=serve, args=(sock, args.latency))
+    server.daemon = True
+    server.start()
+    try:
+        for backend in args.backends.split(","):
+            print(json.dumps(run(backend, url, args.calls, args.concurrency),
+                             sort_keys=True))
+    finally:
+        server.terminate()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""Times loading each filter factory the way paste does at worker start.
+
+For each filter module a fresh interpreter imports wafflehaus.base, which
+every filter needs, then imports the module and builds a disabled filter
+from its filter_factory. The median milliseconds of --runs runs for each
+step are printed as JSON with the heavy dependencies the filter imported
+beyond what wafflehaus.base had.
+On Python 3.7 or later the modules costing the most, taken from
+-X importtime, are listed too. Usage:
+
+    python benchmarks/import_time.py --runs 5
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+
+FILTERS = ("wafflehaus.neutron.last_ip_check.last_ip_check",
+           "wafflehaus.neutron.ip_policy.create_default",
+           "wafflehaus.neutron.shared_network.trusted",
+           "wafflehaus.neutron.nova_interaction",
+           "wafflehaus.neutron.composite.composite")
+HEAVY = ("neutron", "netaddr", "requests", "sqlite3", "eventlet")
+SNIPPET = """
+import json, sys, time
+start = time.time()
+import wafflehaus.base
+base = time.time()
+before = set(sys.modules)
+module = __import__(%(module)r, fromlist=["filter_factory"])
+imported = time.time()
+module.filter_factory({"enabled": "false"})(lambda e, s: [])
+built = time.time()
+print(json.dumps({"base_ms": (base - start) * 1000,
+                  "import_ms": (imported - base) * 1000,
+                  "factory_ms": (built - imported) * 1000,
+                  "heavy": [m for m in %(heavy)r
+                            if m in sys.modules and m not in before]}))
+"""
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def importtime(module, env):
+    """Returns the five modules with the highest cumulative import time."""
+    code = SNIPPET % {"module": module, "heavy": HEAVY}
+    proc = subprocess.Popen([sys.executable, "-X", "importtime", "-c", code],
+                            env=env, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE, universal_newlines=True)
+    _, err = proc.communicate()
+    rows = []
+    for line in err.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        fields = [f.strip() for f in line[len("import time:"):].split("|")]
+        if fields[0].isdigit():
+            rows.append((int(fields[1]), fields[2].strip()))
+    return [{"module": name, "cumulative_ms": round(us / 1000.0, 1)}
+            for us, name in sorted(rows, reverse=True)[:5]]
+
+
+def run(module, runs, env):
+    samples = []
+    for _ in range(runs):
+        out = subprocess.check_output(
+            [sys.executable, "-c", SNIPPET % {"module": module,
+                                              "heavy": HEAVY}],
+            env=env, universal_newlines=True)
+        samples.append(json.loads(out.strip().splitlines()[-1]))
+    result = dict((key, round(median([s[key] for s in samples]), 1))
+                  for key in ("base_ms", "import_ms", "factory_ms"))
+    result["heavy_imported"] = samples[-1]["heavy"]
+    if sys.version_info >= (3, 7):
+        result["slowest"] = importtime(module, env)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("modules", nargs="*", default=FILTERS)
+    args = parser.parse_args()
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        p for p in (root, env.get("PYTHONPATH")) if p)
+    results = dict((module, run(module, args.runs, env))
+                   for module in args.modules)
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == "__main__":
+    main()
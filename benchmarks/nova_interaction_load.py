@@ -0,0 +1,152 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""Drives port POST/PUT/DELETE through NovaInteraction against fakes.
+
+A FakeServer plays Nova and Neutron from a thread of this process and its
+FakeCloud is also the Neutron app the middleware wraps. --concurrency
+threads each create, update and delete ports until --cycles cycles are
+done. Throughput, p50/p99 latency per method and the connections opened
+to the fake server are printed as JSON. Any other filter option can be
+passed as --conf key=value. Usage:
+
+    python benchmarks/nova_interaction_load.py --cycles 500 \\
+        --concurrency 20 --latency 0.01 --jitter 0.01 --error-rate 0.01
+"""
+
+import argparse
+import json
+import logging
+import threading
+import time
+
+import webob
+
+from wafflehaus.neutron import nova_interaction
+from wafflehaus.neutron.nova_interaction import fake
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[int(round(fraction * (len(values) - 1)))]
+
+
+def cycle(filter, i, record):
+    port = {"port": {"instance_id": "instance-%d" % i,
+                     "network_id": "network",
+                     "tenant_id": "tenant",
+                     "fixed_ips": [{"ip_address": "10.0.0.1"}]}}
+    steps = [("POST", "/v2.0/ports", port)]
+    resp = None
+    for method, path, body in steps:
+        req = webob.Request.blank(path, method=method)
+        req.content_type = "application/json"
+        req.body = json.dumps(body) if body is not None else ""
+        start = time.time()
+        resp = req.get_response(filter)
+        record(method, time.time() - start, resp.status_code)
+        if method == "POST":
+            if resp.status_code not in (200, 201):
+                return
+            port_id = resp.json["port"]["id"]
+            update = {"port": {"fixed_ips": [{"ip_address": "10.0.0.2"}]}}
+            steps.append(("PUT", "/v2.0/ports/%s" % port_id, update))
+            steps.append(("DELETE", "/v2.0/ports/%s" % port_id, None))
+
+
+def run(args):
+    cloud = fake.FakeCloud(latency=args.latency, jitter=args.jitter,
+                           error_rate=args.error_rate, seed=args.seed)
+    with fake.FakeServer(cloud) as server:
+        conf = {"enabled": "true",
+                "nova_url": server.url,
+                "neutron_url": server.url,
+                "resources": "POST /v2.0/ports,"
+                             "PUT DELETE /v2.0/ports/{port_id}",
+                "pool_maxsize": str(args.concurrency),
+                "callback_workers": str(args.concurrency),
+                "callback_retry_delay": "0.01"}
+        conf.update(item.split("=", 1) for item in args.conf)
+        filter = nova_interaction.filter_factory(conf)(cloud.neutron_app)
+
+        lock = threading.Lock()
+        latencies = {}
+        failed = [0]
+        counter = iter(range(args.cycles))
+
+        def record(method, seconds, status):
+            with lock:
+                latencies.setdefault(method, []).append(seconds)
+                if status >= 300:
+                    failed[0] += 1
+
+        def worker():
+            while True:
+                with lock:
+                    i = next(counter, None)
+                if i is None:
+                    return
+                cycle(filter, i, record)
+
+        threads = [threading.Thread(target=worker)
+                   for _ in range(args.concurrency)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if filter.dispatcher is not None:
+            filter.dispatcher.join()
+        elapsed = time.time() - start
+
+    requests = sum(len(v) for v in latencies.values())
+    everything = [s for v in latencies.values() for s in v]
+    pool = filter.pool_stats() or {}
+    return {"requests": requests,
+            "failed": failed[0],
+            "seconds": round(elapsed, 3),
+            "requests_per_second": round(requests / elapsed, 1),
+            "p50_ms": round(percentile(everything, 0.5) * 1000, 2),
+            "p99_ms": round(percentile(everything, 0.99) * 1000, 2),
+            "methods": dict((method, {
+                "count": len(values),
+                "p50_ms": round(percentile(values, 0.5) * 1000, 2),
+                "p99_ms": round(percentile(values, 0.99) * 1000, 2)})
+                for method, values in latencies.items()),
+            "server": cloud.stats(),
+            "client_connections_opened": sum(
+                h.get("connections_opened", 0)
+                for h in pool.get("hosts", {}).values()),
+            "callbacks": filter.callback_stats()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--cycles", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--latency", type=float, default=0.005)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--conf", action="append", default=[],
+                        metavar="KEY=VALUE")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+    print(json.dumps(run(args), indent=2, sort_keys=True))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""Measures the memory each forked worker does not share with its parent.
+
+Like neutron-server, a parent builds the filter pipeline, with --trusted
+trusted networks, then forks --workers workers. Each serves --requests
+requests, runs a full garbage collection and reports its unique set size,
+the private pages of /proc/self/smaps, and its proportional set size.
+This is done with gc_freeze on and off, each in a fresh interpreter, and
+the mean and max per worker are printed as JSON in KiB. Linux only.
+Usage:
+
+    python benchmarks/prefork_memory.py --workers 32
+"""
+
+import argparse
+import gc
+import json
+import os
+import subprocess
+import sys
+
+import webob
+import webob.dec
+
+from wafflehaus.neutron.composite import composite
+from wafflehaus.neutron import prefork
+
+
+@webob.dec.wsgify
+def neutron_app(req):
+    return webob.Response(body='{"networks": []}',
+                          content_type="application/json")
+
+
+def memory():
+    """Returns this process' (unique, proportional) set size in KiB."""
+    unique = proportional = 0
+    path = "/proc/self/smaps_rollup"
+    if not os.path.exists(path):
+        path = "/proc/self/smaps"
+    with open(path) as smaps:
+        for line in smaps:
+            if line.startswith(("Private_Clean:", "Private_Dirty:")):
+                unique += int(line.split()[1])
+            elif line.startswith("Pss:"):
+                proportional += int(line.split()[1])
+    return unique, proportional
+
+
+def worker(pipeline, requests, out):
+    paths = ("/v2.0/networks?shared=true", "/v2.0/ports/p", "/v2.0/subnets")
+    for i in range(requests):
+        webob.Request.blank(paths[i % len(paths)]).get_response(pipeline)
+    gc.collect()
+    os.write(out, (json.dumps(memory()) + "\n").encode("ascii"))
+
+
+def measure(args):
+    conf = {"enabled": "true",
+            "gc_freeze": str(args.gc_freeze).lower(),
+            "filters": "last_ip_check ip_policy shared_network "
+                       "nova_interaction",
+            "trusted": " ".join("%08d-0000-0000-0000-000000000000" % i
+                                for i in range(args.trusted)),
+            "nova_interaction.resources": "POST /v2.0/ports",
+            "nova_url": "http://127.0.0.1:1",
+            "neutron_url": "http://127.0.0.1:1"}
+    pipeline = composite.filter_factory(conf)(neutron_app)
+    parent = memory()
+    read, write = os.pipe()
+    pids = []
+    for _ in range(args.workers):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.close(read)
+                worker(pipeline, args.requests, write)
+            finally:
+                os._exit(0)
+        pids.append(pid)
+    os.close(write)
+    with os.fdopen(read) as results:
+        samples = [json.loads(line) for line in results]
+    for pid in pids:
+        os.waitpid(pid, 0)
+    unique = [s[0] for s in samples]
+    proportional = [s[1] for s in samples]
+    return {"parent_uss_kib": parent[0],
+            "workers": len(samples),
+            "worker_uss_mean_kib": sum(unique) // len(unique),
+            "worker_uss_max_kib": max(unique),
+            "worker_pss_mean_kib": sum(proportional) // len(proportional),
+            "frozen_objects": (gc.get_freeze_count()
+                               if prefork.freeze_supported() else None)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, default=32)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--trusted", type=int, default=20000)
+    parser.add_argument("--gc-freeze", choices=("true", "false"))
+    args = parser.parse_args()
+
+    if args.gc_freeze is not None:
+        args.gc_freeze = args.gc_freeze == "true"
+        print(json.dumps(measure(args)))
+        return
+    results = {"gc_freeze_supported": prefork.freeze_supported()}
+    for freeze in ("true", "false"):
+        out = subprocess.check_output(
+            [sys.executable, os.path.abspath(__file__),
+             "--workers", str(args.workers),
+             "--requests", str(args.requests),
+             "--trusted", str(args.trusted), "--gc-freeze", freeze],
+            universal_newlines=True)
+        results["gc_freeze_" + freeze] = json.loads(
+            out.strip().splitlines()[-1])
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == "__main__":
+    main()
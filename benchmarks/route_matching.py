@@ -0,0 +1,125 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""Times matching a request against many filters' resources.
+
+--routes resource specs, shaped like Neutron's, are spread over --filters
+filters. Each path below is matched --requests times the way the filters
+used to, with rf.matched_request for each filter, with a Mapper per
+filter built once, and with one RouteIndex trie for all of them. Mean
+microseconds per request are printed as JSON. Usage:
+
+    python benchmarks/route_matching.py --routes 300 --filters 5
+"""
+
+import argparse
+import json
+import time
+
+from routes import Mapper
+
+from wafflehaus.neutron import route_index
+import wafflehaus.resource_filter as rf
+
+
+SHAPES = ("GET POST /v2.0/res%d{.format}",
+          "GET PUT DELETE /v2.0/res%d/{id}{.format}",
+          "PUT /v2.0/res%d/{id}/tags/{tag}",
+          "GET /v2.0/res%d/{id:[0-9]+}/history")
+PATHS = (("first_resource", "PUT", "/v2.0/res0/abc/tags/t"),
+         ("last_resource", "GET", "/v2.0/res%d/abc.json"),
+         ("requirement", "GET", "/v2.0/res%d/42/history"),
+         ("miss", "GET", "/v2.0/ports/abc"))
+
+
+def specs(routes, filters):
+    """Returns one rf.parse_resources result per filter."""
+    lines = [[] for _ in range(filters)]
+    for i in range(routes):
+        lines[i % filters].append(SHAPES[i % len(SHAPES)] % (i // 4))
+    return [rf.parse_resources(", ".join(specs)) for specs in lines]
+
+
+def per_filter_rf(resources):
+    class Req(object):
+        pass
+
+    def match(method, path):
+        req = Req()
+        req.method, req.path = method, path
+        return [rf.matched_request(req, r) for r in resources]
+    return match
+
+
+def per_filter_mapper(resources):
+    mappers = []
+    for filter_resources in resources:
+        mapper = Mapper()
+        for template, methods in filter_resources.items():
+            mapper.connect(None, template, controller=",".join(methods))
+        mappers.append(mapper)
+
+    def match(method, path):
+        found = []
+        for mapper in mappers:
+            result = mapper.routematch(path)
+            found.append(result is not None and
+                         method in result[0]["controller"].split(","))
+        return found
+    return match
+
+
+def trie(resources):
+    index = route_index.RouteIndex()
+    for key, filter_resources in enumerate(resources):
+        index.add_resources(filter_resources, key)
+
+    def match(method, path):
+        keys = index.match(method, path)
+        return [key in keys for key in range(len(resources))]
+    return match
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--routes", type=int, default=300)
+    parser.add_argument("--filters", type=int, default=5)
+    parser.add_argument("--requests", type=int, default=200)
+    args = parser.parse_args()
+
+    resources = specs(args.routes, args.filters)
+    last = (args.routes - 1) // 4
+    matchers = (("per_filter_rf", per_filter_rf(resources)),
+                ("per_filter_mapper", per_filter_mapper(resources)),
+                ("trie", trie(resources)))
+    results = {}
+    for name, method, path in PATHS:
+        if "%d" in path:
+            path = path % last
+        expected = matchers[0][1](method, path)
+        results[name] = {"matched_filters": sum(expected)}
+        for matcher_name, match in matchers:
+            if match(method, path) != expected:
+                raise AssertionError("%s disagrees on %s %s" % (
+                    matcher_name, method, path))
+            start = time.time()
+            for _ in range(args.requests):
+                match(method, path)
+            results[name][matcher_name + "_us"] = round(
+                (time.time() - start) / args.requests * 1e6, 1)
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""Compares the per-worker and the shared port cache.
+
+The mean microseconds of a get hit, a get miss and a set are timed in one
+process. Then, for each backend, --workers forked workers each cache the
+ports it creates, --ports in all, and deletes as many ports picked at
+random from every worker's, the way a load balancer spreads a tenant's
+requests. The share of deletes that found the port cached is printed
+with the timings as JSON. Usage:
+
+    python benchmarks/shared_cache.py --workers 8 --ports 4000
+"""
+
+import argparse
+import json
+import os
+import random
+import time
+
+from wafflehaus.neutron.nova_interaction import cache
+
+
+PORT = {"mac_address": "AA:BB:CC:DD:EE:FF",
+        "fixed_ips": [{"subnet_id": "8c6d3b4e-7c11-4bb5-a5e1-1f0c2b2c9d10",
+                       "ip_address": "10.0.0.9"}],
+        "instance_id": "5b1f8c3e-2d4a-4f7b-9e6c-0a1b2c3d4e5f",
+        "network_id": "d3b07384-d113-4ec6-a5a2-6f5f2d0f8a5b",
+        "tenant_id": "tenant"}
+
+
+def backends(size):
+    return (("local", cache.PortCache(size=size)),
+            ("shared", cache.SharedPortCache(size=size)))
+
+
+def timed(func, runs):
+    start = time.time()
+    for i in range(runs):
+        func(i)
+    return round((time.time() - start) / runs * 1e6, 2)
+
+
+def timings(port_cache, runs):
+    port_cache.set("hit", PORT)
+    return {"get_hit_us": timed(lambda i: port_cache.get("hit"), runs),
+            "get_miss_us": timed(lambda i: port_cache.get("miss"), runs),
+            "set_us": timed(lambda i: port_cache.set("p%d" % i, PORT), runs)}
+
+
+def hit_rate(port_cache, workers, ports):
+    per_worker = ports // workers
+    read, write = os.pipe()
+    pids = []
+    for worker in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.close(read)
+                for i in range(per_worker):
+                    port_cache.set("w%d-%d" % (worker, i), PORT)
+                # Let every worker create its ports before any deletes
+                time.sleep(0.5)
+                hits = 0
+                for _ in range(per_worker):
+                    port_id = "w%d-%d" % (random.randrange(workers),
+                                          random.randrange(per_worker))
+                    hits += port_cache.get(port_id) is not None
+                os.write(write, ("%d\n" % hits).encode("ascii"))
+            finally:
+                os._exit(0)
+        pids.append(pid)
+    os.close(write)
+    with os.fdopen(read) as results:
+        hits = sum(int(line) for line in results)
+    for pid in pids:
+        os.waitpid(pid, 0)
+    return round(float(hits) / (per_worker * workers), 3)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--ports", type=int, default=4000)
+    parser.add_argument("--runs", type=int, default=20000)
+    args = parser.parse_args()
+
+    results = {}
+    for name, port_cache in backends(max(args.runs, args.ports) * 2):
+        results[name] = timings(port_cache, args.runs)
+    for name, port_cache in backends(args.ports * 2):
+        results[name]["delete_hit_rate"] = hit_rate(port_cache, args.workers,
+                                                    args.ports)
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == "__main__":
+    main()
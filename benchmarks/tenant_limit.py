@@ -0,0 +1,113 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""Measures what the tenant admission filter costs and how well it limits.
+
+The mean microseconds of a port create sent straight to a stub Neutron
+app, admitted by the filter and rejected by it are timed. Then --workers
+forked workers send one tenant's port creates as fast as they can for
+--seconds, with --rate and --burst, and the creates admitted across all
+of them are printed next to the burst plus rate times the elapsed time,
+as JSON. Usage:
+
+    python benchmarks/tenant_limit.py --workers 8 --rate 20 --burst 50
+"""
+
+import argparse
+import json
+import os
+import time
+
+import webob
+import webob.dec
+
+from wafflehaus.neutron.admission import tenant_limit
+
+
+@webob.dec.wsgify
+def neutron_app(req):
+    return webob.Response(body="{}", content_type="application/json")
+
+
+def send(app, tenant_id="tenant"):
+    req = webob.Request.blank("/v2.0/ports", method="POST",
+                              headers={"X_TENANT_ID": tenant_id})
+    return req.get_response(app).status_int
+
+
+def timed(app, requests, tenant_id):
+    start = time.time()
+    for _ in range(requests):
+        send(app, tenant_id)
+    return round((time.time() - start) / requests * 1e6, 1)
+
+
+def latency(requests):
+    admit = tenant_limit.filter_factory(
+        {"enabled": "true", "rate": "1000000", "burst": "1000000"})(
+        neutron_app)
+    reject = tenant_limit.filter_factory(
+        {"enabled": "true", "rate": "0.001", "burst": "1"})(neutron_app)
+    send(reject)
+    return {"unfiltered_us": timed(neutron_app, requests, "tenant"),
+            "admitted_us": timed(admit, requests, "tenant"),
+            "rejected_us": timed(reject, requests, "tenant")}
+
+
+def across_workers(workers, seconds, rate, burst):
+    limited = tenant_limit.filter_factory(
+        {"enabled": "true", "rate": str(rate), "burst": str(burst)})(
+        neutron_app)
+    read, write = os.pipe()
+    pids = []
+    start = time.time() + 0.2
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                time.sleep(max(0, start - time.time()))
+                admitted = 0
+                while time.time() < start + seconds:
+                    admitted += send(limited) == 200
+                os.write(write, ("%d\n" % admitted).encode("ascii"))
+            finally:
+                os._exit(0)
+        pids.append(pid)
+    os.close(write)
+    with os.fdopen(read) as results:
+        admitted = sum(int(line) for line in results)
+    for pid in pids:
+        os.waitpid(pid, 0)
+    return {"workers": workers,
+            "admitted": admitted,
+            "limit": int(burst + rate * seconds)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--seconds", type=float, default=3)
+    parser.add_argument("--rate", type=float, default=20)
+    parser.add_argument("--burst", type=float, default=50)
+    args = parser.parse_args()
+
+    results = latency(args.requests)
+    results["across_workers"] = across_workers(args.workers, args.seconds,
+                                               args.rate, args.burst)
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == "__main__":
+    main()
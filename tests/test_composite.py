@@ -0,0 +1,129 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+import json
+
+import mock
+import webob
+import webob.dec
+
+from tests import test_base
+from wafflehaus.neutron.composite import composite
+from wafflehaus.neutron.shared_network import trusted
+
+
+NETWORKS = {"networks": [{"id": "net-1", "shared": True},
+                         {"id": "net-2", "shared": True},
+                         {"id": "net-3", "shared": False}]}
+
+
+class TestCompositeFilter(test_base.TestBase):
+    def setUp(self):
+        super(TestCompositeFilter, self).setUp()
+        self.calls = []
+
+        @webob.dec.wsgify
+        def neutron_app(req):
+            self.calls.append((req.method, req.path))
+            if req.path.startswith("/v2.0/networks"):
+                return webob.Response(body=json.dumps(NETWORKS),
+                                      content_type="application/json")
+            return webob.Response(body=req.body or b"{}",
+                                  content_type="application/json")
+        self.neutron_app = neutron_app
+        self.conf = {"enabled": "true",
+                     "filters": "last_ip_check ip_policy shared_network",
+                     "shared_network.trusted": "net-1"}
+
+    def _filter(self, **conf):
+        self.conf.update(conf)
+        return composite.filter_factory(self.conf)(self.neutron_app)
+
+    def test_builds_named_filters(self):
+        filter = self._filter()
+
+        self.assertEqual(filter.names, ["last_ip_check", "ip_policy",
+                                        "shared_network"])
+        self.assertEqual(filter.filters[2].trusted_nets, set(["net-1"]))
+        self.assertNotIn("trusted", filter.filters[1].conf)
+
+    def test_unmatched_goes_to_app(self):
+        filter = self._filter()
+        resp = webob.Request.blank("/v2.0/ports").get_response(filter)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(self.calls, [("GET", "/v2.0/ports")])
+
+    def test_unmatched_skips_index(self):
+        filter = self._filter()
+        with mock.patch.object(filter, "match") as match:
+            webob.Request.blank("/v2.0/ports").get_response(filter)
+
+        self.assertFalse(match.called)
+        self.assertEqual(self.calls, [("GET", "/v2.0/ports")])
+
+    def test_matched_filter_acts(self):
+        filter = self._filter()
+        req = webob.Request.blank("/v2.0/networks?shared=true")
+        resp = req.get_response(filter)
+
+        ids = [n["id"] for n in resp.json["networks"]]
+        self.assertEqual(ids, ["net-1", "net-3"])
+        self.assertNotIn(composite.CHAIN_KEY, req.environ)
+
+    def test_only_matched_filters_called(self):
+        filter = self._filter()
+        resp = webob.Response()
+        with mock.patch.object(filter.filters[1], "handle") as ip_policy:
+            with mock.patch.object(filter.filters[2], "handle",
+                                   return_value=resp) as shared:
+                req = webob.Request.blank("/v2.0/networks?shared=true")
+                req.get_response(filter)
+
+        self.assertFalse(ip_policy.called)
+        self.assertTrue(shared.called)
+
+    def test_filter_stops_chain(self):
+        filter = self._filter()
+        req = webob.Request.blank("/v2.0/ports/p", method="PUT",
+                                  body=b'{"port": {"fixed_ips": []}}')
+        resp = req.get_response(filter)
+
+        self.assertEqual(resp.status_code, 403)
+        self.assertEqual(self.calls, [])
+
+    def test_disabled_filter_skipped(self):
+        filter = self._filter(**{"shared_network.enabled": "false"})
+        resp = webob.Request.blank("/v2.0/networks?shared=true").get_response(
+            filter)
+
+        self.assertEqual(len(resp.json["networks"]), 3)
+
+    def test_subrequest_matched_again(self):
+        filter = self._filter()
+        next_app = filter.filters[1].app
+        resp = webob.Request.blank("/v2.0/networks?shared=true").get_response(
+            next_app)
+
+        self.assertEqual(len(resp.json["networks"]), 2)
+
+    def test_same_as_chained(self):
+        filter = self._filter()
+        chained = trusted.filter_factory({"enabled": "true",
+                                          "trusted": "net-1"})(
+            self.neutron_app)
+        path = "/v2.0/networks?shared=true"
+
+        self.assertEqual(webob.Request.blank(path).get_response(filter).json,
+                         webob.Request.blank(path).get_response(chained).json)
@@ -18,6 +18,7 @@ from mock import patch
 from tests import test_base
 
 from wafflehaus.neutron.ip_policy import create_default
+from wafflehaus.neutron import log as waffle_log
 from wafflehaus import tests
 
 
@@ -339,3 +340,16 @@ class TestDefaultIPV6Policy(DefaultPolicyTestBase):
         self.assertEqual("2607:f0d0:1002:51::55", allocation_pools[0]["start"])
         self.assertEqual("2607:f0d0:1002:51::64",
                          allocation_pools[0]["end"])
+
+    def test_default_pools_logged_as_payload(self):
+        conf = {'enabled': 'true', 'log_payload_limit': '5'}
+        result = create_default.filter_factory(conf)(self.app)
+        body = self.v6_has_alloc_smaller_than_default
+        with patch.object(result.detail_log, 'detail') as detail:
+            result.__call__.request('/v2.0/subnets', method='POST',
+                                    body=body)
+        pools = [c[0][2] for c in detail.call_args_list
+                 if 'Default allocation pool' in c[0][1]]
+        self.assertEqual(1, len(pools))
+        self.assertIsInstance(pools[0], waffle_log.Payload)
+        self.assertEqual(5, len(str(pools[0]).split("...(")[0]))
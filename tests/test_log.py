@@ -0,0 +1,239 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+import logging
+import threading
+
+import mock
+import unittest2
+import webob
+import webob.dec
+
+from tests import test_base
+from wafflehaus.neutron import log
+from wafflehaus.neutron.shared_network import trusted
+
+try:
+    import eventlet
+    import eventlet.tpool
+except ImportError:
+    eventlet = None
+
+
+class Exploding(object):
+    def __str__(self):
+        raise AssertionError("formatted without being logged")
+
+
+class TestPayload(test_base.TestBase):
+    def test_truncates(self):
+        self.assertEqual(str(log.Payload("abcdef", 4)), "abcd...(2 more)")
+        self.assertEqual(str(log.Payload("abc", 4)), "abc")
+        self.assertEqual(str(log.Payload("abcdef", 0)), "abcdef")
+
+    def test_formatted_lazily(self):
+        logger = logging.getLogger("test_log.lazy")
+        logger.setLevel(logging.WARNING)
+        logger.info("body %s", log.Payload(Exploding()))
+
+
+class TestFilterLog(test_base.TestBase):
+    def setUp(self):
+        super(TestFilterLog, self).setUp()
+        self.log = mock.MagicMock()
+        self.log.isEnabledFor.return_value = True
+
+    def test_detail_logged_with_args(self):
+        filter_log = log.FilterLog(self.log, {})
+        req = webob.Request.blank("/")
+        filter_log.detail(req, "a %s", 1)
+
+        self.log.info.assert_called_once_with("a %s", 1)
+
+    def test_nothing_built_when_level_off(self):
+        self.log.isEnabledFor.return_value = False
+        filter_log = log.FilterLog(self.log, {"log_sample_rate": "0"})
+        req = webob.Request.blank("/")
+        filter_log.detail(req, "a %s", 1)
+
+        self.assertFalse(self.log.info.called)
+        self.assertNotIn(log.SAMPLED_KEY, req.environ)
+
+    def test_sampling_decided_once_per_request(self):
+        filter_log = log.FilterLog(self.log, {"log_sample_rate": "0.5"})
+        other = log.FilterLog(self.log, {"log_sample_rate": "0.5"})
+        req = webob.Request.blank("/")
+        with mock.patch("random.random", return_value=0.9):
+            filter_log.detail(req, "first")
+        with mock.patch("random.random", return_value=0.1):
+            other.detail(req, "second")
+            other.detail(webob.Request.blank("/"), "third")
+
+        self.log.info.assert_called_once_with("third")
+
+    def test_payload_limit(self):
+        filter_log = log.FilterLog(self.log, {"log_payload_limit": "3"})
+
+        self.assertEqual(str(filter_log.payload([1, 2, 3])), "[1,...(6 more)")
+
+    def test_context(self):
+        filter_log = log.FilterLog(self.log, {})
+        req = webob.Request.blank("/")
+        filter_log.context(req, "here")
+        self.assertFalse(self.log.info.called)
+
+        req.environ["neutron.context"] = mock.Mock(request_id="r",
+                                                   project_id="p",
+                                                   tenant_name="t",
+                                                   is_admin=False,
+                                                   user_id="u")
+        filter_log.context(req, "here")
+        args = self.log.info.call_args[0]
+        self.assertEqual(args[1:], ("here", "r", "p", "t", False, "u"))
+
+
+class TestQueueHandler(test_base.TestBase):
+    def setUp(self):
+        super(TestQueueHandler, self).setUp()
+        self.target = mock.MagicMock(level=logging.NOTSET)
+
+    def _record(self, msg, *args):
+        return logging.LogRecord("test_log", logging.INFO, __file__, 1, msg,
+                                 args, None)
+
+    def test_writes_formatted_records_in_batches(self):
+        handler = log.QueueHandler(self.target, batch_size=10)
+        body = {"a": 1}
+        handler.handle(self._record("body %s", body))
+        body["a"] = 2
+        handler.handle(self._record("second"))
+        handler.flush()
+
+        written = [c[0][0] for c in self.target.handle.call_args_list]
+        self.assertEqual([r.getMessage() for r in written],
+                         ["body {'a': 1}", "second"])
+        stats = handler.stats()
+        self.assertEqual(stats["written"], 2)
+        self.assertEqual(stats["queued"], 0)
+        handler.close()
+        self.assertTrue(self.target.close.called)
+
+    def test_drops_when_full(self):
+        release = threading.Event()
+        self.target.handle.side_effect = lambda record: release.wait(5)
+        handler = log.QueueHandler(self.target, queue_size=1, batch_size=1)
+        handler.handle(self._record("taken by the writer"))
+        for _ in range(5000):
+            if handler.queue.empty():
+                break
+            threading.Event().wait(0.001)
+        handler.handle(self._record("queued"))
+        handler.handle(self._record("dropped"))
+
+        stats = handler.stats()
+        self.assertEqual(stats["dropped"], 1)
+        self.assertEqual(stats["queued"], 1)
+        release.set()
+        handler.close()
+        self.assertEqual(handler.stats()["written"], 2)
+
+    def test_bad_overflow(self):
+        self.assertRaises(ValueError, log.QueueHandler, self.target,
+                          overflow="spill")
+
+    def test_stream_batched_into_one_write(self):
+        stream = mock.MagicMock()
+        target = logging.StreamHandler(stream)
+        handler = log.QueueHandler(target, batch_size=10)
+        handler._write([self._record("one"), self._record("two")])
+
+        stream.write.assert_called_once_with("one\ntwo\n")
+
+    def test_propagated_stream_batched_into_one_write(self):
+        logger = logging.getLogger("test_log.propagated")
+        stream = mock.MagicMock()
+        parent = logging.StreamHandler(stream)
+        logging.getLogger("test_log").addHandler(parent)
+        self.addCleanup(logging.getLogger("test_log").removeHandler, parent)
+        handler = log.QueueHandler(log.PropagateHandler(logger))
+        handler._write([self._record("one"), self._record("two")])
+
+        stream.write.assert_called_once_with("one\ntwo\n")
+
+    @unittest2.skipIf(eventlet is None, "eventlet is not installed")
+    def test_stream_written_off_hub_when_patched(self):
+        stream = mock.MagicMock()
+        handler = log.QueueHandler(logging.StreamHandler(stream))
+        with mock.patch("eventlet.patcher.is_monkey_patched",
+                        return_value=True):
+            with mock.patch("eventlet.tpool.execute") as execute:
+                handler._write([self._record("one")])
+
+        execute.assert_called_once_with(log._write_stream, stream, "one\n")
+        self.assertFalse(stream.write.called)
+
+    def test_filter_log_installs_once(self):
+        logger = logging.getLogger("test_log.async")
+        parent = mock.MagicMock(level=logging.NOTSET)
+        logging.getLogger("test_log").addHandler(parent)
+        try:
+            conf = {"log_async": "true", "log_overflow": "block"}
+            filter_log = log.FilterLog(logger, conf)
+            other = log.FilterLog(logger, conf)
+            self.assertIs(filter_log.async_handler, other.async_handler)
+            self.assertFalse(logger.propagate)
+
+            logger.warning("to %s", "parent")
+            filter_log.async_handler.flush()
+            record = parent.handle.call_args[0][0]
+            self.assertEqual(record.getMessage(), "to parent")
+            self.assertEqual(filter_log.stats()["written"], 1)
+        finally:
+            logging.getLogger("test_log").removeHandler(parent)
+            logger.removeHandler(filter_log.async_handler)
+            logger.propagate = True
+            filter_log.async_handler.close()
+
+    def test_no_stats_when_sync(self):
+        self.assertIsNone(log.FilterLog(mock.MagicMock(), {}).stats())
+
+
+class TestFilterLogging(test_base.TestBase):
+    def setUp(self):
+        super(TestFilterLogging, self).setUp()
+        body = '{"networks": [{"id": "net", "shared": true}]}'
+
+        @webob.dec.wsgify
+        def app(req):
+            return webob.Response(body=body)
+        self.app = app
+        self.req = webob.Request.blank("/v2.0/networks?shared=true")
+
+    def _logged(self, conf):
+        conf.update(enabled="true")
+        filter = trusted.filter_factory(conf)(self.app)
+        with mock.patch.object(filter.log, "isEnabledFor", return_value=True):
+            with mock.patch.object(filter.log, "info") as info:
+                self.req.get_response(filter)
+        return [c[0] for c in info.call_args_list]
+
+    def test_unsampled_request_logs_nothing(self):
+        self.assertEqual(self._logged({"log_sample_rate": "0"}), [])
+
+    def test_body_truncated(self):
+        calls = self._logged({"log_payload_limit": "5"})
+        bodies = [str(c[1]) for c in calls if "json body" in c[0]]
+
+        self.assertEqual(len(bodies), 1)
+        self.assertEqual(len(bodies[0].split("...(")[0]), 5)
@@ -0,0 +1,272 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+import json
+import os
+import shutil
+import socket
+import tempfile
+
+import mock
+import webob
+import webob.dec
+import webob.exc
+
+from tests import test_base
+from wafflehaus.neutron.composite import composite
+from wafflehaus.neutron import metrics
+
+
+NETWORKS = {"networks": [{"id": "net-1", "shared": True},
+                         {"id": "net-2", "shared": True}]}
+
+
+class TestHistogram(test_base.TestBase):
+    def test_snapshot_is_cumulative(self):
+        histogram = metrics.Histogram()
+        for value in (0.00001, 0.0003, 0.0003, 60):
+            histogram.observe(value)
+
+        counts, total = histogram.snapshot()
+        self.assertEqual(counts[0], 1)
+        self.assertEqual(counts[metrics.BUCKETS.index(0.0005)], 3)
+        self.assertEqual(counts[-2], 3)
+        self.assertEqual(counts[-1], 4)
+        self.assertAlmostEqual(total, 60.00061)
+
+
+class TestClassify(test_base.TestBase):
+    def test_decisions(self):
+        app = object()
+
+        self.assertEqual(metrics.classify(app, app), "allowed")
+        self.assertEqual(metrics.classify(webob.exc.HTTPForbidden, app),
+                         "rejected")
+        self.assertEqual(metrics.classify(webob.exc.HTTPBadRequest(), app),
+                         "rejected")
+        self.assertEqual(metrics.classify(webob.Response(), app),
+                         "rewritten")
+
+
+class TestRecorder(test_base.TestBase):
+    def setUp(self):
+        super(TestRecorder, self).setUp()
+        self.registry = metrics.Registry()
+        self.recorder = metrics.Recorder(
+            "test", {"/v2.0/ports/{id}": ["PUT"]}, registry=self.registry)
+        self.now = [0.0]
+        for name in ("wall_clock", "cpu_clock"):
+            patcher = mock.patch.object(metrics, name,
+                                        side_effect=lambda: self.now[0])
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _series(self, method="PUT", route="/v2.0/ports/{id}"):
+        return self.registry.series[("test", method, route)]
+
+    def test_app_time_left_out(self):
+        def inner(environ, start_response):
+            self.now[0] += 5
+            return webob.Response()(environ, start_response)
+        app = metrics._Downstream(self.recorder, inner)
+
+        def handle(req):
+            self.now[0] += 0.002
+            resp = req.get_response(app)
+            self.now[0] += 0.001
+            return resp
+        recorded = self.recorder.wrap(handle, app)
+        recorded(webob.Request.blank("/v2.0/ports/p", method="PUT"))
+
+        counts, total = self._series().wall.snapshot()
+        self.assertEqual(counts[-1], 1)
+        self.assertAlmostEqual(total, 0.003)
+        self.assertEqual(self._series().decisions["rewritten"], 1)
+
+    def test_decide_overrides(self):
+        def handle(req):
+            metrics.decide("allowed")
+            return webob.Response(status=409)
+        self.recorder.wrap(handle, None)(
+            webob.Request.blank("/v2.0/ports/p", method="PUT"))
+
+        self.assertEqual(self._series().decisions["allowed"], 1)
+
+    def test_error_recorded(self):
+        def handle(req):
+            raise ValueError()
+        recorded = self.recorder.wrap(handle, None)
+
+        self.assertRaises(ValueError, recorded,
+                          webob.Request.blank("/v2.0/ports/p", method="PUT"))
+        self.assertEqual(self._series().decisions["error"], 1)
+        self.assertEqual(metrics._stack(), [])
+
+    def test_unmatched_route(self):
+        self.recorder.wrap(lambda req: webob.Response(), None)(
+            webob.Request.blank("/v2.0/networks"))
+
+        self.assertEqual(self._series("GET", "*").decisions["rewritten"], 1)
+
+    def test_render(self):
+        self.assertNotIn("_bucket", self.registry.render())
+        self.recorder.wrap(lambda req: webob.exc.HTTPForbidden, None)(
+            webob.Request.blank("/v2.0/ports/p", method="PUT"))
+
+        text = self.registry.render()
+        labels = 'filter="test",method="PUT",route="/v2.0/ports/{id}"'
+        self.assertIn("# TYPE wafflehaus_filter_seconds histogram", text)
+        self.assertIn('wafflehaus_filter_seconds_bucket{%s,le="+Inf"} 1' %
+                      labels, text)
+        self.assertIn("wafflehaus_filter_cpu_seconds_count{%s} 1" % labels,
+                      text)
+        self.assertIn('wafflehaus_filter_requests_total{%s,'
+                      'decision="rejected"} 1' % labels, text)
+
+
+class TestInstrumentedFilters(test_base.TestBase):
+    def setUp(self):
+        super(TestInstrumentedFilters, self).setUp()
+        metrics._registry.clear()
+        self.addCleanup(metrics._registry.clear)
+
+        @webob.dec.wsgify
+        def neutron_app(req):
+            if req.path.startswith("/v2.0/networks"):
+                return webob.Response(body=json.dumps(NETWORKS),
+                                      content_type="application/json")
+            return webob.Response(body=req.body or b"{}",
+                                  content_type="application/json")
+        self.conf = {"enabled": "true", "metrics": "true",
+                     "filters": "last_ip_check ip_policy shared_network",
+                     "shared_network.trusted": "net-1"}
+        self.filter = composite.filter_factory(self.conf)(neutron_app)
+
+    def _decisions(self, name, method, route):
+        return metrics._registry.series[(name, method, route)].decisions
+
+    def test_hosted_filters_recorded(self):
+        webob.Request.blank("/v2.0/networks?shared=true").get_response(
+            self.filter)
+        body = json.dumps({"subnet": {"cidr": "10.0.0.0/24"}})
+        webob.Request.blank("/v2.0/subnets", method="POST",
+                            body=body).get_response(self.filter)
+
+        self.assertEqual(self._decisions(
+            "shared_network", "GET",
+            "/v2.0/networks{.format}")["rewritten"], 1)
+        self.assertEqual(self._decisions(
+            "ip_policy", "POST", "/v2.0/subnets")["rewritten"], 1)
+
+    def test_disabled_by_default(self):
+        del self.conf["metrics"]
+        filter = composite.filter_factory(self.conf)(self.filter.app)
+        webob.Request.blank("/v2.0/networks?shared=true").get_response(
+            filter)
+
+        self.assertEqual(metrics._registry.series, {})
+        self.assertNotIsInstance(filter.filters[2].app, metrics._Downstream)
+
+    def test_scrape_path(self):
+        webob.Request.blank("/v2.0/networks?shared=true").get_response(
+            self.filter)
+        scrape = metrics.filter_factory({"enabled": "true"})(self.filter)
+
+        resp = webob.Request.blank("/wafflehaus/metrics").get_response(
+            scrape)
+        self.assertEqual(resp.headers["Content-Type"], metrics.CONTENT_TYPE)
+        self.assertIn(b'filter="shared_network"', resp.body)
+        resp = webob.Request.blank("/v2.0/networks").get_response(scrape)
+        self.assertEqual(json.loads(resp.body)["networks"][0]["id"],
+                         "net-1")
+
+    def test_unservable_socket_does_not_fail_requests(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        self.conf["metrics_socket"] = os.path.join(tmp, "missing",
+                                                   "m-{pid}.sock")
+        filter = composite.filter_factory(self.conf)(self.filter.app)
+        # The listener logs through the first filter instrumented
+        with mock.patch.object(filter.filters[0].log, "error") as error:
+            for _ in range(2):
+                resp = webob.Request.blank(
+                    "/v2.0/networks?shared=true").get_response(filter)
+                self.assertEqual(resp.status_int, 200)
+
+        self.assertEqual(error.call_count, 1)
+        self.assertEqual(self._decisions(
+            "shared_network", "GET",
+            "/v2.0/networks{.format}")["rewritten"], 2)
+
+
+class TestListener(test_base.TestBase):
+    def test_serves_registry(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        registry = metrics.Registry()
+        registry.get("test", "GET", "*").record(0.001, 0.001, "allowed")
+        listener = metrics.Listener(os.path.join(tmp, "metrics-{pid}.sock"),
+                                    registry)
+        listener.start()
+        listener.start()
+
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.connect(os.path.join(tmp, "metrics-%d.sock" % os.getpid()))
+        client.sendall(b"GET /metrics HTTP/1.0\r\n\r\n")
+        reply = b""
+        while True:
+            chunk = client.recv(65536)
+            if not chunk:
+                break
+            reply += chunk
+        client.close()
+        self.assertTrue(reply.startswith(b"HTTP/1.0 200 OK"))
+        self.assertIn(b'decision="allowed"} 1', reply)
+
+    def test_scrape_errors_logged(self):
+        class Stop(BaseException):
+            pass
+        conn = mock.Mock()
+        conn.recv.return_value = b"GET /metrics HTTP/1.0\r\n\r\n"
+        conn.sendall.side_effect = socket.error("client went away")
+        sock = mock.Mock()
+        sock.accept.side_effect = [socket.error("too many open files"),
+                                   (conn, None), (conn, None), Stop()]
+        log = mock.Mock()
+        listener = metrics.Listener("metrics.sock", log=log)
+        with mock.patch("time.sleep"):
+            self.assertRaises(Stop, listener._serve, sock, "metrics.sock")
+
+        self.assertEqual(log.error.call_count, 3)
+        self.assertEqual(conn.close.call_count, 2)
+
+    def test_only_stale_sockets_removed(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        path = os.path.join(tmp, "metrics.sock")
+        with open(path, "w") as f:
+            f.write("keep")
+        log = mock.Mock()
+        metrics.Listener(path, log=log).start()
+
+        with open(path) as f:
+            self.assertEqual(f.read(), "keep")
+        self.assertTrue(log.error.called)
+        os.unlink(path)
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(path)
+        stale.close()
+        listener = metrics.Listener(path, log=log)
+        listener.start()
+        self.assertTrue(listener.serving)
@@ -15,10 +15,31 @@
 import mock
 
 import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest2
 import webob
 
+try:
+    import eventlet
+    import eventlet.wsgi
+except ImportError:
+    eventlet = None
+
 from tests import test_base
 from wafflehaus.neutron import nova_interaction
+from wafflehaus.neutron.nova_interaction import balancer
+from wafflehaus.neutron.nova_interaction import breaker
+from wafflehaus.neutron.nova_interaction import cache
+from wafflehaus.neutron.nova_interaction import common
+from wafflehaus.neutron.nova_interaction import dispatch
+from wafflehaus.neutron.nova_interaction import fake
+from wafflehaus.neutron.nova_interaction import limiter
+from wafflehaus.neutron.nova_interaction import outbox
+from wafflehaus.neutron.nova_interaction import singleflight
 
 
 class TestNovaInteraction(test_base.TestBase):
@@ -91,6 +112,18 @@ class TestNovaInteraction(test_base.TestBase):
         self.assertIsInstance(test_filter, nova_interaction.NovaInteraction)
         self.assertTrue(callable(test_filter))
 
+    def test_verify_ssl_options(self):
+        self.conf.update({"nova_verify_ssl": "/etc/ssl/nova-ca.pem",
+                          "neutron_verify_ssl": "true"})
+        test_filter = nova_interaction.filter_factory(self.conf)(self.app)
+
+        self.assertEqual(test_filter.nova_verify_ssl, "/etc/ssl/nova-ca.pem")
+        self.assertEqual(test_filter.nova_conn.verify, "/etc/ssl/nova-ca.pem")
+        self.assertIs(test_filter.neutron_verify_ssl, True)
+        self.conf.pop("neutron_verify_ssl")
+        test_filter = nova_interaction.filter_factory(self.conf)(self.app)
+        self.assertIs(test_filter.neutron_verify_ssl, True)
+
     def test_disabled_filter(self):
         conf = {"enabled": "false"}
         test_filter = nova_interaction.filter_factory(conf)(self.app)
@@ -244,3 +277,1495 @@ class TestNovaInteraction(test_base.TestBase):
         self.assertTrue(mock_nova_conn.admin_virtual_interfaces.called)
         self.assertEqual(resp.json, fake_resp.json)
         self.assertEqual(resp.status_code, 500)
+
+    @mock.patch("wafflehaus.neutron.nova_interaction.NovaConn")
+    @mock.patch("wafflehaus.neutron.nova_interaction.NeutronConn")
+    def test_connections_reused_between_requests(self, mock_neutron,
+                                                 mock_nova):
+        mock_conn = mock.MagicMock()
+        mock_conn.admin_virtual_interfaces.return_value = self.nova_response
+        mock_nova.return_value = mock_conn
+        test_filter = nova_interaction.filter_factory(self.conf)(self.fake_app)
+        for _ in range(3):
+            test_filter(webob.Request.blank("/v2/ports", method="POST"))
+
+        self.assertEqual(mock_nova.call_count, 1)
+        self.assertEqual(mock_conn.admin_virtual_interfaces.call_count, 3)
+        pool_conf = mock_nova.call_args[1]
+        self.assertEqual(pool_conf['pool_name'],
+                         'wafflehaus.neutron.nova_interaction')
+        self.assertEqual(pool_conf['pool_maxsize'], 10)
+
+    @mock.patch("wafflehaus.neutron.nova_interaction.NovaConn")
+    @mock.patch("wafflehaus.neutron.nova_interaction.NeutronConn")
+    def test_post_to_ports_async(self, mock_neutron, mock_nova):
+        mock_conn = mock.MagicMock()
+        mock_conn.admin_virtual_interfaces.return_value = self.nova_response
+        mock_nova.return_value = mock_conn
+        self.conf["callback_mode"] = "async"
+        test_filter = nova_interaction.filter_factory(self.conf)(self.fake_app)
+        resp = test_filter(webob.Request.blank("/v2/ports", method="POST"))
+        test_filter.dispatcher.join()
+        stats = test_filter.callback_stats()
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json['nova_callback'],
+                         {"instance_id": "id_instance", "status": "queued"})
+        self.assertTrue(mock_conn.admin_virtual_interfaces.called)
+        self.assertEqual(stats["submitted"], 1)
+        self.assertEqual(stats["delivered"], 1)
+        self.assertEqual(stats["queue_depth"], 0)
+
+    @mock.patch("wafflehaus.neutron.nova_interaction.NovaConn")
+    @mock.patch("wafflehaus.neutron.nova_interaction.NeutronConn")
+    def test_async_queue_full_falls_back_to_sync(self, mock_neutron,
+                                                 mock_nova):
+        mock_conn = mock.MagicMock()
+        mock_conn.admin_virtual_interfaces.return_value = self.nova_response
+        mock_nova.return_value = mock_conn
+        self.conf.update({"callback_mode": "async", "callback_workers": "0",
+                          "callback_queue_size": "1"})
+        test_filter = nova_interaction.filter_factory(self.conf)(self.fake_app)
+        first = test_filter(webob.Request.blank("/v2/ports", method="POST"))
+        second = test_filter(webob.Request.blank("/v2/ports", method="POST"))
+
+        self.assertEqual(first.json['nova_callback']['status'], "queued")
+        self.assertEqual(second.json['nova_callback']['status'], "success")
+        self.assertEqual(mock_conn.admin_virtual_interfaces.call_count, 1)
+        self.assertEqual(test_filter.callback_stats()["dropped"], 1)
+
+    @mock.patch("wafflehaus.neutron.nova_interaction.NovaConn")
+    @mock.patch("wafflehaus.neutron.nova_interaction.NeutronConn")
+    def test_delete_after_post_uses_port_cache(self, mock_neutron, mock_nova):
+        mock_nova_conn = mock.MagicMock()
+        mock_nova_conn.admin_virtual_interfaces.return_value = (
+            self.nova_response)
+        mock_nova.return_value = mock_nova_conn
+        test_filter = nova_interaction.filter_factory(self.conf)(self.fake_app)
+        test_filter(webob.Request.blank("/v2/ports", method="POST"))
+        req = webob.Request.blank("/v2/ports/random_port_id", method="DELETE")
+        resp = test_filter(req)
+        stats = test_filter.cache_stats()
+
+        self.assertFalse(mock_neutron.called)
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.json['neutron_callback']['cached'])
+        self.assertEqual(
+            mock_nova_conn.admin_virtual_interfaces.call_args[1]['action'],
+            "delete")
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["size"], 0)
+
+    @mock.patch("wafflehaus.neutron.nova_interaction.NovaConn")
+    @mock.patch("wafflehaus.neutron.nova_interaction.NeutronConn")
+    def test_delete_with_internal_lookup(self, mock_neutron, mock_nova):
+        mock_nova_conn = mock.MagicMock()
+        mock_nova_conn.admin_virtual_interfaces.return_value = (
+            self.nova_response)
+        mock_nova.return_value = mock_nova_conn
+        seen = []
+
+        @webob.dec.wsgify
+        def app(req):
+            seen.append((req.method, req.script_name, req.path_info,
+                         req.environ.get('neutron.context')))
+            return webob.Response(body=json.dumps(self.body), status=200)
+
+        self.conf.update({"neutron_lookup": "internal",
+                          "resources": "DELETE /v2.0/ports/{port_id}"})
+        test_filter = nova_interaction.filter_factory(self.conf)(app)
+        req = webob.Request.blank("/ports/random_port_id", method="DELETE",
+                                  environ={"SCRIPT_NAME": "/v2.0"})
+        with mock.patch.object(test_filter, "_admin_context",
+                               return_value="admin"):
+            resp = test_filter(req)
+
+        self.assertFalse(mock_neutron.called)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(seen[0], ("GET", "/v2.0", "/ports/random_port_id",
+                                   "admin"))
+        self.assertEqual(seen[1][0], "DELETE")
+        self.assertEqual(
+            mock_nova_conn.admin_virtual_interfaces.call_args[1]['address'],
+            "AA:BB:CC:DD:EE")
+
+    @mock.patch("wafflehaus.neutron.nova_interaction.NovaConn")
+    @mock.patch("wafflehaus.neutron.nova_interaction.NeutronConn")
+    def test_nova_failure_with_deadline(self, mock_neutron, mock_nova):
+        mock_conn = mock.MagicMock()
+        mock_conn.admin_virtual_interfaces.return_value = (
+            None, breaker.DeadlineExceededError("too late"))
+        mock_nova.return_value = mock_conn
+        self.conf["request_deadline"] = "10"
+        test_filter = nova_interaction.filter_factory(self.conf)(self.fake_app)
+        with mock.patch("time.time", return_value=100):
+            resp = test_filter(webob.Request.blank("/v2/ports",
+                                                   method="POST"))
+
+        self.assertEqual(resp.status_code, 500)
+        self.assertEqual(resp.json['nova_callback']['error'], "too late")
+        kwargs = mock_conn.admin_virtual_interfaces.call_args[1]
+        self.assertEqual(kwargs['deadline'], 110)
+
+    @mock.patch("wafflehaus.neutron.nova_interaction.NovaConn")
+    @mock.patch("wafflehaus.neutron.nova_interaction.NeutronConn")
+    def test_deadline_counted_from_request(self, mock_neutron, mock_nova):
+        mock_conn = mock.MagicMock()
+        mock_conn.admin_virtual_interfaces.return_value = self.nova_response
+        mock_nova.return_value = mock_conn
+        self.conf["request_deadline"] = "10"
+        clock = [100]
+
+        @webob.dec.wsgify
+        def slow_neutron(req):
+            clock[0] += 4
+            return self.fake_app(req)
+        test_filter = nova_interaction.filter_factory(self.conf)(slow_neutron)
+        with mock.patch("time.time", side_effect=lambda: clock[0]):
+            test_filter(webob.Request.blank("/v2/ports/random_port_id",
+                                            method="PUT"))
+
+        kwargs = mock_conn.admin_virtual_interfaces.call_args[1]
+        self.assertEqual(kwargs['deadline'], 110)
+
+    def _bulk_body(self, count):
+        ports = []
+        for i in range(count):
+            port = dict(self.body['port'])
+            port.update({'id': "port_%d" % i, 'instance_id': "inst_%d" % i})
+            ports.append(port)
+        return {'ports': ports}
+
+    @mock.patch("wafflehaus.neutron.nova_interaction.NovaConn")
+    @mock.patch("wafflehaus.neutron.nova_interaction.NeutronConn")
+    def test_bulk_post_to_ports(self, mock_neutron, mock_nova):
+        def nova(deadline=None, **vif):
+            if vif['port_id'] == "port_3":
+                return 503, "ERROR!"
+            return self.nova_response
+
+        mock_conn = mock.MagicMock()
+        mock_conn.admin_virtual_interfaces.side_effect = nova
+        mock_nova.return_value = mock_conn
+        self.body = self._bulk_body(5)
+        test_filter = nova_interaction.filter_factory(self.conf)(self.fake_app)
+        resp = test_filter(webob.Request.blank("/v2/ports", method="POST"))
+        callbacks = resp.json['nova_callbacks']
+
+        self.assertEqual(resp.status_code, 500)
+        self.assertEqual(mock_conn.admin_virtual_interfaces.call_count, 5)
+        self.assertEqual([c['port_id'] for c in callbacks],
+                         ["port_%d" % i for i in range(5)])
+        self.assertEqual([c['status'] for c in callbacks],
+                         ["success"] * 3 + ["error", "success"])
+        self.assertEqual(callbacks[3]['error'], "ERROR!")
+        self.assertEqual(test_filter.port_cache.stats()["size"], 4)
+        self.assertIsNone(test_filter.port_cache.get("port_3"))
+
+    @mock.patch("wafflehaus.neutron.nova_interaction.NovaConn")
+    @mock.patch("wafflehaus.neutron.nova_interaction.NeutronConn")
+    def test_bulk_post_to_ports_async(self, mock_neutron, mock_nova):
+        mock_conn = mock.MagicMock()
+        mock_conn.admin_virtual_interfaces.return_value = self.nova_response
+        mock_nova.return_value = mock_conn
+        self.body = self._bulk_body(3)
+        self.conf["callback_mode"] = "async"
+        test_filter = nova_interaction.filter_factory(self.conf)(self.fake_app)
+        resp = test_filter(webob.Request.blank("/v2/ports", method="POST"))
+        test_filter.dispatcher.join()
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual([c['status'] for c in resp.json['nova_callbacks']],
+                         ["queued"] * 3)
+        self.assertEqual(mock_conn.admin_virtual_interfaces.call_count, 3)
+
+    @mock.patch("wafflehaus.neutron.nova_interaction.NovaConn")
+    @mock.patch("wafflehaus.neutron.nova_interaction.NeutronConn")
+    def test_unchanged_put_suppressed(self, mock_neutron, mock_nova):
+        mock_conn = mock.MagicMock()
+        mock_conn.admin_virtual_interfaces.return_value = self.nova_response
+        mock_nova.return_value = mock_conn
+        self.conf.update({"change_detection": "true",
+                          "port_cache_backend": "shared"})
+        test_filter = nova_interaction.filter_factory(self.conf)(self.fake_app)
+        req = "/v2/ports/random_port_id"
+        first = test_filter(webob.Request.blank(req, method="PUT"))
+        second = test_filter(webob.Request.blank(req, method="PUT"))
+        self.body['port']['fixed_ips'] = "other_ips"
+        third = test_filter(webob.Request.blank(req, method="PUT"))
+
+        self.assertEqual(first.json['nova_callback']['status'], "success")
+        self.assertEqual(second.json['nova_callback']['status'], "unchanged")
+        self.assertEqual(third.json['nova_callback']['status'], "success")
+        self.assertEqual(mock_conn.admin_virtual_interfaces.call_count, 2)
+        self.assertFalse(mock_neutron.called)
+        self.assertEqual(test_filter.change_stats(),
+                         {"checked": 2, "suppressed": 1})
+
+    @mock.patch("wafflehaus.neutron.nova_interaction.NovaConn")
+    @mock.patch("wafflehaus.neutron.nova_interaction.NeutronConn")
+    def test_put_retried_after_failed_callback(self, mock_neutron,
+                                               mock_nova):
+        mock_conn = mock.MagicMock()
+        mock_conn.admin_virtual_interfaces.side_effect = [
+            (503, "ERROR!"), self.nova_response]
+        mock_nova.return_value = mock_conn
+        self.conf.update({"change_detection": "true",
+                          "port_cache_backend": "shared"})
+        test_filter = nova_interaction.filter_factory(self.conf)(self.fake_app)
+        req = "/v2/ports/random_port_id"
+        first = test_filter(webob.Request.blank(req, method="PUT"))
+        retry = test_filter(webob.Request.blank(req, method="PUT"))
+
+        self.assertEqual(first.status_code, 500)
+        self.assertEqual(retry.json['nova_callback']['status'], "success")
+        self.assertEqual(mock_conn.admin_virtual_interfaces.call_count, 2)
+
+    @mock.patch("wafflehaus.neutron.nova_interaction.NovaConn")
+    @mock.patch("wafflehaus.neutron.nova_interaction.NeutronConn")
+    def test_async_put_retried_after_failed_callback(self, mock_neutron,
+                                                     mock_nova):
+        mock_conn = mock.MagicMock()
+        mock_conn.admin_virtual_interfaces.side_effect = [
+            (503, "ERROR!"), self.nova_response]
+        mock_nova.return_value = mock_conn
+        self.conf.update({"change_detection": "true",
+                          "port_cache_backend": "shared",
+                          "callback_mode": "async", "callback_retries": "0"})
+        test_filter = nova_interaction.filter_factory(self.conf)(self.fake_app)
+        req = "/v2/ports/random_port_id"
+        statuses = []
+        for _ in range(3):
+            resp = test_filter(webob.Request.blank(req, method="PUT"))
+            test_filter.dispatcher.join()
+            statuses.append(resp.json['nova_callback']['status'])
+
+        self.assertEqual(statuses, ["queued", "queued", "unchanged"])
+        self.assertEqual(mock_conn.admin_virtual_interfaces.call_count, 2)
+        self.assertEqual(test_filter.callback_stats()["failed"], 1)
+
+    @mock.patch("wafflehaus.neutron.nova_interaction.NovaConn")
+    @mock.patch("wafflehaus.neutron.nova_interaction.NeutronConn")
+    def test_local_cache_not_used_for_change_detection(self, mock_neutron,
+                                                       mock_nova):
+        mock_conn = mock.MagicMock()
+        mock_conn.admin_virtual_interfaces.return_value = self.nova_response
+        mock_nova.return_value = mock_conn
+        self.conf["change_detection"] = "true"
+        test_filter = nova_interaction.filter_factory(self.conf)(self.fake_app)
+        for _ in range(2):
+            resp = test_filter(webob.Request.blank(
+                "/v2/ports/random_port_id", method="PUT"))
+
+        self.assertEqual(resp.json['nova_callback']['status'], "success")
+        self.assertEqual(mock_conn.admin_virtual_interfaces.call_count, 2)
+        self.assertFalse(mock_neutron.called)
+
+    @mock.patch("wafflehaus.neutron.nova_interaction.NovaConn")
+    @mock.patch("wafflehaus.neutron.nova_interaction.NeutronConn")
+    def test_unchanged_put_suppressed_with_preimage(self, mock_neutron,
+                                                    mock_nova):
+        mock_neutron_conn = mock.MagicMock()
+        mock_neutron_conn.ports.return_value = self.neutron_response
+        mock_neutron.return_value = mock_neutron_conn
+        mock_conn = mock.MagicMock()
+        mock_nova.return_value = mock_conn
+        self.conf.update({"change_detection": "true",
+                          "change_detection_preimage": "true"})
+        test_filter = nova_interaction.filter_factory(self.conf)(self.fake_app)
+        resp = test_filter(webob.Request.blank("/v2/ports/random_port_id",
+                                               method="PUT"))
+
+        self.assertTrue(mock_neutron_conn.ports.called)
+        self.assertFalse(mock_conn.admin_virtual_interfaces.called)
+        self.assertEqual(resp.json['nova_callback']['status'], "unchanged")
+
+    @mock.patch("wafflehaus.neutron.nova_interaction.NovaConn")
+    @mock.patch("wafflehaus.neutron.nova_interaction.NeutronConn")
+    def test_change_detection_off_by_default(self, mock_neutron, mock_nova):
+        mock_conn = mock.MagicMock()
+        mock_conn.admin_virtual_interfaces.return_value = self.nova_response
+        mock_nova.return_value = mock_conn
+        test_filter = nova_interaction.filter_factory(self.conf)(self.fake_app)
+        for _ in range(2):
+            test_filter(webob.Request.blank("/v2/ports/random_port_id",
+                                            method="PUT"))
+
+        self.assertEqual(mock_conn.admin_virtual_interfaces.call_count, 2)
+
+
+class TestIpAddresses(test_base.TestBase):
+    def setUp(self):
+        super(TestIpAddresses, self).setUp()
+        self.ip_address = {"ip_address": {"id": "ip1",
+                                          "address": "10.0.0.5",
+                                          "port_ids": ["p2", "p3"]}}
+        self.conf = {"enabled": "true", "nova_url": "https://nova",
+                     "neutron_url": "https://neutron",
+                     "resources": "POST /v2/ip_addresses,"
+                                  "PUT DELETE /v2/ip_addresses/{ip_id}"}
+        self.filter = nova_interaction.filter_factory(self.conf)(
+            self.neutron_app)
+        self.ports = {}
+        for port_id, instance_id in (("p1", "i1"), ("p2", "i2"),
+                                     ("p3", None)):
+            self.ports[port_id] = {"port": {"mac_address": "AA",
+                                            "fixed_ips": [port_id],
+                                            "instance_id": instance_id,
+                                            "network_id": "n",
+                                            "tenant_id": "t"}}
+        patcher = mock.patch.object(self.filter.neutron_conn, "ports",
+                                    side_effect=self._port)
+        self.lookups = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(self.filter.neutron_conn, "ip_addresses",
+                                    return_value=(200, {"ip_address": {
+                                        "port_ids": ["p1", "p2"]}}))
+        self.ip_lookup = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(self.filter.nova_conn,
+                                    "admin_virtual_interfaces",
+                                    return_value=(200, None))
+        self.nova = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _port(self, port_id=None, deadline=None):
+        if port_id not in self.ports:
+            return 404, "no such port"
+        return 200, self.ports[port_id]
+
+    @webob.dec.wsgify
+    def neutron_app(self, req):
+        if req.method == "DELETE":
+            return webob.Response(status=204)
+        return webob.Response(body=json.dumps(self.ip_address), status=201)
+
+    def _callbacks(self, resp):
+        return dict((c["port_id"], c) for c in resp.json["nova_callbacks"])
+
+    def test_create_calls_nova_for_attached_ports(self):
+        req = webob.Request.blank("/v2/ip_addresses", method="POST")
+        resp = self.filter(req)
+        callbacks = self._callbacks(resp)
+
+        self.assertEqual(resp.status_code, 201)
+        self.assertEqual(callbacks["p2"]["status"], "success")
+        self.assertEqual(callbacks["p3"]["status"], "skipped")
+        self.assertEqual(self.nova.call_count, 1)
+        self.assertEqual(self.nova.call_args[1]["fixed_ips"], ["p2"])
+        self.assertFalse(self.ip_lookup.called)
+
+    def test_update_includes_detached_ports(self):
+        req = webob.Request.blank("/v2/ip_addresses/ip1", method="PUT")
+        resp = self.filter(req)
+
+        self.assertEqual(sorted(self._callbacks(resp)), ["p1", "p2", "p3"])
+        self.assertEqual(self.ip_lookup.call_args[1]["ip_address_id"], "ip1")
+        self.assertEqual(sorted(c[1]["port_id"] for c in
+                                self.nova.call_args_list), ["p1", "p2"])
+
+    def test_delete_refreshes_previous_ports(self):
+        req = webob.Request.blank("/v2/ip_addresses/ip1", method="DELETE")
+        resp = self.filter(req)
+
+        self.assertEqual(sorted(self._callbacks(resp)), ["p1", "p2"])
+        self.assertEqual(self.nova.call_count, 2)
+
+    def test_ip_lookup_failure(self):
+        self.ip_lookup.return_value = (500, "ERROR!")
+        req = webob.Request.blank("/v2/ip_addresses/ip1", method="DELETE")
+        resp = self.filter(req)
+
+        self.assertEqual(resp.status_code, 500)
+        self.assertEqual(resp.json["neutron_callback"]["status"], "error")
+        self.assertFalse(self.nova.called)
+
+    def test_port_lookup_and_nova_failures(self):
+        del self.ports["p1"]
+        self.nova.return_value = (500, "ERROR!")
+        req = webob.Request.blank("/v2/ip_addresses/ip1", method="PUT")
+        resp = self.filter(req)
+        callbacks = self._callbacks(resp)
+
+        self.assertEqual(resp.status_code, 500)
+        self.assertEqual(callbacks["p1"]["error"], "no such port")
+        self.assertEqual(callbacks["p2"]["error"], "ERROR!")
+
+    def test_internal_lookup(self):
+        req = webob.Request.blank("/v2.0/ip_addresses/ip1")
+        conn = common.InternalNeutronConnection(self.neutron_app, req, None,
+                                                log=mock.MagicMock())
+        status, resp = conn.ip_addresses(ip_address_id="ip1")
+
+        self.assertEqual(conn.prefix, "/v2.0")
+        self.assertEqual(resp, self.ip_address)
+
+
+class TestFanOut(test_base.TestBase):
+    def test_results_in_order(self):
+        def square(x):
+            time.sleep(0.001 * (5 - x))
+            return x * x
+
+        self.assertEqual(dispatch.fan_out(square, range(5), 3),
+                         [0, 1, 4, 9, 16])
+
+    def test_concurrency_bounded(self):
+        lock = threading.Lock()
+        state = {"in_flight": 0, "peak": 0}
+
+        def call(item):
+            with lock:
+                state["in_flight"] += 1
+                state["peak"] = max(state["peak"], state["in_flight"])
+            time.sleep(0.02)
+            with lock:
+                state["in_flight"] -= 1
+            return item
+
+        start = time.time()
+        dispatch.fan_out(call, range(20), 10)
+        elapsed = time.time() - start
+
+        self.assertTrue(state["peak"] <= 10)
+        self.assertTrue(elapsed < 0.2)
+
+    def test_errors_returned(self):
+        def fail(item):
+            raise ValueError(item)
+
+        status, error = dispatch.fan_out(fail, ["boom"], 1)[0]
+
+        self.assertIsNone(status)
+        self.assertIsInstance(error, ValueError)
+
+
+class TestPortCache(test_base.TestBase):
+    def setUp(self):
+        super(TestPortCache, self).setUp()
+        self.port = {'mac_address': "AA:BB:CC:DD:EE",
+                     'fixed_ips': [],
+                     'instance_id': "id_instance",
+                     'network_id': "id_network",
+                     'tenant_id': "id_tenant",
+                     'name': "ignored"}
+
+    def test_keeps_only_vif_fields(self):
+        port_cache = cache.PortCache()
+        port_cache.set("port", self.port)
+
+        self.assertEqual(sorted(port_cache.get("port").keys()),
+                         sorted(cache.VIF_FIELDS))
+
+    def test_entries_expire(self):
+        port_cache = cache.PortCache(ttl=10)
+        with mock.patch("time.time", return_value=100):
+            port_cache.set("port", self.port)
+        with mock.patch("time.time", return_value=111):
+            self.assertIsNone(port_cache.get("port"))
+
+        self.assertEqual(port_cache.stats()["expired"], 1)
+
+    def test_least_recently_used_evicted(self):
+        port_cache = cache.PortCache(size=2)
+        port_cache.set("first", self.port)
+        port_cache.set("second", self.port)
+        port_cache.get("first")
+        port_cache.set("third", self.port)
+
+        self.assertIsNotNone(port_cache.get("first"))
+        self.assertIsNone(port_cache.get("second"))
+        self.assertEqual(port_cache.stats()["evictions"], 1)
+
+    def test_latency_saved(self):
+        port_cache = cache.PortCache()
+        port_cache.get("port")
+        port_cache.record_lookup(0.5)
+        port_cache.set("port", self.port)
+        port_cache.get("port")
+        stats = port_cache.stats()
+
+        self.assertEqual(stats["hit_rate"], 0.5)
+        self.assertEqual(stats["latency_saved"], 0.5)
+
+    def test_vif_changed(self):
+        ips = [{"subnet_id": "a", "ip_address": "10.0.0.1"},
+               {"subnet_id": "b", "ip_address": "10.0.0.2"}]
+        new = dict(self.port, fixed_ips=list(reversed(ips)), name="new")
+        old = dict(self.port, fixed_ips=ips)
+
+        self.assertFalse(cache.vif_changed(old, new))
+        self.assertTrue(cache.vif_changed(old, dict(new, fixed_ips=ips[:1])))
+        self.assertTrue(cache.vif_changed(old, dict(new, mac_address="FF")))
+
+    def test_disabled(self):
+        port_cache = cache.PortCache(size=0)
+        port_cache.set("port", self.port)
+
+        self.assertIsNone(port_cache.get("port"))
+
+
+class TestCallbackDispatcher(test_base.TestBase):
+    def setUp(self):
+        super(TestCallbackDispatcher, self).setUp()
+        self.log = mock.MagicMock()
+        self.send = mock.MagicMock()
+
+    def test_retries_until_success(self):
+        self.send.side_effect = [(503, "down"), (503, "down"), (200, "ok")]
+        dispatcher = dispatch.CallbackDispatcher(self.send, self.log,
+                                                 workers=1, retries=3,
+                                                 retry_delay=0)
+        dispatcher.submit({"instance_id": "inst"})
+        dispatcher.join()
+        stats = dispatcher.stats()
+
+        self.assertEqual(self.send.call_count, 3)
+        self.assertEqual(stats["retried"], 2)
+        self.assertEqual(stats["delivered"], 1)
+        self.assertEqual(stats["failed"], 0)
+
+    def test_gives_up_after_retries(self):
+        self.send.return_value = (503, "down")
+        dispatcher = dispatch.CallbackDispatcher(self.send, self.log,
+                                                 workers=2, retries=1,
+                                                 retry_delay=0)
+        dispatcher.submit({"instance_id": "inst"})
+        dispatcher.join()
+
+        self.assertEqual(self.send.call_count, 2)
+        self.assertEqual(dispatcher.stats()["failed"], 1)
+        self.assertTrue(self.log.error.called)
+
+    def test_workers_restarted_after_fork(self):
+        self.send.return_value = (200, "ok")
+        dispatcher = dispatch.CallbackDispatcher(self.send, self.log,
+                                                 workers=1)
+        dispatcher.submit({"instance_id": "inst"})
+        dispatcher.join()
+        parent_queue = dispatcher.queue
+        with mock.patch("os.getpid", return_value=dispatcher.pid + 1):
+            dispatcher.submit({"instance_id": "inst"})
+        dispatcher.join()
+
+        self.assertIsNot(parent_queue, dispatcher.queue)
+        self.assertEqual(dispatcher.stats()["delivered"], 2)
+
+
+class FakeNova(object):
+    """Records admin-virtual-interfaces calls like a local Nova would."""
+
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, deadline=None, **vif):
+        self.calls.append((vif["port_id"], vif["action"], vif.get("name")))
+        return 200, {"virtual_interface": vif}
+
+
+class TestCoalescing(test_base.TestBase):
+    def setUp(self):
+        super(TestCoalescing, self).setUp()
+        self.log = mock.MagicMock()
+        self.nova = FakeNova()
+        self.dispatcher = dispatch.CallbackDispatcher(self.nova, self.log,
+                                                      workers=1,
+                                                      coalesce_window=60)
+
+    def _vif(self, port_id, action, name=None, instance_id="inst"):
+        return {"instance_id": instance_id, "port_id": port_id,
+                "action": action, "name": name}
+
+    def test_updates_merged_to_last(self):
+        self.dispatcher.submit(self._vif("port", "create", "first"))
+        self.dispatcher.submit(self._vif("port", "create", "second"))
+        self.dispatcher.submit(self._vif("port", "create", "third"))
+        self.assertEqual(self.dispatcher.stats()["windows"], 1)
+        self.dispatcher.join()
+
+        self.assertEqual(self.nova.calls, [("port", "create", "third")])
+        self.assertEqual(self.dispatcher.stats()["coalesced"], 2)
+
+    def test_new_port_deleted_cancels_out(self):
+        self.dispatcher.submit(self._vif("port", "create"), fresh=True)
+        self.dispatcher.submit(self._vif("port", "create"))
+        self.dispatcher.submit(self._vif("port", "delete"))
+        self.dispatcher.join()
+
+        self.assertEqual(self.nova.calls, [])
+        self.assertEqual(self.dispatcher.stats()["cancelled"], 2)
+
+    def test_existing_port_deleted_sends_delete(self):
+        self.dispatcher.submit(self._vif("port", "create"))
+        self.dispatcher.submit(self._vif("port", "delete"))
+        self.dispatcher.join()
+
+        self.assertEqual(self.nova.calls, [("port", "delete", None)])
+
+    def test_full_queue_loses_nothing(self):
+        dispatcher = dispatch.CallbackDispatcher(self.nova, self.log,
+                                                 workers=1, queue_size=1,
+                                                 coalesce_window=60)
+        accepted = [dispatcher.submit(self._vif("port_%d" % i, "create"))
+                    for i in range(10)]
+        refused = dispatcher.submit(self._vif("port", "create",
+                                              instance_id="other"))
+        dispatcher.join()
+
+        self.assertEqual(accepted, [True] * 10)
+        self.assertFalse(refused)
+        self.assertEqual(sorted(c[0] for c in self.nova.calls),
+                         sorted("port_%d" % i for i in range(10)))
+        stats = dispatcher.stats()
+        self.assertEqual((stats["delivered"], stats["dropped"]), (10, 1))
+
+    def test_one_call_per_port(self):
+        for port in ("a", "b", "c"):
+            self.dispatcher.submit(self._vif(port, "create"), fresh=True)
+            self.dispatcher.submit(self._vif(port, "create"))
+        self.dispatcher.submit(self._vif("a", "create", instance_id="other"))
+        self.dispatcher.join()
+
+        self.assertEqual(sorted(c[0] for c in self.nova.calls),
+                         ["a", "a", "b", "c"])
+
+    def test_window_not_flushed_early(self):
+        self.dispatcher.submit(self._vif("port", "create"))
+        self.dispatcher.flush()
+
+        self.assertEqual(self.dispatcher.stats()["windows"], 1)
+        self.assertEqual(self.nova.calls, [])
+
+    def test_cancelled_entries_leave_outbox(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        box = outbox.Outbox(os.path.join(tmpdir, "outbox.db"), self.log)
+        dispatcher = dispatch.CallbackDispatcher(self.nova, self.log,
+                                                 workers=1, outbox=box,
+                                                 coalesce_window=60)
+        dispatcher.submit(self._vif("new", "create"), fresh=True)
+        dispatcher.submit(self._vif("new", "delete"))
+        dispatcher.submit(self._vif("old", "create"))
+        dispatcher.submit(self._vif("old", "create"))
+        dispatcher.join()
+
+        self.assertEqual(self.nova.calls, [("old", "create", None)])
+        self.assertEqual(box.stats()["pending"], 0)
+
+
+class TestOutbox(test_base.TestBase):
+    def setUp(self):
+        super(TestOutbox, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, "outbox.db")
+        self.log = mock.MagicMock()
+        self.vif = {"action": "create", "instance_id": "inst",
+                    "port_id": "port"}
+
+    def test_append_and_compact(self):
+        box = outbox.Outbox(self.path, self.log, compact_every=2)
+        first = box.append(self.vif)
+        second = box.append(self.vif)
+        box.done(first)
+
+        self.assertEqual(second, first + 1)
+        self.assertEqual(box.stats()["pending"], 1)
+        box.done(second)
+        stats = box.stats()
+        self.assertEqual(stats["pending"], 0)
+        self.assertEqual(stats["compactions"], 1)
+        count = box._connect().execute("SELECT COUNT(*) FROM callbacks")
+        self.assertEqual(count.fetchone()[0], 0)
+
+    def test_concurrent_appends_are_grouped(self):
+        box = outbox.Outbox(self.path, self.log)
+        threads = [threading.Thread(target=box.append, args=(self.vif,))
+                   for _ in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stats = box.stats()
+
+        self.assertEqual(stats["appended"], 20)
+        self.assertEqual(stats["pending"], 20)
+        self.assertTrue(stats["batches"] <= 20)
+
+    def test_claim_orphans_of_dead_workers_only(self):
+        box = outbox.Outbox(self.path, self.log)
+        entry_id = box.append(self.vif)
+        box.db.execute("UPDATE callbacks SET owner = '-1:dead'")
+        box.append(self.vif)
+        with mock.patch.object(outbox, "_pid_alive", return_value=False):
+            orphans = box.claim_orphans()
+            self.assertEqual(box.claim_orphans(), [])
+
+        self.assertEqual(orphans, [(entry_id, self.vif)])
+
+    def test_predecessor_with_same_pid_is_orphaned(self):
+        box = outbox.Outbox(self.path, self.log)
+        entry_id = box.append(self.vif)
+        box.db.execute("UPDATE callbacks SET owner = ?",
+                       ("%d:earlier" % os.getpid(),))
+        box.append(self.vif)
+
+        self.assertEqual(box.claim_orphans(), [(entry_id, self.vif)])
+        self.assertEqual(box.claim_orphans(), [])
+
+    def test_undelivered_own_entries(self):
+        box = outbox.Outbox(self.path, self.log)
+        old = box.append(self.vif)
+        box.db.execute("UPDATE callbacks SET created = created - 60")
+        delivered = box.append(self.vif)
+        box.db.execute("UPDATE callbacks SET created = created - 60")
+        box.done(delivered)
+        box.append(self.vif)
+        other = box.append(self.vif)
+        box.db.execute("UPDATE callbacks SET owner = '-1:other', "
+                       "created = created - 60 WHERE id = ?", (other,))
+
+        self.assertEqual(box.undelivered(30), [(old, self.vif)])
+
+    def test_failed_callback_resent(self):
+        box = outbox.Outbox(self.path, self.log)
+        send = mock.MagicMock(side_effect=[(503, "ERROR!"), (200, "ok")])
+        dispatcher = dispatch.CallbackDispatcher(send, self.log, workers=1,
+                                                 retries=0, outbox=box,
+                                                 resend_interval=0.05)
+        dispatcher.submit(self.vif)
+        for _ in range(100):
+            if box.stats()["pending"] == 0:
+                break
+            time.sleep(0.05)
+        dispatcher.resend_interval = 0
+        dispatcher.replayer.join()
+        stats = dispatcher.stats()
+
+        self.assertEqual(send.call_count, 2)
+        self.assertEqual(box.stats()["pending"], 0)
+        self.assertEqual(stats["failed"], 1)
+        self.assertEqual(stats["resent"], 1)
+
+    def test_replay_does_not_block_start(self):
+        box = outbox.Outbox(self.path, self.log)
+        for _ in range(3):
+            box.append(self.vif)
+        box.db.execute("UPDATE callbacks SET owner = '-1:dead'")
+        release = threading.Event()
+
+        def send(**vif):
+            release.wait(5)
+            return 200, "ok"
+        dispatcher = dispatch.CallbackDispatcher(send, self.log, workers=1,
+                                                 queue_size=1, outbox=box)
+        with mock.patch.object(outbox, "_pid_alive", return_value=False):
+            start = time.time()
+            dispatcher.start()
+            self.assertTrue(time.time() - start < 1)
+            release.set()
+            dispatcher.join()
+
+        self.assertEqual(box.stats()["pending"], 0)
+
+    def test_dispatcher_replays_and_marks_done(self):
+        box = outbox.Outbox(self.path, self.log)
+        box.append(self.vif)
+        box.db.execute("UPDATE callbacks SET owner = '-1:dead'")
+        send = mock.MagicMock(return_value=(200, "ok"))
+        dispatcher = dispatch.CallbackDispatcher(send, self.log, workers=1,
+                                                 outbox=box)
+        with mock.patch.object(outbox, "_pid_alive", return_value=False):
+            dispatcher.submit(self.vif)
+            dispatcher.join()
+
+        self.assertEqual(send.call_count, 2)
+        self.assertEqual(box.stats()["pending"], 0)
+        self.assertEqual(dispatcher.stats()["outbox"]["completed"], 2)
+
+
+class TestSessionPool(test_base.TestBase):
+    def setUp(self):
+        super(TestSessionPool, self).setUp()
+        self.addCleanup(common._pools.clear)
+        self.log = mock.MagicMock()
+
+    def test_pool_shared_by_name(self):
+        first = common.get_session_pool("shared")
+        second = common.get_session_pool("shared")
+        other = common.get_session_pool("other")
+
+        self.assertIs(first, second)
+        self.assertIsNot(first, other)
+
+    def test_pool_rebuilt_after_fork(self):
+        first = common.get_session_pool("forked")
+        with mock.patch("os.getpid", return_value=first.pid + 1):
+            second = common.get_session_pool("forked")
+            self.assertEqual(common.pool_stats().keys(), ["forked"])
+
+        self.assertIsNot(first, second)
+        self.assertEqual(second.pid, first.pid + 1)
+
+    def test_pool_sizes(self):
+        pool = common.get_session_pool("sized", pool_connections=2,
+                                       pool_maxsize=7)
+        stats = pool.stats()
+
+        self.assertEqual(pool.adapter._pool_maxsize, 7)
+        self.assertEqual(stats["pool_connections"], 2)
+        self.assertEqual(stats["pool_maxsize"], 7)
+        self.assertEqual(stats["hosts"], {})
+
+    def test_calls_go_through_session(self):
+        conn = common.NovaConnection(log=self.log, url="http://nova",
+                                     port=8774, pool_name="calls")
+        fake_resp = mock.MagicMock(status_code=200, content='{"a": 1}')
+        fake_resp.json.return_value = {"a": 1}
+        with mock.patch.object(conn.pool.session, "request",
+                               return_value=fake_resp) as request:
+            status, body = conn.put("http://nova:8774/thing", {"b": 2})
+            conn.put("http://nova:8774/thing", {"b": 2})
+
+        self.assertEqual((status, body), (200, {"a": 1}))
+        self.assertEqual(conn.url, "http://nova:8774")
+        self.assertEqual(request.call_count, 2)
+        self.assertEqual(request.call_args[0][0], "PUT")
+        self.assertEqual(request.call_args[1]["data"], '{"b": 2}')
+        self.assertEqual(common.pool_stats("calls")["calls"], 2)
+
+    def test_failed_call_counted(self):
+        conn = common.NeutronConnection(log=self.log, url="http://neutron",
+                                        pool_name="failing")
+        with mock.patch.object(conn.pool.session, "request",
+                               side_effect=IOError("boom")):
+            status, resp = conn.ports(port_id="port")
+
+        self.assertIsNone(status)
+        self.assertIsInstance(resp, IOError)
+        self.assertEqual(common.pool_stats("failing")["errors"], 1)
+
+
+class TestCircuitBreaker(test_base.TestBase):
+    def setUp(self):
+        super(TestCircuitBreaker, self).setUp()
+        self.log = mock.MagicMock()
+        self.breaker = breaker.CircuitBreaker("http://nova", self.log,
+                                              failures=2, reset_timeout=10)
+
+    def _fail(self, times):
+        for _ in range(times):
+            self.breaker.before_call()
+            self.breaker.after_call(False, 0.1)
+
+    def test_opens_after_consecutive_failures(self):
+        self._fail(1)
+        self.breaker.before_call()
+        self.breaker.after_call(True, 0.1)
+        self._fail(2)
+
+        self.assertEqual(self.breaker.state, breaker.OPEN)
+        self.assertRaises(breaker.CircuitOpenError, self.breaker.before_call)
+        self.assertEqual(self.breaker.stats()["rejected"], 1)
+        self.assertTrue(self.log.warning.called)
+
+    def test_slow_calls_count_as_failures(self):
+        slow = breaker.CircuitBreaker("http://nova", self.log, failures=1,
+                                      slow_call=1)
+        slow.before_call()
+        slow.after_call(True, 2)
+
+        self.assertEqual(slow.state, breaker.OPEN)
+
+    def test_half_open_probe_closes(self):
+        with mock.patch("time.time", return_value=100):
+            self._fail(2)
+        with mock.patch("time.time", return_value=111):
+            self.breaker.before_call()
+            self.assertEqual(self.breaker.state, breaker.HALF_OPEN)
+            # Only one probe at a time
+            self.assertRaises(breaker.CircuitOpenError,
+                              self.breaker.before_call)
+            self.breaker.after_call(True, 0.1)
+
+        self.assertEqual(self.breaker.state, breaker.CLOSED)
+        self.assertEqual(self.breaker.stats()["opened"], 1)
+        self.assertEqual(self.breaker.stats()["closed"], 1)
+
+    def test_half_open_probe_failure_reopens(self):
+        with mock.patch("time.time", return_value=100):
+            self._fail(2)
+        with mock.patch("time.time", return_value=111):
+            self.breaker.before_call()
+            self.breaker.after_call(False, 0.1)
+
+        self.assertEqual(self.breaker.state, breaker.OPEN)
+        self.assertEqual(self.breaker.stats()["opened"], 2)
+
+    def test_registry_per_endpoint(self):
+        registry = breaker.BreakerRegistry(self.log)
+        first = registry.for_url("https://nova:8774/v2/a")
+        second = registry.for_url("https://nova:8774/v2/b")
+        other = registry.for_url("https://nova2:8774/v2/a")
+
+        self.assertIs(first, second)
+        self.assertIsNot(first, other)
+        self.assertIsNone(breaker.BreakerRegistry(
+            self.log, failures=0).for_url("https://nova"))
+
+
+class TestConnectionLimits(test_base.TestBase):
+    def setUp(self):
+        super(TestConnectionLimits, self).setUp()
+        self.addCleanup(common._pools.clear)
+        self.log = mock.MagicMock()
+        self.breakers = breaker.BreakerRegistry(self.log, failures=1)
+        self.conn = common.NovaConnection(log=self.log, url="http://nova",
+                                          pool_name="limits",
+                                          connect_timeout=2, read_timeout=20,
+                                          breakers=self.breakers)
+        patcher = mock.patch.object(self.conn.pool.session, "request")
+        self.request = patcher.start()
+        self.request.return_value = mock.MagicMock(status_code=503,
+                                                   content="")
+
+    def test_timeouts_passed(self):
+        self.conn.put("http://nova/thing", {})
+
+        self.assertEqual(self.request.call_args[1]["timeout"], (2, 20))
+
+    def test_deadline_shortens_timeouts(self):
+        with mock.patch("time.time", return_value=100):
+            self.conn.put("http://nova/thing", {}, deadline=105)
+
+        self.assertEqual(self.request.call_args[1]["timeout"], (2, 5))
+
+    def test_deadline_passed_fails_fast(self):
+        with mock.patch("time.time", return_value=100):
+            status, resp = self.conn.put("http://nova/thing", {},
+                                         deadline=99)
+
+        self.assertIsNone(status)
+        self.assertIsInstance(resp, breaker.DeadlineExceededError)
+        self.assertFalse(self.request.called)
+
+    def test_open_circuit_fails_fast(self):
+        self.conn.put("http://nova/thing", {})
+        status, resp = self.conn.put("http://nova/thing", {})
+
+        self.assertIsNone(status)
+        self.assertIsInstance(resp, breaker.CircuitOpenError)
+        self.assertEqual(self.request.call_count, 1)
+        self.assertEqual(self.breakers.stats()["http://nova"]["state"],
+                         breaker.OPEN)
+
+
+class TestSingleFlight(test_base.TestBase):
+    def setUp(self):
+        super(TestSingleFlight, self).setUp()
+        self.flight = singleflight.SingleFlight()
+        self.release = threading.Event()
+        self.calls = []
+
+    def _slow(self, value):
+        self.calls.append(value)
+        self.release.wait(5)
+        if isinstance(value, Exception):
+            raise value
+        return value
+
+    def _run(self, key, value, results):
+        try:
+            results.append(self.flight.do(key, self._slow, value))
+        except Exception as e:
+            results.append(e)
+
+    def _concurrently(self, key, values):
+        results = []
+        threads = [threading.Thread(target=self._run,
+                                    args=(key, v, results)) for v in values]
+        for t in threads:
+            t.start()
+        for _ in range(5000):
+            if self.flight.stats()["shared"] >= len(values) - 1:
+                break
+            time.sleep(0.001)
+        self.release.set()
+        for t in threads:
+            t.join()
+        return results
+
+    def test_concurrent_callers_share_one_call(self):
+        results = self._concurrently("port", ["first", "second", "third"])
+
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(results, [self.calls[0]] * 3)
+        self.assertEqual(self.flight.stats(),
+                         {"in_flight": 0, "calls": 1, "shared": 2})
+
+    def test_error_shared(self):
+        error = IOError("neutron went away")
+        results = self._concurrently("port", [error, error])
+
+        self.assertEqual(results, [error, error])
+        self.assertEqual(len(self.calls), 1)
+
+    def test_joined_call_waits_until_deadline(self):
+        def slow(deadline=None):
+            return self._slow("first")
+        leader = threading.Thread(target=self.flight.do,
+                                  args=("port", slow))
+        leader.start()
+        for _ in range(5000):
+            if self.calls:
+                break
+            time.sleep(0.001)
+        start = time.time()
+        status, resp = self.flight.do("port", slow,
+                                      deadline=time.time() + 0.05)
+        waited = time.time() - start
+        self.release.set()
+        leader.join()
+
+        self.assertIsNone(status)
+        self.assertIsInstance(resp, breaker.DeadlineExceededError)
+        self.assertTrue(waited < 1)
+        self.assertEqual(self.calls, ["first"])
+
+    def test_sequential_calls_not_cached(self):
+        self.release.set()
+        self.flight.do("port", self._slow, 1)
+        self.assertEqual(self.flight.do("port", self._slow, 2), 2)
+        self.assertEqual(self.flight.do("other", self._slow, 3), 3)
+        self.assertEqual(self.calls, [1, 2, 3])
+
+    def test_concurrent_deletes_share_lookup(self):
+        conf = {"enabled": "true", "nova_url": "https://nova",
+                "neutron_url": "https://neutron", "port_cache_size": "0",
+                "resources": "DELETE /v2/ports/{port_id}"}
+        filter = nova_interaction.filter_factory(conf)(None)
+        port = {"port": {"instance_id": "i", "tenant_id": "t"}}
+
+        def ports(port_id=None, deadline=None):
+            self.calls.append(port_id)
+            self.release.wait(5)
+            return 200, port
+
+        results = []
+
+        def lookup():
+            req = webob.Request.blank("/v2/ports/p1", method="DELETE")
+            results.append(filter._lookup_port(req, "p1"))
+
+        with mock.patch.object(filter.neutron_conn, "ports", ports):
+            threads = [threading.Thread(target=lookup) for _ in range(3)]
+            for t in threads:
+                t.start()
+            for _ in range(5000):
+                if filter.lookup_stats()["shared"] >= 2:
+                    break
+                time.sleep(0.001)
+            self.release.set()
+            for t in threads:
+                t.join()
+
+        self.assertEqual(self.calls, ["p1"])
+        self.assertEqual(results, [(200, port)] * 3)
+
+
+class TestAdaptiveLimiter(test_base.TestBase):
+    def setUp(self):
+        super(TestAdaptiveLimiter, self).setUp()
+        self.log = mock.MagicMock()
+
+    def test_sheds_over_limit(self):
+        lim = limiter.AdaptiveLimiter(self.log, initial=2)
+        lim.acquire()
+        lim.acquire()
+
+        self.assertRaises(limiter.LimitExceededError, lim.acquire)
+        self.assertEqual(lim.stats()["rejected"], 1)
+        self.assertEqual(lim.stats()["in_flight"], 2)
+
+    def test_waits_for_a_slot(self):
+        lim = limiter.AdaptiveLimiter(self.log, initial=1, max_wait=5)
+        lim.acquire()
+        timer = threading.Timer(0.05, lim.release)
+        timer.start()
+        lim.acquire()
+        timer.join()
+
+        self.assertEqual(lim.stats()["queued"], 1)
+        self.assertEqual(lim.stats()["rejected"], 0)
+
+    def test_wait_bounded_by_deadline(self):
+        lim = limiter.AdaptiveLimiter(self.log, initial=1, max_wait=60)
+        lim.acquire()
+
+        self.assertRaises(limiter.LimitExceededError, lim.acquire,
+                          deadline=time.time() + 0.01)
+
+    def test_grows_while_fast_and_busy(self):
+        lim = limiter.AdaptiveLimiter(self.log, initial=2, maximum=4)
+        for _ in range(20):
+            lim.acquire()
+            lim.acquire()
+            lim.release(0.01)
+            lim.release(0.01)
+
+        self.assertEqual(lim.stats()["limit"], 4)
+
+    def test_backs_off_on_slow_or_failed_calls(self):
+        lim = limiter.AdaptiveLimiter(self.log, initial=10, backoff=0.5)
+        lim.acquire()
+        lim.release(0.01)
+        lim.acquire()
+        lim.release(0.1)
+        self.assertEqual(lim.stats()["limit"], 5)
+        lim.acquire()
+        lim.release(0.01, success=False)
+
+        self.assertEqual(lim.stats()["limit"], 2)
+        self.assertEqual(lim.stats()["decreases"], 2)
+
+    def test_cancelled_call_does_not_adjust(self):
+        lim = limiter.AdaptiveLimiter(self.log, initial=3)
+        lim.acquire()
+        lim.release()
+
+        self.assertEqual(lim.stats()["limit"], 3)
+        self.assertIsNone(lim.stats()["min_rtt"])
+
+    def test_connection_sheds_calls(self):
+        self.addCleanup(common._pools.clear)
+        lim = limiter.AdaptiveLimiter(self.log, initial=1)
+        conn = common.NovaConnection(log=self.log, url="http://nova",
+                                     pool_name="limiter", limiter=lim)
+        lim.acquire()
+        with mock.patch.object(conn.pool.session, "request") as request:
+            status, resp = conn.put("http://nova/thing", {})
+
+        self.assertIsNone(status)
+        self.assertIsInstance(resp, limiter.LimitExceededError)
+        self.assertFalse(request.called)
+
+    def test_open_circuit_frees_slot(self):
+        self.addCleanup(common._pools.clear)
+        lim = limiter.AdaptiveLimiter(self.log, initial=1)
+        breakers = breaker.BreakerRegistry(self.log, failures=1)
+        breakers.for_url("http://nova").after_call(False, 0.1)
+        conn = common.NovaConnection(log=self.log, url="http://nova",
+                                     pool_name="limiter", limiter=lim,
+                                     breakers=breakers)
+        status, resp = conn.put("http://nova/thing", {})
+
+        self.assertIsInstance(resp, breaker.CircuitOpenError)
+        self.assertEqual(lim.stats()["in_flight"], 0)
+
+    def test_configured_from_filter(self):
+        conf = {"enabled": "true", "nova_url": "https://nova",
+                "nova_concurrency_limit": "5", "resources": "POST /v2/ports"}
+        filter = nova_interaction.filter_factory(conf)(None)
+
+        self.assertEqual(filter.limiter_stats()["limit"], 5)
+        self.assertIs(filter.nova_conn.limiter, filter.limiter)
+        conf.pop("nova_concurrency_limit")
+        self.assertIsNone(
+            nova_interaction.filter_factory(conf)(None).limiter_stats())
+
+
+class TestBalancer(test_base.TestBase):
+    def setUp(self):
+        super(TestBalancer, self).setUp()
+        self.log = mock.MagicMock()
+        self.breakers = breaker.BreakerRegistry(self.log, failures=1,
+                                                reset_timeout=10)
+        self.urls = ["http://nova1:8774", "http://nova2:8774"]
+
+    def test_least_outstanding(self):
+        lb = balancer.Balancer(self.urls)
+        first = lb.acquire()
+        second = lb.acquire()
+
+        self.assertNotEqual(first.url, second.url)
+        lb.release(first, True, 0.1)
+        self.assertIs(lb.acquire(), first)
+
+    def test_ewma_prefers_faster_endpoint(self):
+        lb = balancer.Balancer(self.urls, policy='ewma')
+        slow, fast = lb.endpoints
+        lb.release(lb.acquire(), True, 0)
+        slow.ewma, fast.ewma = 2.0, 0.1
+
+        picks = [lb.acquire() for _ in range(3)]
+
+        self.assertEqual(picks.count(fast), 3)
+        self.assertEqual(lb.stats()["endpoints"][fast.url]["outstanding"], 3)
+
+    def test_bad_policy(self):
+        self.assertRaises(ValueError, balancer.Balancer, self.urls,
+                          policy='random')
+
+    def test_open_circuit_ejects_and_readmits(self):
+        lb = balancer.Balancer(self.urls, breakers=self.breakers)
+        with mock.patch("time.time", return_value=100):
+            sick = self.breakers.for_url(self.urls[0])
+            sick.before_call()
+            sick.after_call(False, 0.1)
+            picks = set(lb.acquire().url for _ in range(4))
+            self.assertEqual(picks, set([self.urls[1]]))
+            self.assertFalse(lb.stats()["endpoints"][self.urls[0]]["healthy"])
+        with mock.patch("time.time", return_value=111):
+            picks = set(lb.acquire().url for _ in range(4))
+        self.assertIn(self.urls[0], picks)
+
+    def test_all_ejected_uses_everything(self):
+        lb = balancer.Balancer(self.urls, breakers=self.breakers)
+        for url in self.urls:
+            self.breakers.for_url(url).after_call(False, 0.1)
+
+        self.assertIn(lb.acquire().url, self.urls)
+        self.assertEqual(lb.stats()["all_ejected"], 1)
+
+    def test_call_records_failures(self):
+        lb = balancer.Balancer(self.urls[:1])
+        result = lb.call(lambda url: (503, url))
+
+        self.assertEqual(result, (503, self.urls[0]))
+        endpoint = lb.stats()["endpoints"][self.urls[0]]
+        self.assertEqual(endpoint["failures"], 1)
+        self.assertEqual(endpoint["outstanding"], 0)
+
+    def test_half_open_without_probe_slot_ejected(self):
+        lb = balancer.Balancer(self.urls, policy='ewma',
+                               breakers=self.breakers)
+        sick_url, well_url = self.urls
+        sick = self.breakers.for_url(sick_url)
+        with mock.patch("time.time", return_value=100):
+            sick.after_call(False, 0.1)
+        with mock.patch("time.time", return_value=111):
+            sick.before_call()
+            self.assertEqual(sick.stats()["state"], breaker.HALF_OPEN)
+
+            def call(url):
+                if url == sick_url:
+                    try:
+                        self.breakers.for_url(url).before_call()
+                    except breaker.CircuitOpenError as e:
+                        return None, e
+                return 200, url
+            results = [lb.call(call) for _ in range(20)]
+
+        self.assertEqual(results, [(200, well_url)] * 20)
+        stats = lb.stats()["endpoints"]
+        self.assertFalse(stats[sick_url]["healthy"])
+        self.assertEqual(stats[sick_url]["calls"], 0)
+        self.assertEqual(stats[sick_url]["ewma"], 0.0)
+
+    def test_refused_call_retried_elsewhere(self):
+        lb = balancer.Balancer(self.urls, policy='ewma')
+        sick_url, well_url = self.urls
+
+        def call(url):
+            if url == sick_url:
+                return None, breaker.CircuitOpenError(url, 10)
+            return 200, url
+        results = [lb.call(call) for _ in range(4)]
+
+        self.assertEqual(results, [(200, well_url)] * 4)
+        sick = lb.stats()["endpoints"][sick_url]
+        self.assertEqual((sick["outstanding"], sick["calls"], sick["ewma"],
+                          sick["failures"]), (0, 0, 0.0, 0))
+
+    def test_every_endpoint_refusing(self):
+        lb = balancer.Balancer(self.urls)
+        calls = []
+
+        def call(url):
+            calls.append(url)
+            return None, breaker.CircuitOpenError(url, 10)
+        status, resp = lb.call(call)
+
+        self.assertIsNone(status)
+        self.assertIsInstance(resp, breaker.CircuitOpenError)
+        self.assertEqual(sorted(calls), self.urls)
+
+    def test_callbacks_spread_over_nova_urls(self):
+        conf = {"enabled": "true",
+                "nova_url": "https://nova1, https://nova2",
+                "nova_port": 8774,
+                "resources": "POST /v2/ports"}
+        filter = nova_interaction.filter_factory(conf)(None)
+        self.addCleanup(common._pools.clear)
+        with mock.patch.object(filter.nova_conn, "put",
+                               return_value=(200, {})) as put:
+            for _ in range(4):
+                filter._send_callback(tenant_id="t", instance_id="i",
+                                      port_id="p")
+
+        hosts = sorted(c[0][0].split("/v2/")[0] for c in put.call_args_list)
+        self.assertEqual(hosts, ["https://nova1:8774"] * 2 +
+                         ["https://nova2:8774"] * 2)
+        self.assertEqual(filter.balancer_stats()["policy"],
+                         "least_outstanding")
+
+
+class TestFakeCloud(test_base.TestBase):
+    def setUp(self):
+        super(TestFakeCloud, self).setUp()
+        self.addCleanup(common._pools.clear)
+        self.cloud = fake.FakeCloud(seed=1)
+        self.server = fake.FakeServer(self.cloud).start()
+        self.addCleanup(self.server.stop)
+        conf = {"enabled": "true",
+                "nova_url": self.server.url,
+                "neutron_url": self.server.url,
+                "port_cache_size": "0",
+                "resources": "POST /v2.0/ports,"
+                             "PUT DELETE /v2.0/ports/{port_id}"}
+        self.filter = nova_interaction.filter_factory(conf)(
+            self.cloud.neutron_app)
+
+    def _request(self, method, path, body=None):
+        req = webob.Request.blank(path, method=method)
+        if body is not None:
+            req.body = json.dumps(body)
+        return req.get_response(self.filter)
+
+    def test_port_lifecycle_through_middleware(self):
+        resp = self._request("POST", "/v2.0/ports",
+                             {"port": {"instance_id": "i", "tenant_id": "t",
+                                       "network_id": "n"}})
+        self.assertEqual(resp.status_code, 201)
+        self.assertEqual(resp.json["nova_callback"]["status"], "success")
+        port_id = resp.json["port"]["id"]
+
+        resp = self._request("DELETE", "/v2.0/ports/%s" % port_id)
+
+        self.assertEqual(resp.status_code, 204)
+        self.assertEqual(resp.json["neutron_callback"]["status"], "success")
+        self.assertEqual(self.cloud.vifs[port_id]["action"], "delete")
+        stats = self.cloud.stats()
+        self.assertEqual(stats["vif_calls"], 2)
+        self.assertEqual(stats["port_lookups"], 1)
+        self.assertEqual(stats["connections"], 1)
+        self.assertEqual(stats["ports"], 0)
+
+    def test_injected_errors(self):
+        self.cloud.error_rate = 1
+        port = self.cloud.add_port(instance_id="i", tenant_id="t")
+        resp = self._request("DELETE", "/v2.0/ports/%s" % port["id"])
+
+        self.assertEqual(resp.status_code, 500)
+        self.assertEqual(resp.json["neutron_callback"]["status"], "error")
+        self.assertEqual(self.cloud.stats()["errors"], 1)
+
+    def test_latency_and_jitter(self):
+        cloud = fake.FakeCloud(latency=0.02, jitter=0.02, seed=1)
+        port = cloud.add_port()
+        start = time.time()
+        status, body = cloud.handle("GET", "/v2.0/ports/%s/" % port["id"])
+        elapsed = time.time() - start
+
+        self.assertEqual(status, 200)
+        self.assertEqual(body["port"]["id"], port["id"])
+        self.assertTrue(0.02 <= elapsed < 0.5)
+        self.assertEqual(cloud.handle("GET", "/v2.0/ports/nope")[0], 404)
+
+
+@unittest2.skipIf(eventlet is None, "eventlet is not installed")
+class TestGreenSessionPool(test_base.TestBase):
+    def setUp(self):
+        super(TestGreenSessionPool, self).setUp()
+        self.addCleanup(common._pools.clear)
+        self.log = mock.MagicMock()
+        sock = eventlet.listen(('127.0.0.1', 0))
+        self.url = "http://127.0.0.1:%d" % sock.getsockname()[1]
+        server = eventlet.spawn(eventlet.wsgi.server, sock, self._nova,
+                                log=open(os.devnull, "w"))
+        eventlet.sleep(0)
+        self.addCleanup(server.kill)
+
+    def _nova(self, environ, start_response):
+        eventlet.sleep(0.05)
+        body = json.dumps({"path": environ["PATH_INFO"],
+                           "body": environ["wsgi.input"].read()})
+        start_response("200 OK", [("Content-Type", "application/json"),
+                                  ("Content-Length", str(len(body)))])
+        return [body]
+
+    def _conn(self):
+        return common.NovaConnection(log=self.log, url=self.url,
+                                     pool_name="green", backend="eventlet",
+                                     read_timeout=5)
+
+    def test_keep_alive_reused(self):
+        conn = self._conn()
+        for _ in range(3):
+            status, resp = conn.put(self.url + "/thing", {"a": 1})
+        stats = common.pool_stats("green")
+
+        self.assertEqual(status, 200)
+        self.assertEqual(resp, {"path": "/thing", "body": '{"a": 1}'})
+        self.assertEqual(stats["backend"], "eventlet")
+        self.assertEqual(stats["hosts"][self.url]["connections_opened"], 1)
+        self.assertEqual(stats["hosts"][self.url]["requests"], 3)
+
+    def test_calls_in_flight_concurrently(self):
+        conn = self._conn()
+        pool = eventlet.GreenPool(20)
+        start = time.time()
+        results = list(pool.imap(lambda i: conn.get(self.url + "/%d" % i),
+                                 range(20)))
+        elapsed = time.time() - start
+
+        self.assertEqual([r[0] for r in results], [200] * 20)
+        self.assertEqual(common.pool_stats("green")["peak_in_flight"], 20)
+        self.assertTrue(elapsed < 0.5)
+
+    def test_idle_connection_closed_by_server_retried(self):
+        def answer_once(client):
+            # Answers one keep-alive call, then drops the connection
+            request = b""
+            while b"\r\n\r\n" not in request:
+                request += client.recv(4096)
+            head, _, body = request.partition(b"\r\n\r\n")
+            length = [int(line.split(b":")[1]) for line in head.split(b"\r\n")
+                      if line.lower().startswith(b"content-length")]
+            while length and len(body) < length[0]:
+                body += client.recv(4096)
+            client.sendall(b"HTTP/1.1 200 OK\r\nContent-Type: "
+                           b"application/json\r\nContent-Length: 2\r\n"
+                           b"\r\n{}")
+            eventlet.sleep(0.01)
+            client.close()
+
+        def serve(sock):
+            while True:
+                client, _ = sock.accept()
+                eventlet.spawn(answer_once, client)
+
+        sock = eventlet.listen(('127.0.0.1', 0))
+        url = "http://127.0.0.1:%d" % sock.getsockname()[1]
+        self.addCleanup(eventlet.spawn(serve, sock).kill)
+        conn = common.NovaConnection(log=self.log, url=url,
+                                     pool_name="green", backend="eventlet",
+                                     read_timeout=5)
+        first = conn.put(url + "/thing", {"a": 1})
+        eventlet.sleep(0.05)
+        second = conn.put(url + "/thing", {"a": 2})
+        stats = common.pool_stats("green")
+
+        self.assertEqual((first, second), ((200, {}), (200, {})))
+        self.assertEqual((stats["errors"], stats["retries"]), (0, 1))
+        self.assertEqual(stats["hosts"][url]["connections_opened"], 2)
+
+    def test_connection_error(self):
+        conn = common.NovaConnection(log=self.log, url="http://127.0.0.1:1",
+                                     pool_name="green", backend="eventlet",
+                                     connect_timeout=1)
+        status, resp = conn.get("http://127.0.0.1:1/thing")
+
+        self.assertIsNone(status)
+        self.assertIsInstance(resp, Exception)
+        self.assertEqual(common.pool_stats("green")["errors"], 1)
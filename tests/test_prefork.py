@@ -0,0 +1,88 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+import mock
+
+from tests import test_base
+from wafflehaus.neutron.composite import composite
+from wafflehaus.neutron import prefork
+from wafflehaus.neutron.shared_network import trusted
+
+
+class TestWarmUp(test_base.TestBase):
+    def setUp(self):
+        super(TestWarmUp, self).setUp()
+        patcher = mock.patch.object(prefork, "gc")
+        self.gc = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(prefork, "_frozen_pid", None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _filter(self, **conf):
+        return mock.Mock(conf=conf, enabled=conf.get("enabled", True),
+                         truths=(True, "true"))
+
+    def test_enabled_filter_warmed_and_frozen(self):
+        filter = self._filter()
+
+        self.assertIs(prefork.warm_up(filter), filter)
+        self.assertTrue(filter.warm_up.called)
+        self.assertTrue(self.gc.collect.called)
+        self.assertTrue(self.gc.freeze.called)
+
+    def test_disabled_filter_not_warmed(self):
+        filter = self._filter(enabled=False)
+        prefork.warm_up(filter)
+
+        self.assertFalse(filter.warm_up.called)
+        self.assertFalse(self.gc.freeze.called)
+
+    def test_frozen_once_per_process(self):
+        first, second = self._filter(), self._filter()
+        prefork.warm_up(first)
+        prefork.warm_up(second)
+
+        self.assertTrue(second.warm_up.called)
+        self.assertEqual(self.gc.freeze.call_count, 1)
+        with mock.patch("os.getpid", return_value=-1):
+            prefork.warm_up(self._filter())
+        self.assertEqual(self.gc.freeze.call_count, 2)
+
+    def test_hosted_filters_frozen_once(self):
+        conf = {"enabled": "true", "trusted": "a b",
+                "filters": "shared_network last_ip_check"}
+        filter = composite.filter_factory(conf)(mock.Mock())
+
+        self.assertEqual(len(filter.filters), 2)
+        self.assertEqual(self.gc.collect.call_count, 1)
+        self.assertEqual(self.gc.freeze.call_count, 1)
+
+    def test_freeze_off(self):
+        prefork.warm_up(self._filter(gc_freeze="false"))
+
+        self.assertFalse(self.gc.freeze.called)
+
+    def test_freeze_unsupported(self):
+        del self.gc.freeze
+        prefork.warm_up(self._filter())
+
+        self.assertFalse(self.gc.collect.called)
+
+    def test_factory_warms_up(self):
+        filter = trusted.filter_factory({"enabled": "true",
+                                         "trusted": "a b"})(mock.Mock())
+
+        self.assertTrue(self.gc.freeze.called)
+        self.assertEqual(filter.trusted_nets, frozenset(["a", "b"]))
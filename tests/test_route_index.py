@@ -0,0 +1,160 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+import mock
+import routes
+import webob
+import webob.dec
+
+from tests import test_base
+from wafflehaus.neutron import route_index
+from wafflehaus.neutron.shared_network import trusted
+
+
+class TestRouteIndex(test_base.TestBase):
+    def test_match(self):
+        index = route_index.RouteIndex()
+        index.add_resources({"/v2.0/ports/{id}": ["PUT", "DELETE"]}, 1)
+        index.add_resources({"/v2.0/ports/{port_id}": ["PUT"]}, 2)
+        index.add(None, ["PUT"], 0)
+        index.add(None, None, 3)
+
+        self.assertEqual(sorted(index.match("put", "/v2.0/ports/p")),
+                         [0, 1, 2, 3])
+        self.assertEqual(sorted(index.match("DELETE", "/v2.0/ports/p")),
+                         [1, 3])
+        self.assertEqual(index.match("GET", "/v2.0/networks"), set([3]))
+
+    def test_same_as_routes(self):
+        templates = ["/v2.0/subnets", "/v2.0/networks{.format}",
+                     "/v2.0/ports/{id}", "/v2.0/ports/{id}{.format}",
+                     "/v2.0/ports/:id/tags", "v2.0/ports", "/v2.0/ports/",
+                     "/v2.0/ip_addresses/{id:[0-9]+}",
+                     "/v2.0/ip_addresses/{id:[0-9]+}/ports/{port_id}",
+                     "/v2.0/files/*path"]
+        paths = ["/v2.0/subnets", "/v2.0/subnets/", "/v2.0/Subnets",
+                 "/v2.0/networks", "/v2.0/networks.json",
+                 "/v2.0/networks.a.b", "/v2.0/networks.", "/v2.0/ports",
+                 "/v2.0/ports/", "/v2.0/ports/a", "/v2.0/ports/a.b.json",
+                 "/v2.0/ports/a/tags", "/v2.0/ports/a/b", "/v2.0//ports",
+                 "/v2.0/ip_addresses/12", "/v2.0/ip_addresses/ab",
+                 "/v2.0/ip_addresses/12/ports/p", "/v2.0/files/a/b"]
+        for template in templates:
+            index = route_index.RouteIndex()
+            index.add(template, ["GET"], template)
+            mapper = routes.Mapper()
+            mapper.connect(None, template)
+            for path in paths:
+                expected = mapper.routematch(path) is not None
+                self.assertEqual(template in index.match("GET", path),
+                                 expected, (template, path))
+
+
+class TestSharedIndex(test_base.TestBase):
+    def test_matches_kept_in_environ(self):
+        key = route_index.register({"/v2.0/things/{id}": ["GET"]})
+        other = route_index.register(None, ["PUT"])
+        req = webob.Request.blank("/v2.0/things/t")
+
+        self.assertTrue(route_index.matched(req, key))
+        self.assertFalse(route_index.matched(req, other))
+        keys = req.environ[route_index.MATCH_KEY][2]
+        with mock.patch.object(route_index._shared, "match") as match:
+            self.assertTrue(route_index.matched(req, key))
+            self.assertFalse(match.called)
+
+            req.method = "PUT"
+            route_index.matches(req)
+            self.assertTrue(match.called)
+        self.assertIn(key, keys)
+
+
+class TestPathFilter(test_base.TestBase):
+    def _environ(self, method, path, script_name=""):
+        return {"REQUEST_METHOD": method, "PATH_INFO": path,
+                "SCRIPT_NAME": script_name}
+
+    def test_static_prefix(self):
+        self.assertEqual(route_index.static_prefix("/v2.0/ports/{id}"),
+                         "/v2.0/ports/")
+        self.assertEqual(route_index.static_prefix("/v2.0/ports"),
+                         "/v2.0/ports")
+        self.assertEqual(route_index.static_prefix("/a/:id"), "/a/")
+
+    def test_resources(self):
+        paths = route_index.PathFilter({"/v2.0/ports/{id}": ["PUT"],
+                                        "/v2.0/networks{.format}": ["GET"]})
+
+        self.assertTrue(paths(self._environ("PUT", "/v2.0/ports/p")))
+        self.assertTrue(paths(self._environ("PUT", "/ports/p", "/v2.0")))
+        self.assertFalse(paths(self._environ("GET", "/v2.0/ports/p")))
+        self.assertFalse(paths(self._environ("PUT", "/v2.0/subnets/s")))
+
+    def test_methods_only(self):
+        paths = route_index.PathFilter(None, ("PUT",))
+
+        self.assertTrue(paths(self._environ("PUT", "/anything")))
+        self.assertFalse(paths(self._environ("GET", "/anything")))
+        self.assertFalse(route_index.PathFilter({})(
+            self._environ("GET", "/")))
+
+
+class TestFastPath(test_base.TestBase):
+    def setUp(self):
+        super(TestFastPath, self).setUp()
+        self.environs = []
+
+        @webob.dec.wsgify
+        def neutron_app(req):
+            self.environs.append(req.environ)
+            return webob.Response(body=b'{"networks": []}',
+                                  content_type="application/json")
+        self.filter = trusted.filter_factory({"enabled": "true"})(
+            neutron_app)
+        patcher = mock.patch("wafflehaus.neutron.route_index.matched")
+        self.matched = patcher.start()
+        self.matched.return_value = True
+        self.addCleanup(patcher.stop)
+
+    def test_unmatched_skips_filter(self):
+        req = webob.Request.blank("/v2.0/ports")
+        req.get_response(self.filter)
+
+        self.assertFalse(self.matched.called)
+        self.assertIs(self.environs[0], req.environ)
+
+    def test_disabled_skips_filter(self):
+        self.filter.enabled = False
+        webob.Request.blank("/v2.0/networks").get_response(self.filter)
+
+        self.assertFalse(self.matched.called)
+
+    def test_possible_match_takes_full_path(self):
+        webob.Request.blank("/v2.0/networks").get_response(self.filter)
+
+        self.assertTrue(self.matched.called)
+
+    def test_reconfigurable_takes_full_path(self):
+        self.filter.reconfigure = True
+        with mock.patch.object(self.filter, "_override"):
+            webob.Request.blank("/v2.0/ports").get_response(self.filter)
+
+        self.assertTrue(self.matched.called)
+
+    def test_request_call_takes_full_path(self):
+        self.matched.return_value = False
+        result = self.filter(webob.Request.blank("/v2.0/ports"))
+
+        self.assertIs(result, self.filter.app)
+        self.assertTrue(self.matched.called)
@@ -0,0 +1,228 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+import os
+import shutil
+import tempfile
+
+import mock
+
+from tests import test_base
+from wafflehaus.neutron import nova_interaction
+from wafflehaus.neutron.nova_interaction import cache
+from wafflehaus.neutron import shm
+
+
+class TestSharedTable(test_base.TestBase):
+    def setUp(self):
+        super(TestSharedTable, self).setUp()
+        self.table = shm.SharedTable(slots=64, slot_size=64, ways=4,
+                                     stripes=4)
+        self.addCleanup(self.table.close)
+
+    def test_set_get_delete(self):
+        self.assertIsNone(self.table.get(b"key"))
+        self.assertTrue(self.table.set(b"key", b"value", 10))
+        self.assertTrue(self.table.set(b"other", b"thing", 10))
+        self.assertTrue(self.table.set(b"key", b"new", 10))
+
+        self.assertEqual(self.table.get(b"key"), b"new")
+        self.assertEqual(self.table.get(b"other"), b"thing")
+        self.assertEqual(len(self.table), 2)
+        self.table.delete(b"key")
+        self.assertIsNone(self.table.get(b"key"))
+        self.assertEqual(len(self.table), 1)
+
+    def test_entries_expire(self):
+        with mock.patch("time.time", return_value=100):
+            self.table.set(b"key", b"value", 10)
+        with mock.patch("time.time", return_value=111):
+            self.assertIsNone(self.table.get(b"key"))
+
+        self.assertEqual(self.table.stats()["expired"], 1)
+
+    def test_oversize_not_stored(self):
+        self.assertFalse(self.table.set(b"key", b"x" * 64, 10))
+
+        self.assertIsNone(self.table.get(b"key"))
+        self.assertEqual(self.table.stats()["oversize"], 1)
+
+    def test_full_bucket_evicts_closest_to_expiry(self):
+        table = shm.SharedTable(slots=2, slot_size=64, ways=2, stripes=1)
+        self.addCleanup(table.close)
+        table.set(b"first", b"1", 20)
+        table.set(b"second", b"2", 10)
+        table.set(b"third", b"3", 30)
+
+        self.assertEqual(table.get(b"first"), b"1")
+        self.assertIsNone(table.get(b"second"))
+        self.assertEqual(table.get(b"third"), b"3")
+        self.assertEqual(table.stats()["evictions"], 1)
+
+    def test_torn_slot_not_read(self):
+        self.table.set(b"key", b"value", 10)
+        _, offset = self.table._bucket(shm._hash(b"key"))
+        data = offset + shm._SLOT.size
+        self.table.map[data:data + 3] = b"xyz"
+
+        self.assertIsNone(self.table.get(b"key"))
+        self.assertEqual(self.table.stats()["retries"], shm._READ_ATTEMPTS)
+
+    def _crash_writer(self, key):
+        """Leaves key's slot as a writer killed mid-write would."""
+        _, offset = self.table._bucket(shm._hash(key))
+        version = shm._VERSION.unpack_from(self.table.map, offset)[0]
+        shm._VERSION.pack_into(self.table.map, offset, version + 1)
+
+    def test_slot_of_killed_writer_recovers(self):
+        self.table.set(b"key", b"value", 10)
+        self._crash_writer(b"key")
+
+        self.assertIsNone(self.table.get(b"key"))
+        self.assertTrue(self.table.set(b"key", b"new", 10))
+        self.assertEqual(self.table.get(b"key"), b"new")
+        self._crash_writer(b"key")
+        self.table.set(b"key", b"newer", 10)
+        self.assertEqual(self.table.get(b"key"), b"newer")
+
+    def test_update_reads_slot_of_killed_writer(self):
+        self.table.set(b"count", b"1", 10)
+        self._crash_writer(b"count")
+        seen = []
+
+        def increment(value):
+            seen.append(value)
+            return str(int(value or 0) + 1).encode("ascii")
+
+        self.assertEqual(self.table.update(b"count", increment, 10), b"2")
+        self.assertEqual(seen, [b"1"])
+        self.assertEqual(self.table.get(b"count"), b"2")
+
+    def test_update(self):
+        def increment(value):
+            return str(int(value or 0) + 1).encode("ascii")
+
+        self.assertEqual(self.table.update(b"count", increment, 10), b"1")
+        self.assertEqual(self.table.update(b"count", increment, 10), b"2")
+        self.assertEqual(self.table.get(b"count"), b"2")
+
+    def test_shared_with_forked_workers(self):
+        pids = []
+        for worker in range(4):
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    for _ in range(50):
+                        self.table.update(
+                            b"count",
+                            lambda v: str(int(v or 0) + 1).encode("ascii"),
+                            10)
+                    self.table.set(("w%d" % worker).encode("ascii"), b"up",
+                                   10)
+                finally:
+                    os._exit(0)
+            pids.append(pid)
+        for pid in pids:
+            os.waitpid(pid, 0)
+
+        self.assertEqual(self.table.get(b"count"), b"200")
+        for worker in range(4):
+            self.assertEqual(
+                self.table.get(("w%d" % worker).encode("ascii")), b"up")
+
+    def test_path_reopened(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        path = os.path.join(tmp, "table")
+        table = shm.SharedTable(path, slots=16, slot_size=64)
+        table.set(b"key", b"value", 10)
+        table.close()
+
+        table = shm.SharedTable(path, slots=16, slot_size=64)
+        self.assertEqual(table.get(b"key"), b"value")
+        table.close()
+        self.assertRaises(ValueError, shm.SharedTable, path, slots=32,
+                          slot_size=64)
+        table = shm.SharedTable(path, slots=16, slot_size=64)
+        self.assertEqual(table.get(b"key"), b"value")
+        table.close()
+
+    def test_other_files_not_overwritten(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        path = os.path.join(tmp, "table")
+        with open(path, "wb") as f:
+            f.write(b"not a table")
+
+        self.assertRaises(ValueError, shm.SharedTable, path, slots=16,
+                          slot_size=64)
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), b"not a table")
+        open(path, "wb").close()
+        table = shm.SharedTable(path, slots=16, slot_size=64)
+        table.set(b"key", b"value", 10)
+        self.assertEqual(table.get(b"key"), b"value")
+        table.close()
+
+
+class TestSharedPortCache(test_base.TestBase):
+    def setUp(self):
+        super(TestSharedPortCache, self).setUp()
+        self.port = {'mac_address': "AA:BB:CC:DD:EE",
+                     'fixed_ips': [{"subnet_id": "a",
+                                    "ip_address": "10.0.0.1"}],
+                     'instance_id': "id_instance",
+                     'network_id': "id_network",
+                     'tenant_id': "id_tenant",
+                     'name': "ignored"}
+
+    def test_set_get_pop(self):
+        port_cache = cache.SharedPortCache(size=16)
+        port_cache.set("port", self.port)
+
+        self.assertEqual(port_cache.get("port"),
+                         dict((k, self.port[k]) for k in cache.VIF_FIELDS))
+        port_cache.pop("port")
+        self.assertIsNone(port_cache.get("port"))
+        stats = port_cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["size"]),
+                         (1, 1, 0))
+
+    def test_seen_by_forked_worker(self):
+        port_cache = cache.SharedPortCache(size=16)
+        pid = os.fork()
+        if pid == 0:
+            try:
+                port_cache.set("port", self.port)
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+
+        self.assertEqual(port_cache.get("port")["instance_id"],
+                         "id_instance")
+
+    def test_large_port_not_cached(self):
+        port_cache = cache.SharedPortCache(size=16, slot_size=128)
+        port_cache.set("port", self.port)
+
+        self.assertIsNone(port_cache.get("port"))
+        self.assertEqual(port_cache.stats()["oversize"], 1)
+
+    def test_filter_backend(self):
+        test_filter = nova_interaction.filter_factory(
+            {"enabled": "true", "nova_url": "https://nova",
+             "neutron_url": "https://neutron",
+             "port_cache_backend": "shared"})(mock.Mock())
+
+        self.assertIsInstance(test_filter.port_cache, cache.SharedPortCache)
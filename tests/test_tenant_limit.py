@@ -0,0 +1,154 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+import os
+
+import mock
+import webob
+import webob.dec
+
+from tests import test_base
+from wafflehaus.neutron.admission import tenant_limit
+from wafflehaus.neutron.composite import composite
+from wafflehaus.neutron import shm
+
+
+class TestTenantLimit(test_base.TestBase):
+    def setUp(self):
+        super(TestTenantLimit, self).setUp()
+        self.calls = 0
+
+        @webob.dec.wsgify
+        def neutron_app(req):
+            self.calls += 1
+            return webob.Response(body=b"{}",
+                                  content_type="application/json")
+        self.neutron_app = neutron_app
+        self.conf = {"enabled": "true", "rate": "1", "burst": "3"}
+        self.now = 1000.0
+        patcher = mock.patch("time.time", side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _filter(self, **conf):
+        self.conf.update(conf)
+        return tenant_limit.filter_factory(self.conf)(self.neutron_app)
+
+    def _send(self, filter, tenant_id="tenant", method="POST",
+              path="/v2.0/ports"):
+        headers = {"X_TENANT_ID": tenant_id} if tenant_id else {}
+        return webob.Request.blank(path, method=method,
+                                   headers=headers).get_response(filter)
+
+    def test_burst_then_rejected(self):
+        filter = self._filter()
+        statuses = [self._send(filter).status_int for _ in range(4)]
+
+        self.assertEqual(statuses, [200, 200, 200, 429])
+        self.assertEqual(self.calls, 3)
+        self.assertEqual(filter.stats()["rejected"], 1)
+
+    def test_retry_after_and_refill(self):
+        filter = self._filter(rate="0.25", burst="1")
+        self._send(filter)
+        resp = self._send(filter)
+
+        self.assertEqual(resp.status_int, 429)
+        self.assertEqual(resp.headers["Retry-After"], "4")
+        self.now += 4
+        self.assertEqual(self._send(filter).status_int, 200)
+
+    def test_buckets_per_tenant_and_route(self):
+        filter = self._filter(burst="1")
+
+        self.assertEqual(self._send(filter, "a").status_int, 200)
+        self.assertEqual(self._send(filter, "b").status_int, 200)
+        self.assertEqual(self._send(filter, "a", "DELETE",
+                                    "/v2.0/ports/p").status_int, 200)
+        self.assertEqual(self._send(filter, "a", "PUT",
+                                    "/v2.0/ports/p").status_int, 200)
+        self.assertEqual(self._send(filter, "a").status_int, 429)
+
+    def test_limit_holds_after_killed_writer(self):
+        filter = self._filter()
+        statuses = [self._send(filter).status_int for _ in range(2)]
+        # Leave the bucket's slot as a worker killed mid-write would
+        key = b"tenant POST /v2.0/ports"
+        offset = filter.table._bucket(shm._hash(key))[1]
+        for way in range(filter.table.ways):
+            slot = offset + way * filter.table.slot_size
+            if filter.table._read(slot, key, shm._hash(key))[0]:
+                version = shm._VERSION.unpack_from(filter.table.map, slot)[0]
+                shm._VERSION.pack_into(filter.table.map, slot, version + 1)
+        statuses += [self._send(filter).status_int for _ in range(3)]
+
+        self.assertEqual(statuses, [200, 200, 200, 429, 429])
+
+    def test_unlimited_requests_pass(self):
+        filter = self._filter(burst="1")
+        for _ in range(3):
+            self.assertEqual(self._send(filter, tenant_id=None).status_int,
+                             200)
+            self.assertEqual(self._send(filter, method="GET",
+                                        path="/v2.0/ports/p").status_int,
+                             200)
+
+    def test_rates_override(self):
+        filter = self._filter(
+            rates="POST /v2.0/ports = 1 2, DELETE /v2.0/ports/{port_id} = 0,"
+                  "POST /v2.0/subnets = 1 1")
+        statuses = [self._send(filter).status_int for _ in range(3)]
+        statuses += [self._send(filter, method="DELETE",
+                                path="/v2.0/ports/p").status_int
+                     for _ in range(5)]
+        statuses += [self._send(filter, path="/v2.0/subnets").status_int
+                     for _ in range(2)]
+
+        self.assertEqual(statuses, [200, 200, 429] + [200] * 5 + [200, 429])
+
+    def test_bad_rates(self):
+        self.assertRaises(ValueError, tenant_limit.parse_rates,
+                          "POST /v2.0/ports")
+        self.assertRaises(ValueError, tenant_limit.parse_rates,
+                          "POST /v2.0/ports = 1 2 3")
+
+    def test_limit_shared_by_forked_workers(self):
+        filter = self._filter(burst="10")
+        read, write = os.pipe()
+        pids = []
+        for _ in range(3):
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    admitted = sum(self._send(filter).status_int == 200
+                                   for _ in range(10))
+                    os.write(write, ("%d\n" % admitted).encode("ascii"))
+                finally:
+                    os._exit(0)
+            pids.append(pid)
+        os.close(write)
+        with os.fdopen(read) as results:
+            admitted = sum(int(line) for line in results)
+        for pid in pids:
+            os.waitpid(pid, 0)
+
+        self.assertEqual(admitted, 10)
+
+    def test_hosted_in_composite(self):
+        filter = composite.filter_factory(
+            {"enabled": "true", "filters": "tenant_limit",
+             "tenant_limit.burst": "1"})(self.neutron_app)
+
+        self.assertEqual(self._send(filter).status_int, 200)
+        self.assertEqual(self._send(filter).status_int, 429)
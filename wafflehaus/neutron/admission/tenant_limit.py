@@ -0,0 +1,189 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+import json
+import math
+import struct
+import time
+
+import webob
+
+from wafflehaus.base import WafflehausBase
+from wafflehaus.neutron import log
+from wafflehaus.neutron import metrics
+from wafflehaus.neutron import prefork
+from wafflehaus.neutron import route_index
+from wafflehaus.neutron import shm
+import wafflehaus.resource_filter as rf
+
+
+DEFAULT_RESOURCES = 'POST /v2.0/ports, PUT DELETE /v2.0/ports/{port_id}'
+# Tokens left and when they were counted
+_BUCKET = struct.Struct('<dd')
+
+
+def parse_rates(value):
+    """Returns {(method, template): (rate, burst)} for a rates option.
+
+       value is a comma separated list of rf.parse_resources specs, each
+       followed by '=', a rate and optionally a burst.
+    """
+    rates = {}
+    for item in value.split(','):
+        spec, equals, numbers = item.rpartition('=')
+        if not equals:
+            if item.strip():
+                raise ValueError("Rate '%s' has no '='" % item.strip())
+            continue
+        numbers = [float(n) for n in numbers.split()]
+        if not 1 <= len(numbers) <= 2:
+            raise ValueError("Rate '%s' needs a rate and optionally a "
+                             "burst" % item.strip())
+        for template, methods in rf.parse_resources(spec).items():
+            for method in methods:
+                rates[(method.upper(), template)] = tuple(numbers)
+    return rates
+
+
+class TenantLimit(WafflehausBase):
+    """Admits a tenant's requests for resources at a limited rate.
+
+       Each tenant, by X_TENANT_ID, has a token bucket for each method
+       and template of resources, refilled at rate tokens a second up to
+       burst. A request takes a token or is answered 429 at once, with a
+       Retry-After of when the bucket will have one. The buckets are kept
+       in a shm.SharedTable built before neutron-server forks, so the
+       limits hold across its workers.
+    """
+
+    def __init__(self, app, conf):
+        super(TenantLimit, self).__init__(app, conf)
+        self.log.name = conf.get('log_name', __name__)
+        self.detail_log = log.FilterLog(self.log, conf)
+        self.resources = rf.parse_resources(conf.get('resources',
+                                                     DEFAULT_RESOURCES))
+        rate = float(conf.get('rate', 1))
+        burst = float(conf.get('burst', 10))
+        limits = dict(((method.upper(), template), (rate, burst))
+                      for template, methods in self.resources.items()
+                      for method in methods)
+        for route, numbers in parse_rates(conf.get('rates', '')).items():
+            limits[route] = (numbers[0], numbers[-1] if len(numbers) > 1
+                             else burst)
+            self.resources.setdefault(route[1], [])
+            if route[0] not in self.resources[route[1]]:
+                self.resources[route[1]].append(route[0])
+        self.limits = {}
+        for (method, template), (rate, burst) in sorted(limits.items()):
+            if rate <= 0:
+                continue
+            key = route_index.register({template: [method]})
+            self.limits[key] = ('%s %s' % (method, template), rate,
+                                max(burst, 1.0))
+        self.route_key = route_index.register(self.resources)
+        self.fast_path = route_index.PathFilter(self.resources)
+        self.table = shm.SharedTable(
+            conf.get('table_path'),
+            slots=int(conf.get('table_slots', 16384)),
+            slot_size=int(conf.get('table_slot_size', 256)),
+            stripes=int(conf.get('table_stripes', 64)))
+        self.body = json.dumps({"TooManyRequests": {
+            "message": "Too many requests for this resource, retry later",
+            "type": "TooManyRequests"}}).encode('utf-8')
+        self.admitted = 0
+        self.rejected = 0
+        metrics.instrument(self, conf)
+
+    def _limit(self, req):
+        """Returns the (route, rate, burst) limiting req, or None."""
+        keys = [k for k in route_index.matches(req) if k in self.limits]
+        return self.limits[min(keys)] if keys else None
+
+    def take(self, tenant_id, route, rate, burst):
+        """Takes a token of tenant_id's bucket for route.
+
+           Returns None if there was one, else the seconds until there
+           will be.
+        """
+        wait = []
+
+        def take_token(value):
+            # Read under the bucket's lock, so counted never goes back
+            now = time.time()
+            tokens = burst
+            if value is not None:
+                tokens, counted = _BUCKET.unpack(value)
+                tokens = min(burst, tokens + max(0.0, now - counted) * rate)
+            if tokens >= 1:
+                tokens -= 1
+                wait.append(None)
+            else:
+                wait.append((1 - tokens) / rate)
+            return _BUCKET.pack(tokens, now)
+        key = ('%s %s' % (tenant_id, route)).encode('utf-8')
+        # An absent bucket is a full one, so it need not outlive refilling
+        self.table.update(key, take_token, burst / rate + 1)
+        return wait[0]
+
+    def handle(self, req):
+        """Admits or turns away req, which matched self.resources."""
+        if self.testing:
+            return self.app
+        tenant_id = req.headers.get('X_TENANT_ID')
+        limit = self._limit(req)
+        if not tenant_id or limit is None:
+            return self.app
+        route, rate, burst = limit
+        try:
+            wait = self.take(tenant_id, route, rate, burst)
+        except ValueError:
+            self.log.error('Bucket of tenant_id %s for %s does not fit the '
+                           'shared table, admitting', tenant_id, route)
+            wait = None
+        if wait is None:
+            self.admitted += 1
+            return self.app
+        self.rejected += 1
+        self.detail_log.debug(req, 'handle - Rejected %s for tenant_id %s, '
+                              'retry after %.2f seconds', route, tenant_id,
+                              wait)
+        # Built plainly: an HTTPException renders a template per response
+        resp = webob.Response(status=429, body=self.body,
+                              content_type='application/json')
+        resp.headers['Retry-After'] = str(int(math.ceil(wait)))
+        return resp
+
+    def stats(self):
+        return {"admitted": self.admitted,
+                "rejected": self.rejected,
+                "table": self.table.stats()}
+
+    @route_index.wsgify
+    def __call__(self, req):
+        super(TenantLimit, self).__call__(req)
+        if not self.enabled:
+            return self.app
+        if self.testing or not route_index.matched(req, self.route_key):
+            return self.app
+        return self.handle(req)
+
+
+def filter_factory(global_conf, **local_conf):
+    """Returns a WSGI filter app for use with paste.deploy."""
+    conf = global_conf.copy()
+    conf.update(local_conf)
+
+    def tenant_limit(app):
+        return prefork.warm_up(TenantLimit(app, conf))
+    return tenant_limit
@@ -0,0 +1,157 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+import importlib
+
+import webob
+
+from wafflehaus.base import WafflehausBase
+from wafflehaus.neutron import prefork
+from wafflehaus.neutron import route_index
+
+
+FILTERS = {
+    'context': 'wafflehaus.try_context.context_filter',
+    'tenant_limit': 'wafflehaus.neutron.admission.tenant_limit',
+    'last_ip_check': 'wafflehaus.neutron.last_ip_check.last_ip_check',
+    'ip_policy': 'wafflehaus.neutron.ip_policy.create_default',
+    'shared_network': 'wafflehaus.neutron.shared_network.trusted',
+    'nova_interaction': 'wafflehaus.neutron.nova_interaction',
+}
+CHAIN_KEY = 'wafflehaus.neutron.composite_chain'
+REQUEST_KEY = 'wafflehaus.neutron.composite_request'
+
+
+class _Next(object):
+    """The app a hosted filter wraps: the hosted filters after it.
+
+       Its calls run the rest of the chain matched for the request, or
+       match again for a subrequest the filter made itself.
+    """
+
+    def __init__(self, composite, position):
+        self.composite = composite
+        self.position = position
+
+    def __call__(self, environ, start_response):
+        req = environ.get(REQUEST_KEY)
+        chain = environ.get(CHAIN_KEY)
+        if req is None or chain is None:
+            req = webob.Request(environ)
+            chain = self.composite.match(req)
+        chain = [p for p in chain if p > self.position]
+        return self.composite.run(req, chain)(environ, start_response)
+
+
+class CompositeFilter(WafflehausBase):
+    """Hosts several filters in one WSGI layer.
+
+       The filters named in filters, outermost first, are built with this
+       filter's conf, overridden for each by options prefixed with its
+       name and a dot. Each request is matched once against the resources
+       of all of them and only the matching filters see it, through one
+       webob Request.
+    """
+
+    def __init__(self, app, conf):
+        super(CompositeFilter, self).__init__(app, conf)
+        self.log.name = conf.get('log_name', __name__)
+        names = conf.get('filters', '').replace(',', ' ').split()
+        self.names = []
+        self.filters = []
+        self.route_keys = []
+        with prefork.hosting():
+            for position, name in enumerate(names):
+                hosted = self._build(name, _Next(self, position), conf)
+                self.names.append(name)
+                self.filters.append(hosted)
+                self.route_keys.append(self._route_key(hosted))
+
+    def _route_key(self, hosted):
+        key = getattr(hosted, 'route_key', None)
+        if key is not None:
+            return key
+        if hasattr(hosted, 'resources'):
+            return route_index.register(hosted.resources or {})
+        return route_index.register(None, getattr(hosted, 'methods', None))
+
+    def _build(self, name, app, conf):
+        module = importlib.import_module(FILTERS.get(name, name))
+        hosted_conf = dict((k, v) for k, v in conf.items()
+                           if k != 'filters')
+        hosted_conf['metrics_name'] = name
+        prefix = name + '.'
+        for key, value in conf.items():
+            if key.startswith(prefix):
+                hosted_conf[key[len(prefix):]] = value
+        return module.filter_factory(hosted_conf)(app)
+
+    def match(self, req):
+        """Returns the positions of the filters req is for, in order."""
+        keys = route_index.matches(req)
+        return [position for position, key in enumerate(self.route_keys)
+                if key in keys]
+
+    def fast_path(self, environ):
+        """Returns whether environ may be for one of the hosted filters."""
+        for hosted in self.filters:
+            fast_path = getattr(hosted, 'fast_path', None)
+            if fast_path is None or hosted.reconfigure:
+                return True
+            if hosted.enabled and fast_path(environ):
+                return True
+        return False
+
+    def run(self, req, chain):
+        """Returns what the first of chain's filters to act on req does.
+
+           A filter returning the app it wraps passes req to the next one,
+           and past the last one req goes to self.app.
+        """
+        for position in chain:
+            hosted = self.filters[position]
+            hosted._override_caller(req)
+            if not hosted.enabled:
+                continue
+            handle = getattr(hosted, 'handle', hosted)
+            result = handle(req)
+            if result is not hosted.app:
+                return result
+        return self.app
+
+    @route_index.wsgify
+    def __call__(self, req):
+        super(CompositeFilter, self).__call__(req)
+        if not self.enabled:
+            return self.app
+        chain = self.match(req)
+        if not chain:
+            return self.app
+        req.environ[CHAIN_KEY] = chain
+        req.environ[REQUEST_KEY] = req
+        try:
+            return self.run(req, chain)
+        finally:
+            del req.environ[CHAIN_KEY]
+            del req.environ[REQUEST_KEY]
+
+
+def filter_factory(global_conf, **local_conf):
+    """Returns a WSGI filter app for use with paste.deploy."""
+    conf = global_conf.copy()
+    conf.update(local_conf)
+
+    def composite_filter(app):
+        return prefork.warm_up(CompositeFilter(app, conf))
+    return composite_filter
@@ -13,15 +13,14 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
-from neutron import context
-from neutron import policy
-
 from wafflehaus.try_context.context_filter import BaseContextStrategy
 
 
 class NeutronContextFilter(BaseContextStrategy):
     def __init__(self, key, req_auth=False):
         super(NeutronContextFilter, self).__init__(key, req_auth)
+        # neutron is only imported once the strategy is used
+        from neutron import context
         self.neutron_ctx = context
 
     def _process_roles(self, roles):
@@ -35,6 +34,7 @@ class NeutronContextFilter(BaseContextStrategy):
                 self.context.roles.append(role)
 
     def load_context(self, req):
+        from neutron import policy
         super(NeutronContextFilter, self).load_context(req)
         tenant_id = req.headers.get('X_TENANT_ID')
         user_id = req.headers.get('X_USER_ID')
@@ -15,11 +15,13 @@
 
 import json
 
-import netaddr
-import webob.dec
 import webob.exc
 
 from wafflehaus.base import WafflehausBase
+from wafflehaus.neutron import log
+from wafflehaus.neutron import metrics
+from wafflehaus.neutron import prefork
+from wafflehaus.neutron import route_index
 import wafflehaus.resource_filter as rf
 
 
@@ -28,12 +30,20 @@ class DefaultIPPolicy(WafflehausBase):
     def __init__(self, app, conf):
         super(DefaultIPPolicy, self).__init__(app, conf)
         self.log.name = conf.get('log_name', __name__)
+        self.detail_log = log.FilterLog(self.log, conf)
         self.resource = conf.get('resource', 'POST /v2.0/subnets')
         self.resources = rf.parse_resources(self.resource)
+        self.route_key = route_index.register(self.resources or {})
+        self.fast_path = route_index.PathFilter(self.resources or {})
+        metrics.instrument(self, conf)
 
-    def _pools_from_ipset(self, ipset):
+    def warm_up(self):
+        import netaddr  # noqa
+
+    def _pools_from_ipset(self, req, ipset):
         cidrs = ipset.iter_cidrs()
-        self.log.info('_pools_from_ipset - CIDRS -> ' + str(cidrs))
+        self.detail_log.detail(req, '_pools_from_ipset - CIDRS -> %s',
+                               self.detail_log.payload(cidrs))
         if len(cidrs) == 0:
             return []
         if len(cidrs) == 1:
@@ -51,11 +61,12 @@ class DefaultIPPolicy(WafflehausBase):
                 pool_start = cidr_start
             prev_cidr_end = cidr[-1]
         pools.append(dict(start=str(pool_start), end=str(prev_cidr_end)))
-        self.log.info('_pools_from_ipset - Pools from ip set -> ' +
-                      str(pools))
+        self.detail_log.detail(req, '_pools_from_ipset - Pools from ip set '
+                               '-> %s', self.detail_log.payload(pools))
         return pools
 
     def _get_default_allocation_pools(self, subnet):
+        import netaddr
         alloc_pools = {}
         cidr_net = netaddr.IPNetwork(subnet["cidr"])
         starting_index = 5 if subnet.get("ip_version") == 4 else 10
@@ -65,11 +76,13 @@ class DefaultIPPolicy(WafflehausBase):
                        "end": str(end)}]
         return alloc_pools
 
-    def _modify_allocation_pools(self, subnet):
+    def _modify_allocation_pools(self, req, subnet):
+        import netaddr
         alloc_pools = subnet.get('allocation_pools')
         default_alloc_pools = self._get_default_allocation_pools(subnet)
-        self.log.info('_get_default_allocation_pools - '
-                      'Default allocation pool -> ' + str(default_alloc_pools))
+        self.detail_log.detail(req, '_get_default_allocation_pools - '
+                               'Default allocation pool -> %s',
+                               self.detail_log.payload(default_alloc_pools))
         default_start = netaddr.IPAddress(default_alloc_pools[0]["start"])
         default_end = netaddr.IPAddress(default_alloc_pools[0]["end"])
         default_set = netaddr.IPSet(netaddr.IPRange(default_start,
@@ -82,89 +95,87 @@ class DefaultIPPolicy(WafflehausBase):
                 netaddr.IPRange(
                     netaddr.IPAddress(start), netaddr.IPAddress(end)).cidrs())
             final_set.update(default_set & alloc_pool_ip_set)
-        alloc_pools = self._pools_from_ipset(final_set)
+        alloc_pools = self._pools_from_ipset(req, final_set)
         return alloc_pools
 
     def _filter_policy(self, req):
-        context_dict = req.environ.get('neutron.context')
-        if context_dict:
-            self.log.info('_filter_policy, Neutron Context ' +
-                          'request id %s, project id %s, '
-                          'tenant name %s, is admin %s, user id %s'
-                          % (str(context_dict.request_id),
-                             str(context_dict.project_id),
-                             str(context_dict.tenant_name),
-                             str(context_dict.is_admin),
-                             str(context_dict.user_id)))
+        self.detail_log.context(req, '_filter_policy')
         tenant_id = req.headers.get('X_TENANT_ID')
         user_id = req.headers.get('X_USER_ID')
         body = req.body
-        self.log.info('_filter_policy - '
-                      'Filter policy request body -> '
-                      '%s tenant_id %s and '
-                      'user_id %s' % (str(body), tenant_id, user_id))
+        self.detail_log.detail(req, '_filter_policy - Filter policy request '
+                               'body -> %s tenant_id %s and user_id %s',
+                               self.detail_log.payload(body), tenant_id,
+                               user_id)
         try:
             body_json = json.loads(body)
         except ValueError:
             self.log.error('_filter_policy - '
                            'Could not load request body as json '
                            'while filtering policy, check if the json is valid'
-                           ' %s tenant_id %s and '
-                           'user_id %s' % (str(body), tenant_id, user_id))
+                           ' %s tenant_id %s and user_id %s',
+                           self.detail_log.payload(body), tenant_id, user_id)
             return webob.exc.HTTPBadRequest
         subnets = body_json.get('subnets')
         subnet = body_json.get('subnet')
-        self.log.info('_filter_policy - Subnets -> '
-                      '%s tenant_id %s and '
-                      'user_id %s' % (str(subnets), tenant_id, user_id))
-        self.log.info(' _filter_policy - Subnet -> ' + str(subnet))
+        self.detail_log.detail(req, '_filter_policy - Subnets -> %s '
+                               'tenant_id %s and user_id %s',
+                               self.detail_log.payload(subnets), tenant_id,
+                               user_id)
+        self.detail_log.detail(req, ' _filter_policy - Subnet -> %s',
+                               self.detail_log.payload(subnet))
         body_json["subnets"] = []
         if subnets is None and subnet is None:
-            self.log.debug('_filter_policy - Both subnets and '
-                           'subnet is None in request json body '
-                           'tenant_id %s and user_id %s' %
-                           (tenant_id, user_id))
+            self.detail_log.debug(req, '_filter_policy - Both subnets and '
+                                  'subnet is None in request json body '
+                                  'tenant_id %s and user_id %s', tenant_id,
+                                  user_id)
             """If this is true there is nothing to work with let app error."""
             return self.app
         single = False
         if subnets is None:
             """If this is true then it's a single, put it in list."""
-            self.log.debug('_filter_policy - Subnets is None but '
-                           'subnet is not, means it is single '
-                           'tenant_id %s and user_id %s' %
-                           (tenant_id, user_id))
+            self.detail_log.debug(req, '_filter_policy - Subnets is None '
+                                  'but subnet is not, means it is single '
+                                  'tenant_id %s and user_id %s', tenant_id,
+                                  user_id)
             single = True
             subnets = [subnet]
         for subnet in subnets:
             alloc_pools = subnet.get('allocation_pools')
             if alloc_pools is None:
-                self.log.debug('_filter_policy - Allocation pools is '
-                               'None, getting default allocation pools '
-                               'tenant_id %s and user_id %s' %
-                               (tenant_id, user_id))
+                self.detail_log.debug(req, '_filter_policy - Allocation '
+                                      'pools is None, getting default '
+                                      'allocation pools tenant_id %s and '
+                                      'user_id %s', tenant_id, user_id)
                 alloc_pools = self._get_default_allocation_pools(subnet)
             else:
-                alloc_pools = self._modify_allocation_pools(subnet)
-                self.log.info('_modify_allocation_pools - '
-                              'Modified allocation pool -> ' + str(
-                                  alloc_pools))
+                alloc_pools = self._modify_allocation_pools(req, subnet)
+                self.detail_log.detail(req, '_modify_allocation_pools - '
+                                       'Modified allocation pool -> %s',
+                                       self.detail_log.payload(alloc_pools))
             subnet["allocation_pools"] = alloc_pools
             body_json["subnets"].append(subnet)
         if single:
             body_json["subnet"] = body_json.pop("subnets")[0]
         req.body = json.dumps(body_json)
         self.body = req.body
+        metrics.decide('rewritten')
         return self.app
 
-    @webob.dec.wsgify
+    def handle(self, req):
+        """Fixes the pools of req, which matched self.resources."""
+        return self._filter_policy(req)
+
+    @route_index.wsgify
     def __call__(self, req):
         super(DefaultIPPolicy, self).__call__(req)
         if not self.enabled:
             return self.app
 
-        if not rf.matched_request(req, self.resources):
+        if not route_index.matched(req, self.route_key):
             return self.app
-        return self._filter_policy(req)
+        return self.handle(req)
 
 
 def filter_factory(global_conf, **local_conf):
@@ -173,5 +184,5 @@ def filter_factory(global_conf, **local_conf):
     conf.update(local_conf)
 
     def block_resource(app):
-        return DefaultIPPolicy(app, conf)
+        return prefork.warm_up(DefaultIPPolicy(app, conf))
     return block_resource
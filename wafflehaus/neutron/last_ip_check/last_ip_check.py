@@ -15,54 +15,52 @@
 
 import json
 
-import webob.dec
 import webob.exc
 
 from wafflehaus.base import WafflehausBase
+from wafflehaus.neutron import log
+from wafflehaus.neutron import metrics
+from wafflehaus.neutron import prefork
+from wafflehaus.neutron import route_index
 
 
 class LastIpCheck(WafflehausBase):
+    # Only PUTs are checked, on any path
+    methods = ('PUT',)
+
     def __init__(self, app, conf):
         super(LastIpCheck, self).__init__(app, conf)
         self.log.name = conf.get('log_name', __name__)
+        self.detail_log = log.FilterLog(self.log, conf)
+        self.route_key = route_index.register(None, self.methods)
+        self.fast_path = route_index.PathFilter(None, self.methods)
+        metrics.instrument(self, conf)
 
     def _check_basics(self, req):
-        context_dict = req.environ.get('neutron.context')
-        if context_dict:
-            self.log.info('_check_basics - Neutron Context ' +
-                          'request id %s, project id %s, '
-                          'tenant name %s, is admin %s, user id %s'
-                          % (str(context_dict.request_id),
-                             str(context_dict.project_id),
-                             str(context_dict.tenant_name),
-                             str(context_dict.is_admin),
-                             str(context_dict.user_id)))
+        self.detail_log.context(req, '_check_basics')
         tenant_id = req.headers.get('X_TENANT_ID')
         user_id = req.headers.get('X_USER_ID')
-        self.log.info('_check_basics - '
-                      'tenant_id %s and user_id '
-                      '%s' % (tenant_id, user_id))
+        self.detail_log.detail(req, '_check_basics - tenant_id %s and '
+                               'user_id %s', tenant_id, user_id)
         if req.content_length == 0:
-            self.log.debug('_check_basics - '
-                           'Content length of request is zero '
-                           '_check_basics returned False for module '
-                           'tenant_id %s and user_id '
-                           '%s' % (tenant_id, user_id))
+            self.detail_log.debug(req, '_check_basics - Content length of '
+                                  'request is zero _check_basics returned '
+                                  'False for module tenant_id %s and '
+                                  'user_id %s', tenant_id, user_id)
             return False
         method = req.method
         if method not in ['PUT']:
-            self.log.debug('_check_basics - PUT not in request method '
-                           'tenant_id %s and user_id '
-                           '%s' % (tenant_id, user_id))
+            self.detail_log.debug(req, '_check_basics - PUT not in request '
+                                  'method tenant_id %s and user_id %s',
+                                  tenant_id, user_id)
             return False
         url = req.path
         url_parts = url.split('/')
         if 'ports' not in url and 'ports' not in url_parts[len(url_parts) - 2]:
-            self.log.debug('_check_basics - Port '
-                           'not found in url, or url_parts[len('
-                           'url_parts) _check_basics retuned False '
-                           'tenant_id %s and user_id '
-                           '%s' % (tenant_id, user_id))
+            self.detail_log.debug(req, '_check_basics - Port not found in '
+                                  'url, or url_parts[len(url_parts) '
+                                  '_check_basics retuned False tenant_id %s '
+                                  'and user_id %s', tenant_id, user_id)
             return False
         return True
 
@@ -78,25 +76,25 @@ class LastIpCheck(WafflehausBase):
         except ValueError:
             self.log.error('_should_run - Failed while loading json, '
                            'check for invalid json tenant_id %s and user_id '
-                           '%s' % (tenant_id, user_id))
+                           '%s', tenant_id, user_id)
             return webob.exc.HTTPBadRequest
         try:
             port_info = body_json.get('port')
         except AttributeError:
             self.log.error('_should_run - Port not found in '
                            'request body json tenant_id %s and user_id '
-                           '%s' % (tenant_id, user_id))
+                           '%s', tenant_id, user_id)
             return False
         if port_info is None:
-            self.log.debug('_should_run - Port info is None '
-                           'in the request body json tenant_id %s and user_id '
-                           '%s' % (tenant_id, user_id))
+            self.detail_log.debug(req, '_should_run - Port info is None in '
+                                  'the request body json tenant_id %s and '
+                                  'user_id %s', tenant_id, user_id)
             return False
         fixed_ips = port_info.get('fixed_ips')
         if fixed_ips is None:
-            self.log.debug('_should_run - Fixed IP is None '
-                           'in request body json tenant_id %s and user_id '
-                           '%s' % (tenant_id, user_id))
+            self.detail_log.debug(req, '_should_run - Fixed IP is None in '
+                                  'request body json tenant_id %s and '
+                                  'user_id %s', tenant_id, user_id)
             return False
         self.fixed_ips = fixed_ips
         return True
@@ -104,26 +102,22 @@ class LastIpCheck(WafflehausBase):
     def _is_last_ip(self, req):
         tenant_id = req.headers.get('X_TENANT_ID')
         user_id = req.headers.get('X_USER_ID')
-        self.log.info('_is_last_ip - Checking if the attached IP is '
-                      'the last address tenant_id %s and user_id %s' %
-                      (tenant_id, user_id))
+        self.detail_log.detail(req, '_is_last_ip - Checking if the attached '
+                               'IP is the last address tenant_id %s and '
+                               'user_id %s', tenant_id, user_id)
         if not hasattr(self, 'fixed_ips') or self.fixed_ips is None:
             return self.app
         if len(self.fixed_ips) == 0:
             self.log.error('_is_last_ip - PUT requests to remove all '
                            'IPs from a Port are not allowed tenant_id %s '
-                           'and user_id %s' % (tenant_id, user_id))
+                           'and user_id %s', tenant_id, user_id)
             return webob.exc.HTTPForbidden("fixed_ips cannot be empty")
         else:
             return self.app
         return webob.exc.HTTPForbidden()
 
-    @webob.dec.wsgify
-    def __call__(self, req):
-        super(LastIpCheck, self).__call__(req)
-        if not self.enabled:
-            return self.app
-
+    def handle(self, req):
+        """Checks req, which may be any request, once enabled."""
         res = self._should_run(req)
         if isinstance(res, webob.exc.HTTPException):
             return res
@@ -131,6 +125,13 @@ class LastIpCheck(WafflehausBase):
             return self.app
         return self._is_last_ip(req)
 
+    @route_index.wsgify
+    def __call__(self, req):
+        super(LastIpCheck, self).__call__(req)
+        if not self.enabled:
+            return self.app
+        return self.handle(req)
+
 
 def filter_factory(global_conf, **local_conf):
     """Returns a WSGI filter app for use with paste.deploy."""
@@ -138,5 +139,5 @@ def filter_factory(global_conf, **local_conf):
     conf.update(local_conf)
 
     def check_last_ip(app):
-        return LastIpCheck(app, conf)
+        return prefork.warm_up(LastIpCheck(app, conf))
     return check_last_ip
@@ -0,0 +1,325 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import logging
+import os
+import random
+import sys
+import threading
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+
+DEFAULT_PAYLOAD_LIMIT = 1024
+SAMPLED_KEY = 'wafflehaus.neutron.log_sampled'
+OVERFLOW_POLICIES = ('drop', 'block')
+_TRUTHS = ('true', 't', '1', 'on', 'yes', 'y')
+_async_lock = threading.Lock()
+
+
+def _blocking(func, *args):
+    """Calls func, which blocks on I/O, and returns what it does.
+
+       In a process monkey patched by eventlet, as neutron-server is, a
+       file write would stall every greenthread, so there it is made in
+       eventlet's pool of OS threads.
+    """
+    if 'eventlet' in sys.modules:
+        from eventlet import patcher
+        if patcher.is_monkey_patched('thread'):
+            from eventlet import tpool
+            return tpool.execute(func, *args)
+    return func(*args)
+
+
+def _write_stream(stream, text):
+    stream.write(text)
+    if hasattr(stream, 'flush'):
+        stream.flush()
+
+
+class Payload(object):
+    """Formats value for a log record only when the record is emitted.
+
+       The text is cut to limit characters, 0 keeps all of it.
+    """
+
+    __slots__ = ('value', 'limit')
+
+    def __init__(self, value, limit=DEFAULT_PAYLOAD_LIMIT):
+        self.value = value
+        self.limit = limit
+
+    def __str__(self):
+        text = str(self.value)
+        if self.limit and len(text) > self.limit:
+            return "%s...(%d more)" % (text[:self.limit],
+                                       len(text) - self.limit)
+        return text
+
+
+class FilterLog(object):
+    """The per-request detail logging of one filter.
+
+       Detail records are only built for the log_sample_rate share of
+       requests, decided once per request so every filter in a pipeline
+       logs the same requests. Payloads are cut to log_payload_limit
+       characters. Both work with logging's deferred formatting: nothing
+       is formatted unless the logger emits the record.
+    """
+
+    def __init__(self, log, conf):
+        self.log = log
+        self.payload_limit = int(conf.get('log_payload_limit',
+                                          DEFAULT_PAYLOAD_LIMIT))
+        self.sample_rate = float(conf.get('log_sample_rate', 1))
+        self.async_handler = None
+        if str(conf.get('log_async', False)).lower() in _TRUTHS:
+            self.async_handler = use_async_handler(
+                log, queue_size=int(conf.get('log_queue_size', 10000)),
+                overflow=conf.get('log_overflow', 'drop').lower(),
+                batch_size=int(conf.get('log_batch_size', 100)))
+
+    def payload(self, value):
+        return Payload(value, self.payload_limit)
+
+    def sampled(self, req):
+        """Returns whether req's detail is logged, the same for each call."""
+        sampled = req.environ.get(SAMPLED_KEY)
+        if sampled is None:
+            sampled = (self.sample_rate >= 1 or
+                       random.random() < self.sample_rate)
+            req.environ[SAMPLED_KEY] = sampled
+        return sampled
+
+    def detail(self, req, msg, *args):
+        """Logs msg % args at INFO for sampled requests."""
+        if self.log.isEnabledFor(logging.INFO) and self.sampled(req):
+            self.log.info(msg, *args)
+
+    def debug(self, req, msg, *args):
+        """Logs msg % args at DEBUG for sampled requests."""
+        if self.log.isEnabledFor(logging.DEBUG) and self.sampled(req):
+            self.log.debug(msg, *args)
+
+    def context(self, req, where):
+        """Logs the identity in req's neutron context, if it has one."""
+        context = req.environ.get('neutron.context')
+        if context:
+            self.detail(req, '%s - Neutron Context request id %s, project '
+                        'id %s, tenant name %s, is admin %s, user id %s',
+                        where, context.request_id, context.project_id,
+                        context.tenant_name, context.is_admin,
+                        context.user_id)
+
+    def stats(self):
+        """Returns the async handler's queue counts, if log_async is on."""
+        if self.async_handler is None:
+            return None
+        return self.async_handler.stats()
+
+
+class PropagateHandler(logging.Handler):
+    """Hands records to the handlers of logger's ancestors.
+
+       This is what propagation would have done, used as the target of a
+       QueueHandler installed on a logger that no longer propagates.
+    """
+
+    def __init__(self, logger):
+        super(PropagateHandler, self).__init__()
+        self.logger = logger
+
+    def handlers(self):
+        """Returns the handlers of logger's ancestors, nearest first."""
+        handlers = []
+        parent = self.logger.parent
+        while parent is not None:
+            handlers.extend(parent.handlers)
+            if not parent.propagate:
+                break
+            parent = parent.parent
+        return handlers
+
+    def emit(self, record):
+        for handler in self.handlers():
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+
+class QueueHandler(logging.Handler):
+    """Moves log writes off the request thread.
+
+       Records are formatted into their message where they are logged,
+       since their args may change afterwards, then put on a queue of up
+       to queue_size records. A background thread writes them to target,
+       or for a PropagateHandler to the handlers it stands for, in batches
+       of up to batch_size, with one flush per batch and, for a plain
+       stream or file handler, one write. When the queue is full,
+       overflow 'drop' drops the record and 'block' waits for room.
+
+       The writer thread is started by the first record of each process.
+       Under eventlet it is a greenthread, so it hands those stream and
+       file writes to eventlet's OS threads rather than stall the worker.
+    """
+
+    def __init__(self, target, queue_size=10000, overflow='drop',
+                 batch_size=100):
+        super(QueueHandler, self).__init__()
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError("Log overflow policy must be one of %s" %
+                             ', '.join(OVERFLOW_POLICIES))
+        self.target = target
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self.batch_size = max(1, batch_size)
+        self.queue = None
+        self.pid = None
+        self.writer = None
+        self.start_lock = threading.Lock()
+        self.enqueued = 0
+        self.dropped = 0
+        self.written = 0
+        self.batches = 0
+        self.errors = 0
+
+    def _start(self):
+        pid = os.getpid()
+        if self.pid == pid:
+            return
+        with self.start_lock:
+            if self.pid == pid:
+                return
+            # A forked child inherits the parent's queue but not its thread
+            self.queue = queue.Queue(self.queue_size)
+            self.writer = threading.Thread(target=self._drain)
+            self.writer.daemon = True
+            self.writer.start()
+            self.pid = pid
+
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = logging.Formatter().formatException(
+                    record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            self._start()
+            record = self.prepare(record)
+            if self.overflow == 'block':
+                self.queue.put(record)
+            else:
+                self.queue.put_nowait(record)
+            self.enqueued += 1
+        except queue.Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+    def _drain(self):
+        work_queue = self.queue
+        while True:
+            batch = [work_queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(work_queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in batch
+            batch = [r for r in batch if r is not None]
+            try:
+                self._write(batch)
+            except Exception:
+                self.errors += 1
+            finally:
+                for _ in range(len(batch) + (1 if stop else 0)):
+                    work_queue.task_done()
+            if stop:
+                return
+
+    def _write(self, batch):
+        if isinstance(self.target, PropagateHandler):
+            handlers = self.target.handlers()
+        else:
+            handlers = [self.target]
+        for handler in handlers:
+            records = [r for r in batch if r.levelno >= handler.level]
+            if not records:
+                continue
+            if type(handler) in (logging.StreamHandler,
+                                 logging.FileHandler) and (
+                    handler.stream is not None):
+                # Formatted here, only the write itself may block
+                text = "".join("%s\n" % handler.format(r) for r in records
+                               if handler.filter(r))
+                if not text:
+                    continue
+                handler.acquire()
+                try:
+                    _blocking(_write_stream, handler.stream, text)
+                finally:
+                    handler.release()
+            else:
+                for record in records:
+                    handler.handle(record)
+                handler.flush()
+        self.written += len(batch)
+        self.batches += 1
+
+    def flush(self):
+        """Waits until every queued record is written."""
+        if self.pid == os.getpid():
+            self.queue.join()
+
+    def close(self):
+        if self.pid == os.getpid():
+            self.queue.put(None)
+            self.writer.join()
+            self.pid = None
+        self.target.close()
+        super(QueueHandler, self).close()
+
+    def stats(self):
+        return {"queued": self.queue.qsize() if self.queue else 0,
+                "enqueued": self.enqueued,
+                "dropped": self.dropped,
+                "written": self.written,
+                "batches": self.batches,
+                "errors": self.errors}
+
+
+def use_async_handler(logger, **kwargs):
+    """Sends logger's records through a QueueHandler, returning it.
+
+       The QueueHandler takes over from propagation, writing to the
+       handlers logger's records went to before. Calling it again for the
+       same logger returns the handler already installed.
+    """
+    with _async_lock:
+        for handler in logger.handlers:
+            if isinstance(handler, QueueHandler):
+                return handler
+        handler = QueueHandler(PropagateHandler(logger), **kwargs)
+        logger.addHandler(handler)
+        logger.propagate = False
+        return handler
@@ -0,0 +1,424 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+import bisect
+import logging
+import os
+import socket
+import stat
+import threading
+import time
+
+import webob
+import webob.exc
+
+from wafflehaus.base import WafflehausBase
+from wafflehaus.neutron import route_index
+
+
+# Upper bounds, in seconds, of the histogram buckets
+BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+           0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+DECISIONS = ('allowed', 'rejected', 'rewritten', 'error')
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+DEFAULT_PATH = '/wafflehaus/metrics'
+_TRUTHS = ('true', 't', '1', 'on', 'yes', 'y')
+
+wall_clock = time.time
+# Time the calling thread, or on Python 2 the process, spent on a CPU
+cpu_clock = getattr(time, 'thread_time', None) or time.clock
+
+
+class Histogram(object):
+    """Counts of observed values per bucket of BUCKETS, and their sum.
+
+       It has no lock of its own, the Series holding it locks for it.
+    """
+
+    __slots__ = ('counts', 'sum')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+
+    def snapshot(self):
+        """Returns the cumulative bucket counts and the sum."""
+        counts = list(self.counts)
+        for i in range(1, len(counts)):
+            counts[i] += counts[i - 1]
+        return counts, self.sum
+
+
+class Series(object):
+    """What one filter did for the requests of one method and route."""
+
+    __slots__ = ('wall', 'cpu', 'decisions', 'lock')
+
+    def __init__(self):
+        self.wall = Histogram()
+        self.cpu = Histogram()
+        self.decisions = dict((d, 0) for d in DECISIONS)
+        self.lock = threading.Lock()
+
+    def record(self, wall, cpu, decision):
+        with self.lock:
+            self.wall.observe(wall)
+            self.cpu.observe(cpu)
+            self.decisions[decision] += 1
+
+    def snapshot(self):
+        """Returns the wall and CPU snapshots and the decision counts."""
+        with self.lock:
+            return (self.wall.snapshot(), self.cpu.snapshot(),
+                    dict(self.decisions))
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n')
+
+
+class Registry(object):
+    """The series of every instrumented filter in this process."""
+
+    def __init__(self):
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def get(self, filter_name, method, route):
+        key = (filter_name, method, route)
+        series = self.series.get(key)
+        if series is None:
+            with self.lock:
+                series = self.series.setdefault(key, Series())
+        return series
+
+    def clear(self):
+        with self.lock:
+            self.series.clear()
+
+    def render(self):
+        """Returns the series in the Prometheus text exposition format."""
+        with self.lock:
+            items = sorted(self.series.items())
+        snapshots = [(key, series.snapshot()) for key, series in items]
+        lines = []
+        for metric, index, text in (
+                ('wafflehaus_filter_seconds', 0,
+                 'Wall time filters spent on requests, excluding the app '
+                 'they wrap.'),
+                ('wafflehaus_filter_cpu_seconds', 1,
+                 'CPU time filters spent on requests, excluding the app '
+                 'they wrap.')):
+            lines.append('# HELP %s %s' % (metric, text))
+            lines.append('# TYPE %s histogram' % metric)
+            for (name, method, route), snapshot in snapshots:
+                labels = 'filter="%s",method="%s",route="%s"' % (
+                    _label(name), _label(method), _label(route))
+                counts, total = snapshot[index]
+                for bound, count in zip(BUCKETS, counts):
+                    lines.append('%s_bucket{%s,le="%r"} %d' % (
+                        metric, labels, bound, count))
+                lines.append('%s_bucket{%s,le="+Inf"} %d' % (
+                    metric, labels, counts[-1]))
+                lines.append('%s_sum{%s} %r' % (metric, labels, total))
+                lines.append('%s_count{%s} %d' % (metric, labels,
+                                                  counts[-1]))
+        metric = 'wafflehaus_filter_requests_total'
+        lines.append('# HELP %s Requests filters handled, by decision.' %
+                     metric)
+        lines.append('# TYPE %s counter' % metric)
+        for (name, method, route), snapshot in snapshots:
+            for decision in DECISIONS:
+                lines.append(
+                    '%s{filter="%s",method="%s",route="%s",decision="%s"} %d'
+                    % (metric, _label(name), _label(method), _label(route),
+                       decision, snapshot[2][decision]))
+        return '\n'.join(lines) + '\n'
+
+
+_registry = Registry()
+_frames = threading.local()
+
+
+def render():
+    """Returns every filter's metrics as Prometheus text."""
+    return _registry.render()
+
+
+def _stack():
+    stack = getattr(_frames, 'stack', None)
+    if stack is None:
+        stack = _frames.stack = []
+    return stack
+
+
+def decide(decision):
+    """Sets the decision recorded for the handle running in this thread.
+
+       Filters call it where the result of handle alone would be
+       misread: a request passed on after being changed was 'rewritten',
+       the app's own response returned as is was 'allowed'.
+    """
+    stack = _stack()
+    if stack:
+        stack[-1][3] = decision
+
+
+def classify(result, app):
+    """Returns the decision a handle returning result made by default.
+
+       Returning app allowed the request, an HTTP error rejected it and
+       any other response was the filter's own or changed by it.
+    """
+    if result is app:
+        return 'allowed'
+    if isinstance(result, type) and issubclass(result,
+                                               webob.exc.HTTPException):
+        return 'rejected'
+    if getattr(result, 'status_code', 0) >= 400:
+        return 'rejected'
+    return 'rewritten'
+
+
+class _Downstream(object):
+    """The app of an instrumented filter, timed for its handle's frame."""
+
+    def __init__(self, recorder, app):
+        self.recorder = recorder
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        stack = _stack()
+        if not stack or stack[-1][0] is not self.recorder:
+            return self.app(environ, start_response)
+        frame = stack[-1]
+        wall, cpu = wall_clock(), cpu_clock()
+        try:
+            return self.app(environ, start_response)
+        finally:
+            frame[1] += wall_clock() - wall
+            frame[2] += cpu_clock() - cpu
+
+    def __getattr__(self, name):
+        return getattr(self.app, name)
+
+
+class Recorder(object):
+    """Times the handle of one filter into the process' registry.
+
+       Each series is for a method and the template of resources the
+       request matched, or '*' for a filter of no resources. Templates
+       are registered in the shared route index, so the match already
+       made for the request names its route.
+    """
+
+    def __init__(self, name, resources=None, methods=None,
+                 registry=None):
+        self.name = name
+        self.registry = registry if registry is not None else _registry
+        self.routes = {}
+        if resources is not None:
+            for template, template_methods in sorted(resources.items()):
+                key = route_index.register({template: template_methods})
+                self.routes[key] = template
+        self.listener = None
+
+    def route(self, req):
+        if self.routes:
+            keys = [k for k in route_index.matches(req) if k in self.routes]
+            if keys:
+                return self.routes[min(keys)]
+        return '*'
+
+    def record(self, req, frame, wall, cpu, decision):
+        wall = wall_clock() - wall - frame[1]
+        cpu = cpu_clock() - cpu - frame[2]
+        if self.listener is not None:
+            self.listener.start()
+        self.registry.get(self.name, req.method, self.route(req)).record(
+            max(wall, 0.0), max(cpu, 0.0), decision)
+
+    def wrap(self, handle, app):
+        """Returns handle recording into this recorder."""
+        def recorded(req):
+            # The recorder, the wall and CPU time spent in app, and the
+            # decision if the filter made one with decide
+            frame = [self, 0.0, 0.0, None]
+            stack = _stack()
+            stack.append(frame)
+            wall, cpu = wall_clock(), cpu_clock()
+            try:
+                result = handle(req)
+            except Exception:
+                self.record(req, frame, wall, cpu, 'error')
+                raise
+            finally:
+                stack.pop()
+            self.record(req, frame, wall, cpu,
+                        frame[3] or classify(result, app))
+            return result
+        recorded.__doc__ = handle.__doc__
+        return recorded
+
+
+class Listener(object):
+    """Serves the registry over HTTP on a unix socket at path.
+
+       '{pid}' in path is replaced by the process id, so every worker
+       neutron-server forks has its own socket. The serving thread is
+       started by each process' first recorded request. A process that
+       cannot serve the socket logs why once and records without it.
+    """
+
+    def __init__(self, path, registry=None, log=None):
+        self.path = path
+        self.registry = registry if registry is not None else _registry
+        self.log = log or logging.getLogger(__name__)
+        self.pid = None
+        self.serving = False
+        self.lock = threading.Lock()
+
+    def start(self):
+        pid = os.getpid()
+        if self.pid == pid:
+            return
+        with self.lock:
+            if self.pid == pid:
+                return
+            self.pid = pid
+            path = self.path.replace('{pid}', str(pid))
+            try:
+                self._remove_stale(path)
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                try:
+                    sock.bind(path)
+                    sock.listen(8)
+                except Exception:
+                    sock.close()
+                    raise
+                thread = threading.Thread(target=self._serve,
+                                          args=(sock, path))
+                thread.daemon = True
+                thread.start()
+            except Exception as e:
+                self.serving = False
+                self.log.error('Not serving metrics on %s: %s', path, e)
+                return
+            self.serving = True
+
+    def _remove_stale(self, path):
+        """Removes a socket left at path by an earlier process.
+
+           Anything else at path is kept, so binding to it fails.
+        """
+        try:
+            mode = os.lstat(path).st_mode
+        except OSError:
+            return
+        if stat.S_ISSOCK(mode):
+            os.unlink(path)
+
+    def _serve(self, sock, path):
+        while True:
+            conn = None
+            try:
+                conn, _ = sock.accept()
+                conn.settimeout(1.0)
+                request = b''
+                while b'\r\n\r\n' not in request and b'\n\n' not in (
+                        request) and len(request) < 8192:
+                    chunk = conn.recv(1024)
+                    if not chunk:
+                        break
+                    request += chunk
+                body = self.registry.render().encode('utf-8')
+                conn.sendall(b''.join((
+                    b'HTTP/1.0 200 OK\r\n',
+                    ('Content-Type: %s\r\nContent-Length: %d\r\n\r\n' % (
+                        CONTENT_TYPE, len(body))).encode('ascii'),
+                    body)))
+            except Exception as e:
+                self.log.error('Could not serve metrics on %s: %s', path, e)
+                if conn is None:
+                    # Do not spin while accepting fails, e.g. out of fds
+                    time.sleep(1)
+            finally:
+                if conn is not None:
+                    conn.close()
+
+
+_listeners = {}
+_listeners_lock = threading.Lock()
+
+
+def listener(path, log=None):
+    """Returns the one Listener of this process for path."""
+    with _listeners_lock:
+        if path not in _listeners:
+            _listeners[path] = Listener(path, log=log)
+        return _listeners[path]
+
+
+def instrument(filter, conf):
+    """Records filter's handle into the registry if metrics is true.
+
+       The series are named metrics_name, by default the module of
+       filter's class. filter.app is wrapped so what handle spends in it
+       is left out. With metrics_socket set, each worker serves the
+       registry on a unix socket there. Returns the Recorder, or None.
+    """
+    if str(conf.get('metrics', False)).lower() not in _TRUTHS:
+        return None
+    recorder = Recorder(conf.get('metrics_name', type(filter).__module__),
+                        getattr(filter, 'resources', None),
+                        getattr(filter, 'methods', None))
+    if conf.get('metrics_socket'):
+        recorder.listener = listener(conf['metrics_socket'],
+                                     getattr(filter, 'log', None))
+    filter.app = _Downstream(recorder, filter.app)
+    filter.handle = recorder.wrap(filter.handle, filter.app)
+    return recorder
+
+
+class MetricsFilter(WafflehausBase):
+    """Answers GETs of path with the metrics of this process' filters."""
+
+    def __init__(self, app, conf):
+        super(MetricsFilter, self).__init__(app, conf)
+        self.path = conf.get('path', DEFAULT_PATH)
+        self.fast_path = route_index.PathFilter({self.path: ['GET']})
+
+    @route_index.wsgify
+    def __call__(self, req):
+        super(MetricsFilter, self).__call__(req)
+        if not self.enabled or req.method != 'GET' or req.path != self.path:
+            return self.app
+        resp = webob.Response(body=render().encode('utf-8'))
+        resp.headers['Content-Type'] = CONTENT_TYPE
+        return resp
+
+
+def filter_factory(global_conf, **local_conf):
+    """Returns a WSGI filter app for use with paste.deploy."""
+    conf = global_conf.copy()
+    conf.update(local_conf)
+
+    def metrics_filter(app):
+        return MetricsFilter(app, conf)
+    return metrics_filter
@@ -14,18 +14,33 @@
 #    under the License.
 
 import json
+import time
 
-from webob.dec import wsgify
 from webob import Response
 
 from wafflehaus.base import WafflehausBase
+from wafflehaus.neutron import log
+from wafflehaus.neutron import metrics
+from wafflehaus.neutron.nova_interaction import balancer
+from wafflehaus.neutron.nova_interaction import breaker
+from wafflehaus.neutron.nova_interaction import cache
+from wafflehaus.neutron.nova_interaction import common
+from wafflehaus.neutron.nova_interaction import dispatch
+from wafflehaus.neutron.nova_interaction import limiter
+from wafflehaus.neutron.nova_interaction import outbox
+from wafflehaus.neutron.nova_interaction import singleflight
 from wafflehaus.neutron.nova_interaction.common import (NeutronConnection as
                                                         NeutronConn)
 from wafflehaus.neutron.nova_interaction.common import (NovaConnection as
                                                         NovaConn)
+from wafflehaus.neutron import prefork
+from wafflehaus.neutron import route_index
 import wafflehaus.resource_filter as rf
 
 
+FALSES = (False, 'False', 'false', 'f', '0', 'off', 'no', 'n')
+
+
 class NovaInteraction(WafflehausBase):
     def __init__(self, app, conf):
         super(NovaInteraction, self).__init__(app, conf)
@@ -33,47 +48,470 @@ class NovaInteraction(WafflehausBase):
         self.log.info('Starting wafflehaus nova_callback middleware')
         self.neutron_port = conf.get('neutron_port')
         self.neutron_url = conf.get('neutron_url')
-        self.neutron_verify_ssl = conf.get('neutron_verify_ssl', True)
+        self.neutron_verify_ssl = self._verify_ssl(
+            conf.get('neutron_verify_ssl', True))
         self.nova_port = conf.get('nova_port')
-        self.nova_url = conf.get('nova_url')
-        self.nova_verify_ssl = conf.get('nova_verify_ssl', True)
+        self.nova_urls = (conf.get('nova_url') or '').replace(',', ' ').split()
+        self.nova_url = self.nova_urls[0] if self.nova_urls else None
+        self.nova_verify_ssl = self._verify_ssl(
+            conf.get('nova_verify_ssl', True))
         self.resources = rf.parse_resources(conf.get('resources'))
+        self.route_key = route_index.register(self.resources or {})
+        self.paths = route_index.PathFilter(self.resources or {})
+        self.detail_log = log.FilterLog(self.log, conf)
+        self.pool_conf = {
+            'pool_name': conf.get('pool_name', __name__),
+            'pool_connections': int(conf.get('pool_connections',
+                                             common.DEFAULT_POOL_CONNECTIONS)),
+            'pool_maxsize': int(conf.get('pool_maxsize',
+                                         common.DEFAULT_POOL_MAXSIZE)),
+            'backend': conf.get('http_backend', 'requests').lower()}
+        if self.pool_conf['backend'] not in common.BACKENDS:
+            raise ValueError("http_backend must be one of %s" %
+                             ', '.join(common.BACKENDS))
+        self.breakers = breaker.BreakerRegistry(
+            self.log, failures=int(conf.get('breaker_failures', 5)),
+            reset_timeout=float(conf.get('breaker_reset', 30)),
+            slow_call=float(conf.get('breaker_slow_call', 0)),
+            probes=int(conf.get('breaker_probes', 1)))
+        self.nova_conf = dict(
+            self.pool_conf, breakers=self.breakers,
+            payload_limit=self.detail_log.payload_limit,
+            connect_timeout=float(conf.get('nova_connect_timeout', 5)),
+            read_timeout=float(conf.get('nova_read_timeout', 30)))
+        self.limiter = None
+        if int(conf.get('nova_concurrency_limit', 0)) > 0:
+            self.limiter = limiter.AdaptiveLimiter(
+                self.log, initial=int(conf.get('nova_concurrency_limit')),
+                minimum=int(conf.get('nova_concurrency_min', 1)),
+                maximum=int(conf.get('nova_concurrency_max', 100)),
+                tolerance=float(conf.get('nova_concurrency_tolerance', 2)),
+                backoff=float(conf.get('nova_concurrency_backoff', 0.9)),
+                max_wait=float(conf.get('nova_concurrency_wait', 0)),
+                green=self.pool_conf['backend'] == 'eventlet')
+            self.nova_conf['limiter'] = self.limiter
+        self.balancer = None
+        if len(self.nova_urls) > 1:
+            port = self.nova_port
+            urls = [("%s:%s" % (url, port) if port is not None else url)
+                    for url in self.nova_urls]
+            self.balancer = balancer.Balancer(
+                urls, policy=conf.get('nova_balancer',
+                                      'least_outstanding').lower(),
+                breakers=self.breakers,
+                decay=float(conf.get('nova_balancer_decay', 0.3)))
+            self.nova_conf['balancer'] = self.balancer
+        self.neutron_conf = dict(
+            self.pool_conf, breakers=self.breakers,
+            payload_limit=self.detail_log.payload_limit,
+            connect_timeout=float(conf.get('neutron_connect_timeout', 5)),
+            read_timeout=float(conf.get('neutron_read_timeout', 30)))
+        self.request_deadline = float(conf.get('request_deadline', 0))
+        self.bulk_concurrency = int(conf.get('bulk_concurrency', 10))
+        self.change_detection = (conf.get('change_detection', False) in
+                                 self.truths)
+        self.change_preimage = (conf.get('change_detection_preimage', False)
+                                in self.truths)
+        self.changes_checked = 0
+        self.changes_suppressed = 0
+        self._nova_conn = None
+        self._neutron_conn = None
+        self.neutron_lookup = conf.get('neutron_lookup', 'http').lower()
+        self.lookups = singleflight.SingleFlight(
+            green=self.pool_conf['backend'] == 'eventlet')
+        port_cache_size = int(conf.get('port_cache_size', 1000))
+        port_cache_ttl = float(conf.get('port_cache_ttl', 300))
+        if conf.get('port_cache_backend', 'local').lower() == 'shared':
+            self.port_cache = cache.SharedPortCache(
+                size=port_cache_size, ttl=port_cache_ttl,
+                path=conf.get('port_cache_path'),
+                slot_size=int(conf.get('port_cache_slot_size', 512)))
+        else:
+            self.port_cache = cache.PortCache(size=port_cache_size,
+                                              ttl=port_cache_ttl)
+        if (self.change_detection and not self.change_preimage and
+                not self.port_cache.shared):
+            self.log.warning('change_detection needs port_cache_backend = '
+                             'shared or change_detection_preimage = true, '
+                             'PUTs will not be compared')
+        self.callback_mode = conf.get('callback_mode', 'sync').lower()
+        self.dispatcher = None
+        self.outbox = None
+        outbox_path = conf.get('callback_outbox')
+        if outbox_path and self.callback_mode != 'async':
+            self.log.warning('callback_outbox is only used when '
+                             'callback_mode = async')
+        elif outbox_path:
+            self.outbox = outbox.Outbox(
+                outbox_path, self.log,
+                compact_every=int(conf.get('callback_outbox_compact', 100)))
+        if self.callback_mode == 'async':
+            self.dispatcher = dispatch.CallbackDispatcher(
+                self._send_callback, self.log,
+                workers=int(conf.get('callback_workers', 4)),
+                queue_size=int(conf.get('callback_queue_size', 1000)),
+                retries=int(conf.get('callback_retries', 3)),
+                retry_delay=float(conf.get('callback_retry_delay', 0.5)),
+                outbox=self.outbox,
+                coalesce_window=float(conf.get('callback_coalesce_window',
+                                               0)),
+                resend_interval=float(conf.get('callback_outbox_resend',
+                                               60)))
+        metrics.instrument(self, conf)
+
+    def _verify_ssl(self, value):
+        """Returns a verify_ssl option as requests takes verify.
+
+           True and false strings become booleans, anything else is the
+           path of a CA bundle and is kept as it is.
+        """
+        if value in self.truths:
+            return True
+        if value in FALSES:
+            return False
+        return value
+
+    @property
+    def nova_conn(self):
+        """Connections are built once and share this middleware's pool."""
+        if self._nova_conn is None:
+            self._nova_conn = NovaConn(log=self.log, port=self.nova_port,
+                                       url=self.nova_url,
+                                       verify_ssl=self.nova_verify_ssl,
+                                       **self.nova_conf)
+        return self._nova_conn
+
+    @property
+    def neutron_conn(self):
+        if self._neutron_conn is None:
+            self._neutron_conn = NeutronConn(
+                log=self.log, port=self.neutron_port, url=self.neutron_url,
+                verify_ssl=self.neutron_verify_ssl, **self.neutron_conf)
+        return self._neutron_conn
+
+    def pool_stats(self):
+        """Returns the keep-alive pool stats for this worker process."""
+        return common.pool_stats(self.pool_conf['pool_name'])
+
+    def callback_stats(self):
+        """Returns queue depth and delivery stats for async callbacks."""
+        if self.dispatcher is None:
+            return None
+        return self.dispatcher.stats()
+
+    def breaker_stats(self):
+        """Returns the circuit state and transition counts per endpoint."""
+        return self.breakers.stats()
+
+    def limiter_stats(self):
+        """Returns the current Nova concurrency limit and rejections."""
+        if self.limiter is None:
+            return None
+        return self.limiter.stats()
+
+    def balancer_stats(self):
+        """Returns per endpoint load and health when nova_url lists many."""
+        if self.balancer is None:
+            return None
+        return self.balancer.stats()
+
+    def _deadline(self, req):
+        """Returns when calls made for req must be done by, if ever.
+
+           Filters placed earlier in the pipeline may already have set it.
+        """
+        if not self.request_deadline:
+            return req.environ.get('wafflehaus.neutron.deadline')
+        return req.environ.setdefault('wafflehaus.neutron.deadline',
+                                      time.time() + self.request_deadline)
+
+    def cache_stats(self):
+        """Returns hit rate and latency saved by the DELETE port cache."""
+        return self.port_cache.stats()
+
+    def lookup_stats(self):
+        """Returns how many Neutron lookups were shared with one in flight."""
+        return self.lookups.stats()
+
+    def change_stats(self):
+        """Returns how many PUT callbacks were skipped as unchanged."""
+        return {"checked": self.changes_checked,
+                "suppressed": self.changes_suppressed}
+
+    def _previous_port(self, req):
+        """Returns the port being PUT as it was before, if it is known.
+
+           Only a shared port cache is trusted for it: another worker's
+           PUT does not reach this worker's local cache, which could then
+           hold a state the port is being changed back to.
+        """
+        port_id = req.path.split("/")
+        port_id = port_id[port_id.index("ports") + 1]
+        previous = None
+        if self.port_cache.shared:
+            previous = self.port_cache.get(port_id)
+        if previous is None and self.change_preimage:
+            status, neutron_resp = self._fetch_port(req, port_id)
+            if status in (200, 204) and isinstance(neutron_resp, dict):
+                previous = neutron_resp.get('port')
+        return previous
+
+    def _admin_context(self):
+        from neutron import context
+        return context.get_admin_context()
+
+    def _port_conn(self, req):
+        if self.neutron_lookup == 'internal':
+            return common.InternalNeutronConnection(
+                self.app, req, self._admin_context(), log=self.log)
+        return self.neutron_conn
+
+    def _fetch_port(self, req, port_id):
+        """Asks Neutron for a port, sharing any lookup already in flight."""
+        return self.lookups.do(('port', port_id), self._port_conn(req).ports,
+                               port_id=port_id, deadline=self._deadline(req))
+
+    def _lookup_port(self, req, port_id):
+        """Returns (status, port response), from the cache when possible."""
+        port = self.port_cache.get(port_id)
+        if port is not None:
+            return 200, {'port': port, 'cached': True}
+        start = time.time()
+        status, neutron_resp = self._fetch_port(req, port_id)
+        self.port_cache.record_lookup(time.time() - start)
+        return status, neutron_resp
+
+    def _send_callback(self, deadline=None, **vif):
+        return self.nova_conn.admin_virtual_interfaces(deadline=deadline,
+                                                       **vif)
+
+    def _nova_callback(self, req, resp, vif, port=None):
+        """Tells Nova about vif and records the outcome in resp's body.
+
+           port, if given, is cached once Nova has been told, so a retry
+           after a failed callback is not taken as unchanged.
+        """
+        instance_id = vif['instance_id']
+        fresh = req.method.upper() == 'POST'
+        if (self.dispatcher is not None and
+                self.dispatcher.submit(vif, fresh=fresh,
+                                       delivered=self._cacher(vif, port))):
+            new_body = self._body(resp)
+            new_body['nova_callback'] = {"instance_id": instance_id,
+                                         "status": "queued"}
+            resp.body = json.dumps(new_body)
+            return resp
+        status, nova_resp = self._send_callback(deadline=self._deadline(req),
+                                                **vif)
+        if isinstance(nova_resp, Exception):
+            nova_resp = str(nova_resp)
+        if status not in (200, 204):
+            # We'll likely want to provide the customer with a call here
+            # such as virtual-interface-delete/virtual-interface-update
+            resp.status = 500
+            new_body = self._body(resp)
+            new_body['nova_callback'] = {"instance_id": instance_id,
+                                         "status": "error",
+                                         "error": nova_resp}
+            resp.body = json.dumps(new_body)
+        else:
+            if port is not None:
+                self.port_cache.set(vif['port_id'], port)
+            new_body = self._body(resp)
+            new_body['nova_callback'] = {"instance_id": instance_id,
+                                         "status": "success"}
+            resp.body = json.dumps(new_body)
+        return resp
+
+    def _cacher(self, vif, port):
+        """Returns what caches port once vif's queued callback is
+           delivered, or None when there is no port to cache.
+        """
+        if port is None:
+            return None
+        return lambda: self.port_cache.set(vif['port_id'], port)
+
+    def _body(self, resp):
+        """Returns resp's JSON body, a DELETE's 204 usually has none."""
+        return resp.json if resp.body else {}
+
+    def _vif(self, action, port, port_id=None):
+        """Returns the admin_virtual_interfaces arguments for port."""
+        return dict(action=action, address=port['mac_address'],
+                    fixed_ips=port['fixed_ips'],
+                    instance_id=port['instance_id'],
+                    network_id=port['network_id'],
+                    port_id=port_id or port['id'],
+                    tenant_id=port['tenant_id'])
+
+    def _send_callbacks(self, req, resp, vifs, fresh=False, ports=None):
+        """Makes the callbacks for vifs, at most bulk_concurrency at a time,
+           and returns each one's outcome in the same order.
+
+           ports, if given, are the ports of vifs, each cached once its
+           callback is delivered.
+        """
+        if ports is None:
+            ports = [None] * len(vifs)
+        queued = [self.dispatcher is not None and
+                  self.dispatcher.submit(v, fresh=fresh,
+                                         delivered=self._cacher(v, p))
+                  for v, p in zip(vifs, ports)]
+        deadline = self._deadline(req)
+
+        def call(vif):
+            return self._send_callback(deadline=deadline, **vif)
+
+        results = iter(dispatch.fan_out(
+            call, [v for v, q in zip(vifs, queued) if not q],
+            self.bulk_concurrency))
+        callbacks = []
+        for vif, was_queued in zip(vifs, queued):
+            callback = {"port_id": vif['port_id'],
+                        "instance_id": vif['instance_id'],
+                        "status": "queued" if was_queued else "success"}
+            if not was_queued:
+                status, nova_resp = next(results)
+                if status not in (200, 204):
+                    resp.status = 500
+                    callback['status'] = "error"
+                    callback['error'] = (str(nova_resp) if
+                                         isinstance(nova_resp, Exception)
+                                         else nova_resp)
+            port = ports[len(callbacks)]
+            if port is not None and callback['status'] == "success":
+                self.port_cache.set(vif['port_id'], port)
+            callbacks.append(callback)
+        return callbacks
+
+    def _bulk_callbacks(self, req, resp, ports):
+        """Makes the callbacks of a bulk create and reports each port's
+           outcome in nova_callbacks.
+        """
+        vifs = [self._vif("create", port) for port in ports]
+        new_body = resp.json
+        new_body['nova_callbacks'] = self._send_callbacks(req, resp, vifs,
+                                                          fresh=True,
+                                                          ports=ports)
+        resp.body = json.dumps(new_body)
+        return resp
+
+    def _ip_address_callbacks(self, req, resp, port_ids):
+        """Tells Nova about every port an ip_address change touched.
+
+           The ports are looked up again, bypassing the cache, so Nova gets
+           their fixed_ips as they are after the change. Ports that are not
+           attached to an instance are skipped.
+        """
+        conn = self._port_conn(req)
+        deadline = self._deadline(req)
+
+        def lookup(port_id):
+            return conn.ports(port_id=port_id, deadline=deadline)
+
+        callbacks = []
+        vifs = []
+        ports = []
+        for port_id, (status, neutron_resp) in zip(
+                port_ids, dispatch.fan_out(lookup, port_ids,
+                                           self.bulk_concurrency)):
+            callback = {"port_id": port_id}
+            if status not in (200, 204) or not isinstance(neutron_resp,
+                                                          dict):
+                resp.status = 500
+                callback['status'] = "error"
+                callback['error'] = str(neutron_resp)
+            elif not neutron_resp['port'].get('instance_id'):
+                callback['status'] = "skipped"
+            else:
+                port = neutron_resp['port']
+                ports.append(port)
+                vifs.append(self._vif("create", port, port_id=port_id))
+                callback = None
+            callbacks.append(callback)
+        sent = iter(self._send_callbacks(req, resp, vifs, ports=ports))
+        new_body = self._body(resp)
+        new_body['nova_callbacks'] = [c if c is not None else next(sent)
+                                      for c in callbacks]
+        resp.body = json.dumps(new_body)
+        return resp
+
+    def _ip_address_call(self, req):
+        """Passes an ip_addresses change on, then calls Nova for the ports
+           the address was or now is attached to.
+        """
+        previous = []
+        if req.method.upper() in ('PUT', 'DELETE'):
+            ip_address_id = req.path.split("/")
+            ip_address_id = ip_address_id[
+                ip_address_id.index("ip_addresses") + 1]
+            status, neutron_resp = self._port_conn(req).ip_addresses(
+                ip_address_id=ip_address_id, deadline=self._deadline(req))
+            if isinstance(neutron_resp, Exception):
+                neutron_resp = str(neutron_resp)
+            if status not in (200, 204):
+                resp = Response()
+                resp.status = 500
+                new_body = {"neutron_callback":
+                            {"ip_address_id": ip_address_id,
+                             "status": "error",
+                             "error": neutron_resp}}
+                resp.body = json.dumps(new_body)
+                return resp
+            previous = neutron_resp['ip_address'].get('port_ids') or []
+        resp = req.get_response(self.app)
+        if resp.status_code not in (200, 201, 204):
+            return resp
+        current = []
+        if req.method.upper() != 'DELETE':
+            current = resp.json['ip_address'].get('port_ids') or []
+        port_ids = []
+        for port_id in previous + current:
+            if port_id not in port_ids:
+                port_ids.append(port_id)
+        return self._ip_address_callbacks(req, resp, port_ids)
 
     def _process_call(self, req, resource):
         """This is were all callbacks are made and the req is processed."""
         if resource == "ports":
             if req.method.upper() in ('PUT', 'POST'):
+                previous = None
+                if self.change_detection and req.method.upper() == 'PUT':
+                    previous = self._previous_port(req)
                 # Pass the request back to be processed by other filters
                 #   and Neutron first
                 resp = req.get_response(self.app)
-                if resp.status_code not in (200, 204):
+                if resp.status_code not in (200, 201, 204):
+                    metrics.decide('allowed')
                     return resp
                 resp_body = resp.json
+                if isinstance(resp_body.get('ports'), list):
+                    return self._bulk_callbacks(req, resp, resp_body['ports'])
 
                 # Variables for Nova Call, obtained from Neutron response
-                action = "create"
-                address = resp_body['port']['mac_address']
-                fixed_ips = resp_body['port']['fixed_ips']
-                instance_id = resp_body['port']['instance_id']
-                network_id = resp_body['port']['network_id']
-                port_id = resp_body['port']['id']
-                tenant_id = resp_body['port']['tenant_id']
+                port = resp_body['port']
+                vif = self._vif("create", port)
+                if previous is not None:
+                    self.changes_checked += 1
+                    if not cache.vif_changed(previous, port):
+                        self.changes_suppressed += 1
+                        resp_body['nova_callback'] = {
+                            "instance_id": vif['instance_id'],
+                            "status": "unchanged"}
+                        resp.body = json.dumps(resp_body)
+                        return resp
+                return self._nova_callback(req, resp, vif, port=port)
 
             elif req.method.upper() == "DELETE":
-                action = "delete"
                 port_id = req.path.split("/")
                 port_id = port_id[port_id.index("ports") + 1]
 
                 # DELETEs do not have all the port info that we need, so a
                 # call to Neutron must be made first.
-                neutron_conn = NeutronConn(log=self.log,
-                                           port=self.neutron_port,
-                                           url=self.neutron_url,
-                                           verify_ssl=self.neutron_verify_ssl)
-                status, neutron_resp = neutron_conn.ports(port_id=port_id)
+                status, neutron_resp = self._lookup_port(req, port_id)
                 if isinstance(neutron_resp, Exception):
-                    return neutron_resp
-                elif status not in (200, 204):
+                    neutron_resp = str(neutron_resp)
+                if status not in (200, 204):
                     resp = Response()
                     resp.status = 500
                     new_body = {"neutron_callback":
@@ -85,64 +523,68 @@ class NovaInteraction(WafflehausBase):
 
                 # Now that we have the port info, we can make the variables
                 # for the Nova Call
-                address = neutron_resp['port']['mac_address']
-                fixed_ips = neutron_resp['port']['fixed_ips']
-                instance_id = neutron_resp['port']['instance_id']
-                network_id = neutron_resp['port']['network_id']
-                tenant_id = neutron_resp['port']['tenant_id']
+                vif = self._vif("delete", neutron_resp['port'],
+                                port_id=port_id)
 
                 # Port info saved, now send the request back to processed by
                 #   other filters and Neutron
                 resp = req.get_response(self.app)
                 if resp.status_code not in (200, 204):
+                    metrics.decide('allowed')
                     return resp
                 else:
-                    new_body = resp.json
+                    self.port_cache.pop(port_id)
+                    new_body = self._body(resp)
                     new_body['neutron_callback'] = {"port_id": port_id,
                                                     "status": "success"}
+                    if neutron_resp.get('cached'):
+                        new_body['neutron_callback']['cached'] = True
                     resp.body = json.dumps(new_body)
 
-            nova_conn = NovaConn(log=self.log, url=self.nova_url,
-                                 verify_ssl=self.nova_verify_ssl)
-            status, nova_resp = nova_conn.admin_virtual_interfaces(
-                action=action, address=address, fixed_ips=fixed_ips,
-                network_id=network_id, port_id=port_id, tenant_id=tenant_id,
-                instance_id=instance_id)
-            if isinstance(nova_resp, Exception):
-                return nova_resp
-            elif status not in (200, 204):
-                # We'll likely want to provide the customer with a call here
-                # such as virtual-interface-delete/virtual-interface-update
-                resp.status = 500
-                new_body = resp.json
-                new_body['nova_callback'] = {"instance_id": instance_id,
-                                             "status": "error",
-                                             "error": nova_resp}
-                resp.body = json.dumps(new_body)
-            else:
-                new_body = resp.json
-                new_body['nova_callback'] = {"instance_id": instance_id,
-                                             "status": "success"}
-                resp.body = json.dumps(new_body)
-            return resp
+            return self._nova_callback(req, resp, vif)
         elif resource == "ip_addresses":
-            pass  # Insert logic to call Nova for ip_addresses changes here
+            return self._ip_address_call(req)
         return resp
 
-    @wsgify
+    def warm_up(self):
+        """Imports what the first Nova or Neutron call would."""
+        if self.pool_conf['backend'] == 'eventlet':
+            from wafflehaus.neutron.nova_interaction import green  # noqa
+        else:
+            import requests  # noqa
+        if self.outbox is not None:
+            import sqlite3  # noqa
+
+    def fast_path(self, environ):
+        """Returns whether environ may be for self.resources."""
+        if self.dispatcher is not None:
+            self.dispatcher.start()
+        return self.paths(environ)
+
+    def handle(self, req):
+        """Processes req, which matched self.resources."""
+        if self.dispatcher is not None:
+            self.dispatcher.start()
+        # Counted from now, not from when Neutron is done with req
+        self._deadline(req)
+        req_path = req.path.lower()
+        if "/ports" in req_path:
+            resource = "ports"
+        elif "/ip_addresses" in req_path:
+            resource = "ip_addresses"
+        resp = self._process_call(req, resource)
+        return resp
+
+    @route_index.wsgify
     def __call__(self, req):
         """This returns an app if ignored or a response if processed."""
         super(NovaInteraction, self).__call__(req)
         if not self.enabled:
             return self.app
-        if rf.matched_request(req, self.resources):
-            req_path = req.path.lower()
-            if "/ports" in req_path:
-                resource = "ports"
-            elif "/ip_addresses" in req_path:
-                resource = "ip_addresses"
-            resp = self._process_call(req, resource)
-            return resp
+        if self.dispatcher is not None:
+            self.dispatcher.start()
+        if route_index.matched(req, self.route_key):
+            return self.handle(req)
         return self.app
 
 
@@ -152,6 +594,6 @@ def filter_factory(global_conf, **local_conf):
     conf.update(local_conf)
 
     def wrapper(app):
-        return NovaInteraction(app, conf)
+        return prefork.warm_up(NovaInteraction(app, conf))
 
     return wrapper
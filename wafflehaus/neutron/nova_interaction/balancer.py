@@ -0,0 +1,148 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import threading
+import time
+
+from wafflehaus.neutron.nova_interaction import breaker as cb
+from wafflehaus.neutron.nova_interaction import limiter as cl
+
+
+POLICIES = ('least_outstanding', 'ewma')
+# What a call returns instead of a status when it was never sent
+NOT_SENT = (cb.CircuitOpenError, cb.DeadlineExceededError,
+            cl.LimitExceededError)
+
+
+class Endpoint(object):
+    def __init__(self, url):
+        self.url = url
+        self.outstanding = 0
+        self.ewma = 0.0
+        self.calls = 0
+        self.failures = 0
+
+
+class Balancer(object):
+    """Picks which of several Nova API endpoints gets the next call.
+
+       least_outstanding picks the endpoint with the fewest calls in
+       flight, ewma the one whose decayed average latency, scaled by its
+       calls in flight, is lowest. Ties rotate between endpoints.
+
+       Health is passive and comes from the breakers, a BreakerRegistry:
+       an endpoint whose circuit is open, or half open with every probe in
+       flight, is ejected until the circuit lets probes through again. If
+       every endpoint is ejected all of them are candidates, so calls
+       still fail fast through their breakers. A call that was never sent
+       is not counted in the endpoint's load or latency, and one its
+       breaker refused is retried on another endpoint.
+    """
+
+    def __init__(self, urls, policy='least_outstanding', breakers=None,
+                 decay=0.3):
+        if policy not in POLICIES:
+            raise ValueError("Balancer policy must be one of %s" %
+                             ', '.join(POLICIES))
+        self.endpoints = [Endpoint(url) for url in urls]
+        self.policy = policy
+        self.breakers = breakers
+        self.decay = decay
+        self.lock = threading.Lock()
+        self.turn = 0
+        self.ejected_picks = 0
+
+    def _healthy(self, endpoint):
+        if self.breakers is None:
+            return True
+        breaker = self.breakers.for_url(endpoint.url)
+        return breaker is None or breaker.available()
+
+    def _score(self, endpoint):
+        if self.policy == 'ewma':
+            return endpoint.ewma * (endpoint.outstanding + 1)
+        return endpoint.outstanding
+
+    def acquire(self, exclude=()):
+        """Returns the endpoint for the next call, counted as in flight.
+
+           Endpoints in exclude are only picked if there are no others.
+        """
+        with self.lock:
+            endpoints = ([e for e in self.endpoints if e not in exclude] or
+                         self.endpoints)
+            candidates = [e for e in endpoints if self._healthy(e)]
+            if not candidates:
+                self.ejected_picks += 1
+                candidates = endpoints
+            self.turn = (self.turn + 1) % len(candidates)
+            rotated = candidates[self.turn:] + candidates[:self.turn]
+            endpoint = min(rotated, key=self._score)
+            endpoint.outstanding += 1
+            endpoint.calls += 1
+        return endpoint
+
+    def release(self, endpoint, success, elapsed, sent=True):
+        """Counts a call acquire handed endpoint for as done.
+
+           A call that was never sent is only taken off the calls in
+           flight.
+        """
+        with self.lock:
+            endpoint.outstanding -= 1
+            if not sent:
+                endpoint.calls -= 1
+                return
+            if not success:
+                endpoint.failures += 1
+            if endpoint.ewma:
+                endpoint.ewma += self.decay * (elapsed - endpoint.ewma)
+            else:
+                endpoint.ewma = elapsed
+
+    def call(self, func):
+        """Calls func(url) on the chosen endpoint, returns its result.
+
+           func returns (None, one of NOT_SENT) for a call it did not
+           make. One refused by a CircuitOpenError is made again on an
+           endpoint not tried yet.
+        """
+        tried = []
+        while True:
+            endpoint = self.acquire(exclude=tried)
+            start = time.time()
+            status = resp = None
+            try:
+                status, resp = func(endpoint.url)
+            finally:
+                sent = status is not None or not isinstance(resp, NOT_SENT)
+                self.release(endpoint, status is not None and status < 500,
+                             time.time() - start, sent=sent)
+            tried.append(endpoint)
+            if (not isinstance(resp, cb.CircuitOpenError) or
+                    len(tried) >= len(self.endpoints)):
+                return status, resp
+
+    def stats(self):
+        endpoints = {}
+        for endpoint in self.endpoints:
+            endpoints[endpoint.url] = {"healthy": self._healthy(endpoint),
+                                       "outstanding": endpoint.outstanding,
+                                       "ewma": endpoint.ewma,
+                                       "calls": endpoint.calls,
+                                       "failures": endpoint.failures}
+        return {"policy": self.policy,
+                "all_ejected": self.ejected_picks,
+                "endpoints": endpoints}
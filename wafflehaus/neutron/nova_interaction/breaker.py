@@ -0,0 +1,162 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import threading
+import time
+
+try:
+    from urllib.parse import urlsplit
+except ImportError:
+    from urlparse import urlsplit
+
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an endpoint whose breaker is open."""
+
+    def __init__(self, endpoint, retry_after):
+        super(CircuitOpenError, self).__init__(
+            "Circuit for %s is open, retry in %.1fs" % (endpoint, retry_after))
+        self.endpoint = endpoint
+        self.retry_after = retry_after
+
+
+class DeadlineExceededError(Exception):
+    """Raised instead of calling an endpoint once the deadline passed."""
+
+
+class CircuitBreaker(object):
+    """Stops calling one endpoint after repeated failures or slow calls.
+
+       After failures consecutive failures the breaker opens and every call
+       is refused for reset_timeout seconds. It then lets probes calls
+       through half open, closing again once they all succeed or opening
+       again on the first failure. A call slower than slow_call seconds
+       counts as a failure when slow_call is set.
+    """
+
+    def __init__(self, endpoint, log, failures=5, reset_timeout=30,
+                 slow_call=0, probes=1):
+        self.endpoint = endpoint
+        self.log = log
+        self.failures = failures
+        self.reset_timeout = reset_timeout
+        self.slow_call = slow_call
+        self.probes = probes
+        self.state = CLOSED
+        self.lock = threading.Lock()
+        self.consecutive = 0
+        self.opened_at = 0
+        self.probes_in_flight = 0
+        self.probe_successes = 0
+        self.rejected = 0
+        self.transitions = {CLOSED: 0, OPEN: 0, HALF_OPEN: 0}
+
+    def _transition(self, state):
+        self.log.warning("Circuit for %s went from %s to %s" %
+                         (self.endpoint, self.state, state))
+        self.state = state
+        self.transitions[state] += 1
+        self.consecutive = 0
+        self.probes_in_flight = 0
+        self.probe_successes = 0
+        if state == OPEN:
+            self.opened_at = time.time()
+
+    def before_call(self):
+        """Raises CircuitOpenError if the endpoint should not be called."""
+        with self.lock:
+            if self.state == OPEN:
+                waited = time.time() - self.opened_at
+                if waited < self.reset_timeout:
+                    self.rejected += 1
+                    raise CircuitOpenError(self.endpoint,
+                                           self.reset_timeout - waited)
+                self._transition(HALF_OPEN)
+            if self.state == HALF_OPEN:
+                if self.probes_in_flight >= self.probes:
+                    self.rejected += 1
+                    raise CircuitOpenError(self.endpoint, self.reset_timeout)
+                self.probes_in_flight += 1
+
+    def available(self):
+        """Returns False while the breaker would refuse the next call."""
+        with self.lock:
+            if self.state == HALF_OPEN:
+                return self.probes_in_flight < self.probes
+            return not (self.state == OPEN and
+                        time.time() - self.opened_at < self.reset_timeout)
+
+    def after_call(self, success, elapsed):
+        if self.slow_call and elapsed > self.slow_call:
+            success = False
+        with self.lock:
+            if self.state == HALF_OPEN:
+                self.probes_in_flight -= 1
+                if not success:
+                    self._transition(OPEN)
+                    return
+                self.probe_successes += 1
+                if self.probe_successes >= self.probes:
+                    self._transition(CLOSED)
+                return
+            if success:
+                self.consecutive = 0
+                return
+            self.consecutive += 1
+            if self.state == CLOSED and self.consecutive >= self.failures:
+                self._transition(OPEN)
+
+    def stats(self):
+        return {"state": self.state,
+                "consecutive_failures": self.consecutive,
+                "rejected": self.rejected,
+                "opened": self.transitions[OPEN],
+                "half_opened": self.transitions[HALF_OPEN],
+                "closed": self.transitions[CLOSED]}
+
+
+class BreakerRegistry(object):
+    """Hands out one CircuitBreaker per scheme://host:port endpoint."""
+
+    def __init__(self, log, failures=5, reset_timeout=30, slow_call=0,
+                 probes=1):
+        self.log = log
+        self.conf = {"failures": failures, "reset_timeout": reset_timeout,
+                     "slow_call": slow_call, "probes": probes}
+        self.enabled = failures > 0
+        self.breakers = {}
+        self.lock = threading.Lock()
+
+    def for_url(self, url):
+        if not self.enabled:
+            return None
+        parts = urlsplit(url)
+        endpoint = "%s://%s" % (parts.scheme, parts.netloc)
+        breaker = self.breakers.get(endpoint)
+        if breaker is None:
+            with self.lock:
+                breaker = self.breakers.get(endpoint)
+                if breaker is None:
+                    breaker = CircuitBreaker(endpoint, self.log, **self.conf)
+                    self.breakers[endpoint] = breaker
+        return breaker
+
+    def stats(self):
+        return dict((e, b.stats()) for e, b in self.breakers.items())
@@ -0,0 +1,177 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import collections
+import json
+import threading
+import time
+
+from wafflehaus.neutron import shm
+
+
+# The port fields Nova needs for an admin-virtual-interfaces call
+VIF_FIELDS = ('mac_address', 'fixed_ips', 'instance_id', 'network_id',
+              'tenant_id')
+# The port fields whose change Nova has to hear about
+CHANGE_FIELDS = ('mac_address', 'fixed_ips', 'instance_id', 'network_id')
+
+
+def _fixed_ip_key(fixed_ip):
+    if not isinstance(fixed_ip, dict):
+        return (str(fixed_ip), '')
+    return (str(fixed_ip.get('subnet_id')), str(fixed_ip.get('ip_address')))
+
+
+def vif_changed(old, new):
+    """Returns True if Nova would see a difference between old and new.
+
+       The order of fixed_ips is not significant.
+    """
+    for field in CHANGE_FIELDS:
+        old_value, new_value = old.get(field), new.get(field)
+        if (field == 'fixed_ips' and isinstance(old_value, list) and
+                isinstance(new_value, list)):
+            old_value = sorted(_fixed_ip_key(ip) for ip in old_value)
+            new_value = sorted(_fixed_ip_key(ip) for ip in new_value)
+        if old_value != new_value:
+            return True
+    return False
+
+
+class PortCache(object):
+    """Bounded LRU of the port fields Nova callbacks need, with a TTL.
+
+       It is filled from the POST and PUT responses the middleware already
+       parses so that most DELETEs can skip asking Neutron for the port.
+       Every miss that has to go to Neutron is timed, a hit is credited
+       with the average miss time as latency saved.
+    """
+
+    # Whether every worker sees the same entries
+    shared = False
+
+    def __init__(self, size=1000, ttl=300):
+        self.size = size
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+        self.lookups = 0
+        self.lookup_time = 0.0
+
+    def set(self, port_id, port):
+        if not port_id or self.size <= 0:
+            return
+        value = dict((k, port.get(k)) for k in VIF_FIELDS)
+        with self.lock:
+            self.entries.pop(port_id, None)
+            self.entries[port_id] = (time.time() + self.ttl, value)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def get(self, port_id):
+        with self.lock:
+            entry = self.entries.get(port_id)
+            if entry is not None and entry[0] < time.time():
+                del self.entries[port_id]
+                self.expired += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            # Re-insert so the entry becomes the most recently used
+            self.entries[port_id] = self.entries.pop(port_id)
+            return dict(entry[1])
+
+    def pop(self, port_id):
+        with self.lock:
+            self.entries.pop(port_id, None)
+
+    def record_lookup(self, seconds):
+        """Records how long a miss took to look up in Neutron."""
+        self.lookups += 1
+        self.lookup_time += seconds
+
+    def stats(self):
+        total = self.hits + self.misses
+        avg_lookup = self.lookup_time / self.lookups if self.lookups else 0.0
+        return {"size": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "expired": self.expired,
+                "evictions": self.evictions,
+                "hit_rate": float(self.hits) / total if total else 0.0,
+                "lookup_avg": avg_lookup,
+                "latency_saved": self.hits * avg_lookup}
+
+
+class SharedPortCache(PortCache):
+    """PortCache kept in a shm.SharedTable every worker reads.
+
+       neutron-server's workers, forked after the table is built, or
+       processes given the same path, see each other's ports, so a port
+       created through one worker is cached for a DELETE through
+       another. Entries expire after ttl and a full bucket drops the one
+       closest to expiry, instead of the least recently used. Ports whose
+       fields do not fit slot_size bytes are not cached. Counts other
+       than size are this process'.
+    """
+
+    shared = True
+
+    def __init__(self, size=1000, ttl=300, path=None, slot_size=512):
+        super(SharedPortCache, self).__init__(size=size, ttl=ttl)
+        self.table = None
+        if size > 0:
+            self.table = shm.SharedTable(path, slots=size,
+                                         slot_size=slot_size)
+
+    def _key(self, port_id):
+        return port_id.encode('utf-8')
+
+    def set(self, port_id, port):
+        if not port_id or self.table is None:
+            return
+        value = dict((k, port.get(k)) for k in VIF_FIELDS)
+        self.table.set(self._key(port_id), json.dumps(value).encode('utf-8'),
+                       self.ttl)
+
+    def get(self, port_id):
+        value = None
+        if self.table is not None:
+            value = self.table.get(self._key(port_id))
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(value.decode('utf-8'))
+
+    def pop(self, port_id):
+        if self.table is not None:
+            self.table.delete(self._key(port_id))
+
+    def stats(self):
+        stats = super(SharedPortCache, self).stats()
+        if self.table is not None:
+            table = self.table.stats()
+            stats.update(size=table["size"], expired=table["expired"],
+                         evictions=table["evictions"],
+                         oversize=table["oversize"])
+        return stats
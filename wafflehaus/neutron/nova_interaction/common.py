@@ -13,68 +13,253 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import json
+import os
+import threading
+import time
 
-import requests
+import webob
+
+from wafflehaus.neutron import log as waffle_log
+from wafflehaus.neutron.nova_interaction import breaker as cb
+from wafflehaus.neutron.nova_interaction import limiter as cl
+
+
+DEFAULT_POOL_NAME = 'wafflehaus.neutron'
+DEFAULT_POOL_CONNECTIONS = 10
+DEFAULT_POOL_MAXSIZE = 10
+BACKENDS = ('requests', 'eventlet')
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+class SessionPool(object):
+    """A keep-alive requests.Session shared by one middleware in a process.
+
+       pool_connections is the number of hosts kept warm and pool_maxsize
+       the number of connections kept per host. The owning pid is recorded
+       so that a forked worker never reuses its parent's sockets.
+    """
+
+    def __init__(self, name, pool_connections=DEFAULT_POOL_CONNECTIONS,
+                 pool_maxsize=DEFAULT_POOL_MAXSIZE):
+        # requests is slow to import, only pay for it once a call is made
+        import requests
+        from requests import adapters
+        self.name = name
+        self.pid = os.getpid()
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.adapter = adapters.HTTPAdapter(pool_connections=pool_connections,
+                                            pool_maxsize=pool_maxsize)
+        self.session = requests.Session()
+        self.session.mount('http://', self.adapter)
+        self.session.mount('https://', self.adapter)
+        self.calls = 0
+        self.errors = 0
+
+    def request(self, method, **params):
+        self.calls += 1
+        try:
+            return self.session.request(method, **params)
+        except Exception:
+            self.errors += 1
+            raise
+
+    def stats(self):
+        hosts = {}
+        pools = self.adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            host = "%s://%s:%s" % (pool.scheme, pool.host, pool.port)
+            hosts[host] = {"connections_opened": pool.num_connections,
+                           "requests": pool.num_requests,
+                           "idle": pool.pool.qsize() if pool.pool else 0}
+        return {"pid": self.pid,
+                "backend": "requests",
+                "calls": self.calls,
+                "errors": self.errors,
+                "pool_connections": self.pool_connections,
+                "pool_maxsize": self.pool_maxsize,
+                "hosts": hosts}
+
+    def close(self):
+        self.session.close()
+
+
+def get_session_pool(name=DEFAULT_POOL_NAME,
+                     pool_connections=DEFAULT_POOL_CONNECTIONS,
+                     pool_maxsize=DEFAULT_POOL_MAXSIZE, backend='requests'):
+    """Returns the process-wide SessionPool for name, creating it if needed.
+
+       A pool created by another pid (i.e. before a fork) is discarded
+       without closing it, its sockets still belong to the parent. The
+       eventlet backend returns a GreenSessionPool with the same interface.
+    """
+    pid = os.getpid()
+    with _pools_lock:
+        pool = _pools.get(name)
+        if pool is None or pool.pid != pid:
+            if backend == 'eventlet':
+                from wafflehaus.neutron.nova_interaction import green
+                pool_class = green.GreenSessionPool
+            else:
+                pool_class = SessionPool
+            pool = pool_class(name, pool_connections=pool_connections,
+                              pool_maxsize=pool_maxsize)
+            _pools[name] = pool
+    return pool
+
+
+def pool_stats(name=None):
+    """Returns stats for every pool owned by this process, or just name."""
+    pid = os.getpid()
+    stats = dict((n, p.stats()) for n, p in _pools.items() if p.pid == pid)
+    if name is not None:
+        return stats.get(name)
+    return stats
 
 
 class BaseConnection(object):
     """Base Connection Class for calling Nova and Neutron.
 
        This requests wrapper mostly provides logging and a common
-       framework for headers and parameters going into Requests.
+       framework for headers and parameters going into Requests. Calls
+       go through a pooled keep-alive session shared by every connection
+       created with the same pool_name.
+
+       Every call is bounded by connect_timeout and read_timeout and, when
+       given, by an absolute deadline. With breakers, a BreakerRegistry,
+       calls to an endpoint whose circuit is open fail fast. With limiter,
+       an AdaptiveLimiter, calls over its concurrency limit wait for a slot
+       or are shed. backend picks requests or explicitly cooperative
+       eventlet sockets, see BACKENDS.
     """
 
-    def __init__(self, log=None, verify_ssl=True):
+    def __init__(self, log=None, verify_ssl=True, pool_name=None,
+                 pool_connections=DEFAULT_POOL_CONNECTIONS,
+                 pool_maxsize=DEFAULT_POOL_MAXSIZE, connect_timeout=None,
+                 read_timeout=None, breakers=None, backend='requests',
+                 limiter=None, payload_limit=waffle_log.DEFAULT_PAYLOAD_LIMIT):
         self.headers = {
             'Content-Type': 'application/json',
             'Accept': 'application/json'}
         self.log = log
         self.verify = verify_ssl
-
-    def _make_the_call(self, method, url, body=None):
+        self.pool_name = pool_name or DEFAULT_POOL_NAME
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.breakers = breakers
+        self.backend = backend
+        self.limiter = limiter
+        self.payload_limit = payload_limit
+
+    @property
+    def pool(self):
+        return get_session_pool(self.pool_name,
+                                pool_connections=self.pool_connections,
+                                pool_maxsize=self.pool_maxsize,
+                                backend=self.backend)
+
+    def _timeout(self, deadline):
+        """Returns the (connect, read) timeout left before deadline."""
+        connect, read = self.connect_timeout, self.read_timeout
+        if deadline is not None:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise cb.DeadlineExceededError("Deadline passed %.3fs ago" %
+                                               abs(remaining))
+            connect = min(connect or remaining, remaining)
+            read = min(read or remaining, remaining)
+        if connect is None and read is None:
+            return None
+        return (connect, read)
+
+    def _payload(self, value):
+        return waffle_log.Payload(value, self.payload_limit)
+
+    def _make_the_call(self, method, url, body=None, deadline=None):
         """Note that a request response is being used here, not webob."""
-        self.log.debug("%s call to %s with body = %s" % (method, url, body))
+        self.log.debug("%s call to %s with body = %s", method, url,
+                       self._payload(body))
         params = {"url": url, "headers": self.headers, "verify": self.verify}
         if body is not None:
+            if not isinstance(body, basestring):
+                body = json.dumps(body)
             params["data"] = body
-        func = getattr(requests, method.lower())
+        breaker = self.breakers.for_url(url) if self.breakers else None
+        try:
+            params["timeout"] = self._timeout(deadline)
+            if self.limiter is not None:
+                self.limiter.acquire(deadline=deadline)
+        except (cb.DeadlineExceededError, cl.LimitExceededError) as e:
+            self.log.error("Not calling %s: %s" % (url, e))
+            return None, e
+        try:
+            if breaker is not None:
+                breaker.before_call()
+        except cb.CircuitOpenError as e:
+            if self.limiter is not None:
+                self.limiter.release()
+            self.log.error("Not calling %s: %s" % (url, e))
+            return None, e
+        start = time.time()
         try:
-            resp = func(**params)
+            resp = self.pool.request(method.upper(), **params)
         except Exception as e:
-            self.log.error("Call to %s failed with %s, %s" % (url, repr(e),
-                                                              e.message))
+            elapsed = time.time() - start
+            if breaker is not None:
+                breaker.after_call(False, elapsed)
+            if self.limiter is not None:
+                self.limiter.release(elapsed, False)
+            self.log.error("Call to %s failed with %s" % (url, repr(e)))
             return None, e
         else:
-            self.log.debug("Call to %s returned with status %s and body "
-                           "%s" % (url, resp.status, resp.text))
-        return resp.status_code, resp.json()
-
-    def delete(self, url, body):
-        self.log.debug('DELETE call to nova with '
-                       'url %s and body %s' % (str(url),
-                                               str(body.__dict__)))
-        status, resp = self._make_the_call("DELETE", url, body)
+            elapsed = time.time() - start
+            if breaker is not None:
+                breaker.after_call(resp.status_code < 500, elapsed)
+            if self.limiter is not None:
+                self.limiter.release(elapsed, resp.status_code < 500)
+            self.log.debug("Call to %s returned with status %s and body %s",
+                           url, resp.status_code, self._payload(resp.content))
+        if not resp.content:
+            return resp.status_code, None
+        try:
+            return resp.status_code, resp.json()
+        except ValueError:
+            return resp.status_code, resp.text
+
+    def delete(self, url, body, deadline=None):
+        self.log.debug('DELETE call to nova with url %s and body %s', url,
+                       self._payload(body))
+        status, resp = self._make_the_call("DELETE", url, body,
+                                           deadline=deadline)
         return status, resp
 
-    def get(self, url, body=None):
-        self.log.debug('GET call to nova with '
-                       'url %s and body %s' % (str(url),
-                                               str(body.__dict__)))
-        status, resp = self._make_the_call("GET", url, body)
+    def get(self, url, body=None, deadline=None):
+        self.log.debug('GET call to nova with url %s and body %s', url,
+                       self._payload(body))
+        status, resp = self._make_the_call("GET", url, body,
+                                           deadline=deadline)
         return status, resp
 
-    def post(self, url, body):
-        self.log.debug('POST call to nova with '
-                       'url %s and body %s' % (str(url),
-                                               str(body.__dict__)))
-        status, resp = self._make_the_call("POST", url, body)
+    def post(self, url, body, deadline=None):
+        self.log.debug('POST call to nova with url %s and body %s', url,
+                       self._payload(body))
+        status, resp = self._make_the_call("POST", url, body,
+                                           deadline=deadline)
         return status, resp
 
-    def put(self, url, body):
-        status, resp = self._make_the_call("PUT", url, body)
-        self.log.debug('PUT call to nova with '
-                       'url %s and body %s' % (str(url),
-                                               str(body.__dict__)))
+    def put(self, url, body, deadline=None):
+        status, resp = self._make_the_call("PUT", url, body,
+                                           deadline=deadline)
+        self.log.debug('PUT call to nova with url %s and body %s', url,
+                       self._payload(body))
 
         return status, resp
 
@@ -109,27 +294,35 @@ class NovaConnection(BaseConnection):
             {"network_id": "<network_id>"}}
     """
 
-    def __init__(self, log=None, port=None, url=None, verify_ssl=True):
-        super(NovaConnection, self).__init__(log=log, verify_ssl=verify_ssl)
-        self.url = "%s:%d" % (url, port) if self.port is not None else url
+    def __init__(self, log=None, port=None, url=None, verify_ssl=True,
+                 balancer=None, **conn_conf):
+        super(NovaConnection, self).__init__(log=log, verify_ssl=verify_ssl,
+                                             **conn_conf)
+        self.url = "%s:%s" % (url, port) if port is not None else url
+        self.balancer = balancer
 
     def admin_virtual_interfaces(self, action=None, address=None,
                                  fixed_ips=None, network_id=None,
                                  port_id=None, tenant_id=None,
-                                 instance_id=None):
+                                 instance_id=None, deadline=None):
         body = {"virtual_interface":
                 {"action": action,
                  "address": address,
                  "fixed_ips": fixed_ips,
                  "id": port_id,
                  "network_id": network_id}}
-        url = "%s/v2/%s/servers/%s/admin-virtual-interfaces/%s/" % (
-            self.url, tenant_id, instance_id, port_id)
+        path = "/v2/%s/servers/%s/admin-virtual-interfaces/%s/" % (
+            tenant_id, instance_id, port_id)
 
-        status, nova_resp = self.put(url, body)
+        if self.balancer is not None:
+            status, nova_resp = self.balancer.call(
+                lambda base: self.put(base + path, body, deadline=deadline))
+        else:
+            status, nova_resp = self.put(self.url + path, body,
+                                         deadline=deadline)
         self.log.debug('Nova status : %s and response : %s for '
-                       'admin virtual interfaces.', str(status),
-                       str(nova_resp))
+                       'admin virtual interfaces.', status,
+                       self._payload(nova_resp))
         return status, nova_resp
 
     def os_virtual_interfaces(self, network_id=None):
@@ -139,30 +332,83 @@ class NovaConnection(BaseConnection):
 
         status, nova_resp = self.put(self.url, body)
         self.log.debug('Nova status %s and response %s for os virtual '
-                       'interfaces.' % (str(status), str(nova_resp)))
+                       'interfaces.', status, self._payload(nova_resp))
         return status, nova_resp
 
 
 class NeutronConnection(BaseConnection):
     """Use this connection type for any Neutron Calls.
 
-       Currently it's for pulling /port info, but may be expanded
-       later when more work is done on /ip_addresses.
+       Currently it's for pulling /ports and /ip_addresses info.
 
        Example /ports call:
 
        curl -X GET neutron://v2.0/ports/<id>
+
+       Example /ip_addresses call:
+
+       curl -X GET neutron://v2.0/ip_addresses/<id>
     """
 
-    def __init__(self, log=None, port=None, url=None, verify_ssl=True):
-        super(NeutronConnection, self).__init__(log=log, verify_ssl=verify_ssl)
-        self.url = "%s:%d" % (url, port) if self.port is not None else url
+    def __init__(self, log=None, port=None, url=None, verify_ssl=True,
+                 **conn_conf):
+        super(NeutronConnection, self).__init__(log=log,
+                                                verify_ssl=verify_ssl,
+                                                **conn_conf)
+        self.url = "%s:%s" % (url, port) if port is not None else url
 
-    def ip_addresses(self):
-        """Placeholder for ip_addresses info call."""
-        pass
+    def ip_addresses(self, ip_address_id=None, deadline=None):
+        url = "%s/v2.0/ip_addresses/%s/" % (self.url, ip_address_id)
+        status, neutron_resp = self.get(url, deadline=deadline)
+        return status, neutron_resp
 
-    def ports(self, port_id=None):
+    def ports(self, port_id=None, deadline=None):
         url = "%s/v2.0/ports/%s/" % (self.url, port_id)
-        status, neutron_resp = self.get(url)
+        status, neutron_resp = self.get(url, deadline=deadline)
         return status, neutron_resp
+
+
+class InternalNeutronConnection(object):
+    """Looks ports and ip_addresses up with a subrequest to the wrapped
+       Neutron app.
+
+       This skips the HTTP round trip, TLS, load balancer and second auth
+       pass of NeutronConnection and does not need a free worker. The
+       subrequest is built from the request being filtered so it reaches
+       the same API version mounted under the same script name.
+    """
+
+    def __init__(self, app, req, context, log=None):
+        self.app = app
+        self.log = log
+        self.script_name = req.script_name
+        path = req.path_info
+        self.prefix = ''
+        for resource in ('/ports', '/ip_addresses'):
+            if resource in path:
+                self.prefix = path[:path.index(resource)]
+                break
+        self.context = context
+
+    def _get(self, resource, resource_id):
+        path = "%s/%s/%s" % (self.prefix, resource, resource_id)
+        sub = webob.Request.blank(path, method='GET',
+                                  environ={'SCRIPT_NAME': self.script_name})
+        sub.headers['Accept'] = 'application/json'
+        sub.environ['neutron.context'] = self.context
+        try:
+            resp = sub.get_response(self.app)
+        except Exception as e:
+            self.log.error("Internal GET of %s %s failed with %s" %
+                           (resource, resource_id, repr(e)))
+            return None, e
+        try:
+            return resp.status_code, resp.json
+        except ValueError:
+            return resp.status_code, resp.text
+
+    def ports(self, port_id=None, deadline=None):
+        return self._get('ports', port_id)
+
+    def ip_addresses(self, ip_address_id=None, deadline=None):
+        return self._get('ip_addresses', ip_address_id)
@@ -0,0 +1,368 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import collections
+import os
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+def fan_out(func, items, concurrency):
+    """Calls func on every item with at most concurrency calls in flight.
+
+       Returns the results in the order of items. A call that raises gets
+       (None, exception) as its result, like a failed connection call.
+    """
+    results = [None] * len(items)
+    work = queue.Queue()
+    for index, item in enumerate(items):
+        work.put((index, item))
+
+    def run():
+        while True:
+            try:
+                index, item = work.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                results[index] = func(item)
+            except Exception as e:
+                results[index] = (None, e)
+
+    count = min(max(concurrency, 1), len(items))
+    if count <= 1:
+        run()
+        return results
+    threads = [threading.Thread(target=run) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+class CallbackDispatcher(object):
+    """Delivers Nova callbacks from a bounded queue with a pool of workers.
+
+       send is called with the admin_virtual_interfaces keyword arguments
+       and must return (status, response) like the connection classes do.
+       Workers are plain threads, which become greenthreads when the
+       process is monkey patched by eventlet as neutron-server is. They are
+       started lazily so that a dispatcher built before a fork gets fresh
+       workers in every child.
+
+       With an outbox, callbacks are recorded durably before they are
+       queued and marked done once delivered. Undelivered callbacks left
+       behind by dead workers are replayed by a thread of their own when
+       the workers start, so a backlog larger than the queue never holds
+       up the request that started them. Every resend_interval seconds
+       that thread claims callbacks of workers that died since, and
+       resends this process' own callbacks that failed and are not
+       queued, which no other worker would replay while it lives.
+
+       With a coalesce_window, callbacks for one instance are held for that
+       many seconds and merged per port before they are queued: only the
+       last action for a port is sent, and a delete cancels a create made
+       for a new port that Nova has not been told about yet. At most
+       queue_size instances have a window open, a callback that would
+       open another is refused like one finding the queue full. Windows
+       that are due wait for room in the queue.
+
+       A callback may be submitted with a delivered function, called with
+       no arguments by the worker once Nova has accepted it. A merged
+       callback keeps the last one given for its port.
+    """
+
+    def __init__(self, send, log, workers=4, queue_size=1000, retries=3,
+                 retry_delay=0.5, outbox=None, coalesce_window=0,
+                 resend_interval=60):
+        self.send = send
+        self.log = log
+        self.outbox = outbox
+        self.resend_interval = resend_interval
+        self.in_flight = set()
+        self.coalesce_window = coalesce_window
+        self.windows = collections.OrderedDict()
+        self.windows_lock = threading.Lock()
+        self.workers = workers
+        self.queue_size = queue_size
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.pid = None
+        self.queue = None
+        self.threads = []
+        self.replayer = None
+        self.replayed = None
+        self.lock = threading.Lock()
+        self.submitted = 0
+        self.delivered = 0
+        self.failed = 0
+        self.dropped = 0
+        self.retried = 0
+        self.resent = 0
+        self.coalesced = 0
+        self.cancelled = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def start(self):
+        """Starts workers for this process, replaying the outbox once."""
+        pid = os.getpid()
+        if self.pid == pid:
+            return
+        with self.lock:
+            if self.pid == pid:
+                return
+            self.queue = queue.Queue(self.queue_size)
+            self.threads = []
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._work,
+                                          args=(self.queue,),
+                                          name="nova-callback-%d" % i)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+            if self.coalesce_window:
+                thread = threading.Thread(target=self._flush_windows,
+                                          name="nova-callback-coalesce")
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+            self.replayer = None
+            self.replayed = None
+            self.in_flight = set()
+            if self.outbox is not None:
+                self.replayed = threading.Event()
+                self.replayer = threading.Thread(
+                    target=self._replay, name="nova-callback-replay")
+                self.replayer.daemon = True
+                self.replayer.start()
+            self.pid = pid
+
+    def _replay(self):
+        try:
+            self._requeue(self.outbox.claim_orphans())
+        except Exception as e:
+            self.log.error("Could not replay the Nova callback outbox: "
+                           "%s" % repr(e))
+        finally:
+            self.replayed.set()
+        while self.resend_interval:
+            time.sleep(self.resend_interval)
+            try:
+                self._requeue(self.outbox.claim_orphans())
+                self.resent += self._requeue(
+                    self.outbox.undelivered(self.resend_interval))
+            except Exception as e:
+                self.log.error("Could not resend from the Nova callback "
+                               "outbox: %s" % repr(e))
+
+    def _requeue(self, entries):
+        """Queues outbox entries that are not already queued."""
+        entries = [(entry_id, callback) for entry_id, callback in entries
+                   if entry_id not in self.in_flight]
+        if entries:
+            self.log.info("Replaying %d Nova callbacks from the outbox" %
+                          len(entries))
+        for entry_id, callback in entries:
+            self.in_flight.add(entry_id)
+            # Waits for room, this thread is not on a request path
+            self.queue.put((time.time(), callback, [entry_id], None))
+            self.submitted += 1
+        return len(entries)
+
+    def submit(self, callback, fresh=False, delivered=None):
+        """Queues callback, returns False if the queue is full.
+
+           fresh says the callback creates a port Nova never heard of,
+           delivered is called once Nova has accepted it.
+        """
+        self.start()
+        entry_id = None
+        if self.outbox is not None:
+            try:
+                entry_id = self.outbox.append(callback)
+            except Exception:
+                self.log.error("Queueing Nova callback for instance %s "
+                               "without the outbox" %
+                               callback.get('instance_id'))
+        entry_ids = [entry_id] if entry_id is not None else []
+        self.in_flight.update(entry_ids)
+        if self.coalesce_window:
+            queued = self._coalesce(callback, entry_ids, fresh, delivered)
+        else:
+            try:
+                self.queue.put_nowait((time.time(), callback, entry_ids,
+                                       delivered))
+            except queue.Full:
+                queued = False
+            else:
+                queued = True
+                self.submitted += 1
+        if not queued:
+            self.dropped += 1
+            self.log.error("Nova callback queue is full, could not queue "
+                           "%s" % str(callback))
+            if entry_id is not None:
+                # The caller falls back to a synchronous call
+                self.in_flight.discard(entry_id)
+                self.outbox.done(entry_id)
+        return queued
+
+    def _coalesce(self, callback, entry_ids, fresh, delivered=None):
+        """Adds callback to its instance's window, False if none is open
+           and no more may be.
+        """
+        now = time.time()
+        port_id = callback.get('port_id')
+        done = []
+        with self.windows_lock:
+            window = self.windows.get(callback.get('instance_id'))
+            if window is None:
+                if len(self.windows) >= self.queue_size:
+                    return False
+                window = {"due": now + self.coalesce_window, "queued_at": now,
+                          "ports": collections.OrderedDict()}
+                self.windows[callback.get('instance_id')] = window
+            ports = window["ports"]
+            previous = ports.get(port_id)
+            if previous is None:
+                ports[port_id] = (callback, entry_ids, fresh, delivered)
+            elif (callback.get('action') == 'delete' and
+                  previous[0].get('action') == 'create' and previous[2]):
+                del ports[port_id]
+                done = previous[1] + entry_ids
+                self.cancelled += 2
+            else:
+                if callback.get('action') == 'create':
+                    fresh = previous[2]
+                ports[port_id] = (callback, previous[1] + entry_ids, fresh,
+                                  delivered)
+                self.coalesced += 1
+        for entry_id in done:
+            self._done(entry_id)
+        return True
+
+    def flush(self, force=False):
+        """Queues the callbacks of every window that is due, or all."""
+        now = time.time()
+        with self.windows_lock:
+            due = [k for k, w in self.windows.items()
+                   if force or w["due"] <= now]
+            windows = [self.windows.pop(k) for k in due]
+        for window in windows:
+            for callback, entry_ids, _, delivered in window["ports"].values():
+                # Waits for room, these were already accepted
+                self.queue.put((window["queued_at"], callback, entry_ids,
+                                delivered))
+                self.submitted += 1
+
+    def _flush_windows(self):
+        while True:
+            time.sleep(self.coalesce_window / 2.0)
+            self.flush()
+
+    def deliver(self, callback):
+        """Sends callback with retries, returns the last (status, resp)."""
+        attempt = 0
+        while True:
+            status, resp = self.send(**callback)
+            if status in (200, 204):
+                return status, resp
+            if attempt >= self.retries:
+                return status, resp
+            attempt += 1
+            self.retried += 1
+            self.log.debug("Retrying Nova callback for instance %s, attempt "
+                           "%d" % (callback.get('instance_id'), attempt))
+            # An open circuit says when it is worth probing Nova again
+            delay = getattr(resp, 'retry_after', None)
+            time.sleep(delay if delay else self.retry_delay * attempt)
+
+    def _work(self, work_queue):
+        while True:
+            queued_at, callback, entry_ids, delivered = work_queue.get()
+            try:
+                self._handle(queued_at, callback, entry_ids, delivered)
+            finally:
+                work_queue.task_done()
+
+    def _handle(self, queued_at, callback, entry_ids=(), delivered=None):
+        try:
+            status, resp = self.deliver(callback)
+        except Exception as e:
+            status, resp = None, e
+        latency = time.time() - queued_at
+        self.latency_total += latency
+        self.latency_max = max(self.latency_max, latency)
+        if status in (200, 204):
+            self.delivered += 1
+            for entry_id in entry_ids:
+                self._done(entry_id)
+            if delivered is not None:
+                try:
+                    delivered()
+                except Exception as e:
+                    self.log.error("Nova callback for instance %s was "
+                                   "delivered, but handling that failed: "
+                                   "%s" % (callback.get('instance_id'),
+                                           repr(e)))
+        else:
+            self.failed += 1
+            # Left in the outbox for the replayer to resend
+            self.in_flight.difference_update(entry_ids)
+            self.log.error("Nova callback for instance %s failed with "
+                           "%s %s" % (callback.get('instance_id'), status,
+                                      resp))
+
+    def _done(self, entry_id):
+        self.in_flight.discard(entry_id)
+        try:
+            self.outbox.done(entry_id)
+        except Exception as e:
+            self.log.error("Could not mark outbox entry %s done: %s" %
+                           (entry_id, repr(e)))
+
+    def join(self):
+        """Blocks until every queued callback has been handled."""
+        if self.replayed is not None:
+            self.replayed.wait()
+        if self.coalesce_window:
+            self.flush(force=True)
+        if self.queue is not None:
+            self.queue.join()
+
+    def stats(self):
+        done = self.delivered + self.failed
+        return {"queue_depth": self.queue.qsize() if self.queue else 0,
+                "queue_size": self.queue_size,
+                "workers": self.workers,
+                "submitted": self.submitted,
+                "delivered": self.delivered,
+                "failed": self.failed,
+                "dropped": self.dropped,
+                "retried": self.retried,
+                "resent": self.resent,
+                "coalesced": self.coalesced,
+                "cancelled": self.cancelled,
+                "windows": len(self.windows),
+                "latency_avg": self.latency_total / done if done else 0.0,
+                "latency_max": self.latency_max,
+                "outbox": self.outbox.stats() if self.outbox else None}
@@ -0,0 +1,206 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""Stand-ins for Nova and Neutron to exercise NovaInteraction offline.
+
+FakeCloud keeps ports in memory and answers the calls NovaInteraction
+makes: admin-virtual-interfaces on the Nova side and /v2.0/ports on the
+Neutron side. FakeServer serves it over keep-alive HTTP from a thread of
+the current process, and FakeCloud.neutron_app is the Neutron API the
+middleware wraps. Only the standard library and webob are needed.
+"""
+
+import json
+import random
+import re
+import threading
+import time
+import uuid
+
+from webob.dec import wsgify
+from webob import Response
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler
+    from BaseHTTPServer import HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import BaseHTTPRequestHandler
+    from http.server import HTTPServer
+    from socketserver import ThreadingMixIn
+
+
+_VIF_PATH = re.compile(r"^/v2/([^/]+)/servers/([^/]+)/"
+                       r"admin-virtual-interfaces/([^/]+)/?$")
+_PORTS_PATH = re.compile(r"^(?:/v2\.0|/v2)?/ports/?$")
+_PORT_PATH = re.compile(r"^(?:/v2\.0|/v2)?/ports/([^/]+)/?$")
+
+
+class FakeCloud(object):
+    """In memory ports plus Nova's admin-virtual-interfaces.
+
+       Every answer is delayed by latency seconds plus up to jitter more,
+       and error_rate of them, chosen with a generator seeded by seed, are
+       500s instead. Ports are created by POSTs to neutron_app or with
+       add_port.
+    """
+
+    def __init__(self, latency=0, jitter=0, error_rate=0, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.ports = {}
+        self.vifs = {}
+        self.counts = {"requests": 0, "errors": 0, "connections": 0,
+                       "vif_calls": 0, "port_lookups": 0}
+
+    def _count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+    def _delay_and_fail(self):
+        with self.lock:
+            delay = self.latency + self.random.random() * self.jitter
+            fail = self.random.random() < self.error_rate
+        if delay:
+            time.sleep(delay)
+        if fail:
+            self._count("errors")
+        return fail
+
+    def add_port(self, **fields):
+        port = {"id": str(uuid.uuid4()),
+                "mac_address": "fa:16:3e:%02x:%02x:%02x" % tuple(
+                    self.random.randint(0, 255) for _ in range(3)),
+                "fixed_ips": [],
+                "instance_id": None,
+                "network_id": None,
+                "tenant_id": None}
+        port.update(fields)
+        with self.lock:
+            self.ports[port["id"]] = port
+        return dict(port)
+
+    def handle(self, method, path, body=None):
+        """Returns (status, body) for one Nova or Neutron call."""
+        self._count("requests")
+        method = method.upper()
+        data = json.loads(body) if body else {}
+        vif = _VIF_PATH.match(path)
+        if vif and method == "PUT":
+            self._count("vif_calls")
+            if self._delay_and_fail():
+                return 500, {"error": "injected failure"}
+            with self.lock:
+                self.vifs[vif.group(3)] = data.get("virtual_interface")
+            return 200, {"virtual_interface": data.get("virtual_interface")}
+        if _PORTS_PATH.match(path) and method == "POST":
+            return 201, {"port": self.add_port(**data.get("port", {}))}
+        port = _PORT_PATH.match(path)
+        if port is None:
+            return 404, {"error": "no such resource"}
+        port_id = port.group(1)
+        if method == "GET":
+            self._count("port_lookups")
+            if self._delay_and_fail():
+                return 500, {"error": "injected failure"}
+        with self.lock:
+            if port_id not in self.ports:
+                return 404, {"error": "no such port"}
+            if method == "DELETE":
+                del self.ports[port_id]
+                return 204, None
+            if method == "PUT":
+                self.ports[port_id].update(data.get("port", {}))
+            return 200, {"port": dict(self.ports[port_id])}
+
+    @wsgify
+    def neutron_app(self, req):
+        status, body = self.handle(req.method, req.path_info, req.body)
+        resp = Response(status=status, content_type="application/json")
+        resp.body = json.dumps(body) if body is not None else ""
+        return resp
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counts, ports=len(self.ports))
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Send each response in one write so keep-alive connections do not
+    # wait on delayed ACKs
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.cloud._count("connections")
+
+    def _serve(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else None
+        status, data = self.server.cloud.handle(self.command, self.path,
+                                                body)
+        payload = b""
+        if data is not None:
+            payload = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    do_GET = do_PUT = do_POST = do_DELETE = _serve
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+class FakeServer(object):
+    """Serves cloud on an ephemeral localhost port from a daemon thread.
+
+       url is where the server listens. Usable as a context manager.
+    """
+
+    def __init__(self, cloud, host="127.0.0.1", port=0):
+        self.cloud = cloud
+        self.server = _ThreadingServer((host, port), _Handler)
+        self.server.cloud = cloud
+        self.url = "http://%s:%d" % self.server.server_address[:2]
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
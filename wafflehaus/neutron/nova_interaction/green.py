@@ -0,0 +1,200 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import collections
+import errno
+import json
+import os
+import socket
+
+try:
+    from urllib.parse import urlsplit
+except ImportError:
+    from urlparse import urlsplit
+
+
+class GreenResponse(object):
+    """The parts of a requests.Response that BaseConnection looks at."""
+
+    def __init__(self, status_code, content, headers):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', 'replace')
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class GreenSessionPool(object):
+    """A SessionPool look-alike built on eventlet's green httplib.
+
+       Sockets, DNS lookups (through dnspython) and TLS handshakes always
+       yield to other greenthreads, whether or not the process has been
+       monkey patched, so a slow Nova never stalls the whole worker.
+       Up to pool_maxsize idle keep-alive connections are kept for each of
+       the pool_connections most recently used hosts. A call on an idle
+       connection the other end has since closed is made once more on a
+       new connection, as urllib3 does for requests.
+    """
+
+    def __init__(self, name, pool_connections=10, pool_maxsize=10):
+        import eventlet
+        from eventlet.green import ssl
+        from eventlet.green import httplib
+        self.eventlet = eventlet
+        self.ssl = ssl
+        self.httplib = httplib
+        self.name = name
+        self.pid = os.getpid()
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.idle = collections.OrderedDict()
+        self.hosts = {}
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+
+    def _context(self, verify):
+        context = self.ssl.create_default_context()
+        if verify is False:
+            context.check_hostname = False
+            context.verify_mode = self.ssl.CERT_NONE
+        elif verify not in (True, None):
+            context.load_verify_locations(cafile=verify)
+        return context
+
+    def _checkout(self, host, verify):
+        """Returns an idle connection to host, else a new one."""
+        idle = self.idle.get(host)
+        if idle:
+            return idle.pop()
+        return self._connection(host, verify)
+
+    def _connection(self, host, verify):
+        scheme, netloc = host
+        self.hosts.setdefault(host, {"connections_opened": 0, "requests": 0})
+        self.hosts[host]["connections_opened"] += 1
+        if scheme == 'https':
+            return self.httplib.HTTPSConnection(netloc,
+                                                context=self._context(verify))
+        return self.httplib.HTTPConnection(netloc)
+
+    def _checkin(self, host, conn):
+        idle = self.idle.pop(host, [])
+        self.idle[host] = idle
+        if len(idle) < self.pool_maxsize:
+            idle.append(conn)
+        else:
+            conn.close()
+        while len(self.idle) > self.pool_connections:
+            for stale in self.idle.popitem(last=False)[1]:
+                stale.close()
+
+    def request(self, method, url=None, headers=None, data=None, verify=True,
+                timeout=None):
+        parts = urlsplit(url)
+        host = (parts.scheme, parts.netloc)
+        path = parts.path or '/'
+        if parts.query:
+            path = "%s?%s" % (path, parts.query)
+        connect, read = timeout if isinstance(timeout, tuple) else (
+            timeout, timeout)
+        conn = self._checkout(host, verify)
+        self.calls += 1
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        try:
+            reused = conn.sock is not None
+            try:
+                resp, content = self._send(conn, parts.netloc, method, path,
+                                           data, headers, connect, read)
+            except Exception as e:
+                if not reused or not self._closed_idle(e):
+                    raise
+                conn.close()
+                self.retries += 1
+                conn = self._connection(host, verify)
+                resp, content = self._send(conn, parts.netloc, method, path,
+                                           data, headers, connect, read)
+        except Exception:
+            self.errors += 1
+            conn.close()
+            raise
+        finally:
+            self.in_flight -= 1
+        self.hosts[host]["requests"] += 1
+        if resp.will_close:
+            conn.close()
+        else:
+            self._checkin(host, conn)
+        return GreenResponse(resp.status, content, dict(resp.getheaders()))
+
+    def _send(self, conn, netloc, method, path, data, headers, connect,
+              read):
+        """Makes one call on conn, returns its response and content."""
+        if conn.sock is None:
+            error = IOError("Connecting to %s timed out" % netloc)
+            with self.eventlet.Timeout(connect, error):
+                conn.connect()
+        conn.sock.settimeout(read)
+        conn.request(method, path, body=data, headers=headers or {})
+        resp = conn.getresponse()
+        return resp, resp.read()
+
+    def _closed_idle(self, error):
+        """Returns whether error is a kept-alive connection found closed
+           before any of the response came back.
+        """
+        if isinstance(error, socket.timeout):
+            return False
+        if isinstance(error, self.httplib.BadStatusLine):
+            # Python 3 raises RemoteDisconnected, Python 2 gives the empty
+            # line read, or in later releases says the server closed it
+            return (isinstance(error, getattr(self.httplib,
+                                              'RemoteDisconnected', ())) or
+                    error.line in ("", "''") or
+                    error.line.startswith("No status line received"))
+        return (isinstance(error, (socket.error, IOError, OSError)) and
+                getattr(error, 'errno', None) in (errno.ECONNRESET,
+                                                  errno.EPIPE,
+                                                  errno.ECONNABORTED))
+
+    def stats(self):
+        hosts = {}
+        for (scheme, netloc), counts in self.hosts.items():
+            idle = self.idle.get((scheme, netloc), [])
+            hosts["%s://%s" % (scheme, netloc)] = dict(counts, idle=len(idle))
+        return {"pid": self.pid,
+                "backend": "eventlet",
+                "calls": self.calls,
+                "errors": self.errors,
+                "retries": self.retries,
+                "in_flight": self.in_flight,
+                "peak_in_flight": self.peak_in_flight,
+                "pool_connections": self.pool_connections,
+                "pool_maxsize": self.pool_maxsize,
+                "hosts": hosts}
+
+    def close(self):
+        for idle in self.idle.values():
+            for conn in idle:
+                conn.close()
+        self.idle.clear()
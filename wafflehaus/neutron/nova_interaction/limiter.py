@@ -0,0 +1,115 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import threading
+import time
+
+
+class LimitExceededError(Exception):
+    """Raised instead of calling out when no concurrency slot freed up."""
+
+
+class AdaptiveLimiter(object):
+    """Caps the calls in flight with a limit that follows observed latency.
+
+       The limit grows by about one per round trip while calls come back
+       within tolerance times the fastest recent call, and is multiplied
+       by backoff when a call is slower than that or fails (AIMD). The
+       fastest call is relearned every relearn calls so the baseline can
+       follow a Nova that got slower for good.
+
+       A call over the limit waits up to max_wait seconds for a slot and
+       is shed with LimitExceededError after that. With green set the wait
+       yields to other greenthreads even without monkey patching.
+    """
+
+    def __init__(self, log, initial=10, minimum=1, maximum=100,
+                 tolerance=2.0, backoff=0.9, max_wait=0, relearn=500,
+                 green=False):
+        self.log = log
+        self.limit = float(max(minimum, min(initial, maximum)))
+        self.minimum = minimum
+        self.maximum = maximum
+        self.tolerance = tolerance
+        self.backoff = backoff
+        self.max_wait = max_wait
+        self.relearn = relearn
+        if green:
+            from eventlet.green import threading as green_threading
+            self.cond = green_threading.Condition()
+        else:
+            self.cond = threading.Condition()
+        self.in_flight = 0
+        self.min_rtt = None
+        self.samples = 0
+        self.admitted = 0
+        self.queued = 0
+        self.rejected = 0
+        self.decreases = 0
+
+    def acquire(self, deadline=None):
+        """Takes a slot or raises LimitExceededError."""
+        with self.cond:
+            if self.in_flight >= int(self.limit):
+                wait_until = time.time() + self.max_wait
+                if deadline is not None:
+                    wait_until = min(wait_until, deadline)
+                self.queued += 1
+                while self.in_flight >= int(self.limit):
+                    remaining = wait_until - time.time()
+                    if remaining <= 0:
+                        self.rejected += 1
+                        raise LimitExceededError(
+                            "%d calls already in flight" % self.in_flight)
+                    self.cond.wait(remaining)
+            self.in_flight += 1
+            self.admitted += 1
+
+    def release(self, elapsed=None, success=True):
+        """Frees a slot, elapsed None means the call never went out."""
+        with self.cond:
+            self.in_flight -= 1
+            if elapsed is not None:
+                self._adjust(elapsed, success)
+            self.cond.notify()
+
+    def _adjust(self, elapsed, success):
+        self.samples += 1
+        if self.relearn and self.samples % self.relearn == 0:
+            self.min_rtt = None
+        if success and (self.min_rtt is None or elapsed < self.min_rtt):
+            self.min_rtt = elapsed
+        overloaded = not success or (
+            self.min_rtt is not None and
+            elapsed > self.tolerance * max(self.min_rtt, 0.001))
+        if overloaded:
+            limit = max(self.minimum, self.limit * self.backoff)
+            if int(limit) < int(self.limit):
+                self.decreases += 1
+                self.log.debug("Concurrency limit lowered to %d after a "
+                               "%.3fs call" % (limit, elapsed))
+            self.limit = limit
+        elif self.in_flight + 1 >= int(self.limit) / 2:
+            # Only grow when the limit is actually being used
+            self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+
+    def stats(self):
+        return {"limit": int(self.limit),
+                "in_flight": self.in_flight,
+                "min_rtt": self.min_rtt,
+                "admitted": self.admitted,
+                "queued": self.queued,
+                "rejected": self.rejected,
+                "decreases": self.decreases}
@@ -0,0 +1,219 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import binascii
+import errno
+import json
+import os
+import threading
+import time
+
+
+_SCHEMA = ("CREATE TABLE IF NOT EXISTS callbacks ("
+           "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+           "body TEXT NOT NULL, "
+           "created REAL NOT NULL, "
+           "owner TEXT NOT NULL, "
+           "done INTEGER NOT NULL DEFAULT 0)")
+
+
+def _owner_pid(owner):
+    """Returns the pid of an owner, written as 'pid:token'."""
+    return int(str(owner).partition(':')[0])
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+class Outbox(object):
+    """Durable SQLite log of Nova callbacks that have not been delivered.
+
+       Entries are appended before a callback is dispatched and marked done
+       once Nova accepted it. Appends use group commit: whichever caller
+       finds no write in progress writes every pending entry in a single
+       transaction, so concurrent requests share one fsync. Each entry is
+       owned by the process that wrote it, by its pid and a token drawn
+       when it first used the outbox, and entries of dead owners are
+       claimed for replay, which lets every worker share one file. The
+       token tells a worker restarted with its predecessor's pid, as in a
+       pid namespace, from the predecessor.
+    """
+
+    def __init__(self, path, log, compact_every=100):
+        self.path = path
+        self.log = log
+        self.compact_every = compact_every
+        self.pid = None
+        self.owner = None
+        self.db = None
+        self.db_lock = threading.Lock()
+        self.cond = threading.Condition(threading.Lock())
+        self.pending = []
+        self.flushing = False
+        self.appended = 0
+        self.batches = 0
+        self.completed = 0
+        self.compactions = 0
+        self._since_compact = 0
+
+    def _connect(self):
+        """Returns this process' connection, sqlite ones can't cross forks."""
+        pid = os.getpid()
+        if self.pid != pid:
+            import sqlite3
+            db = sqlite3.connect(self.path, check_same_thread=False,
+                                 isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=FULL")
+            db.execute(_SCHEMA)
+            self.db = db
+            self.owner = "%d:%s" % (pid, binascii.hexlify(
+                os.urandom(8)).decode('ascii'))
+            self.pid = pid
+        return self.db
+
+    def append(self, callback):
+        """Durably records callback and returns its outbox id."""
+        entry = {"body": json.dumps(callback), "id": None, "error": None}
+        with self.cond:
+            self.pending.append(entry)
+            while entry["id"] is None and entry["error"] is None:
+                if self.flushing:
+                    self.cond.wait()
+                else:
+                    self._flush_pending()
+        if entry["error"] is not None:
+            raise entry["error"]
+        return entry["id"]
+
+    def _flush_pending(self):
+        """Writes every pending entry, called with self.cond held."""
+        self.flushing = True
+        batch, self.pending = self.pending, []
+        self.cond.release()
+        try:
+            try:
+                self._write(batch)
+            except Exception as e:
+                self.log.error("Could not write %d callbacks to the outbox "
+                               "%s: %s" % (len(batch), self.path, repr(e)))
+                for entry in batch:
+                    entry["error"] = e
+        finally:
+            self.cond.acquire()
+            self.flushing = False
+            self.cond.notify_all()
+
+    def _write(self, batch):
+        now = time.time()
+        with self.db_lock:
+            db = self._connect()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                for entry in batch:
+                    cursor = db.execute(
+                        "INSERT INTO callbacks (body, created, owner) "
+                        "VALUES (?, ?, ?)", (entry["body"], now, self.owner))
+                    entry["id"] = cursor.lastrowid
+            except Exception:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+        self.appended += len(batch)
+        self.batches += 1
+
+    def done(self, entry_id):
+        """Marks entry_id delivered, compacting every compact_every."""
+        with self.db_lock:
+            db = self._connect()
+            db.execute("UPDATE callbacks SET done = 1 WHERE id = ?",
+                       (entry_id,))
+            self.completed += 1
+            self._since_compact += 1
+            if self._since_compact >= self.compact_every:
+                self._compact(db)
+
+    def compact(self):
+        with self.db_lock:
+            self._compact(self._connect())
+
+    def _compact(self, db):
+        db.execute("DELETE FROM callbacks WHERE done = 1")
+        self._since_compact = 0
+        self.compactions += 1
+
+    def claim_orphans(self):
+        """Takes over undelivered entries whose owner died.
+
+           Returns a list of (id, callback) in the order they were written.
+        """
+        with self.db_lock:
+            db = self._connect()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                owners = [row[0] for row in db.execute(
+                    "SELECT DISTINCT owner FROM callbacks WHERE done = 0")]
+                dead = [o for o in owners if self._dead(o)]
+                rows = []
+                for owner in dead:
+                    rows.extend(db.execute(
+                        "SELECT id, body FROM callbacks WHERE owner = ? AND "
+                        "done = 0", (owner,)).fetchall())
+                    db.execute("UPDATE callbacks SET owner = ? WHERE "
+                               "owner = ? AND done = 0", (self.owner, owner))
+            except Exception:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+        return [(entry_id, json.loads(body)) for entry_id, body in
+                sorted(rows)]
+
+    def undelivered(self, age):
+        """Returns this process' entries still undelivered age seconds
+           after they were written, as a list of (id, callback).
+        """
+        with self.db_lock:
+            db = self._connect()
+            rows = db.execute(
+                "SELECT id, body FROM callbacks WHERE owner = ? AND "
+                "done = 0 AND created <= ? ORDER BY id",
+                (self.owner, time.time() - age)).fetchall()
+        return [(entry_id, json.loads(body)) for entry_id, body in rows]
+
+    def _dead(self, owner):
+        """Returns whether the process owner names has exited.
+
+           An owner with this process' pid but not its token was an earlier
+           process.
+        """
+        if owner == self.owner:
+            return False
+        pid = _owner_pid(owner)
+        return pid == self.pid or not _pid_alive(pid)
+
+    def stats(self):
+        with self.db_lock:
+            pending = self._connect().execute(
+                "SELECT COUNT(*) FROM callbacks WHERE done = 0").fetchone()[0]
+        return {"pending": pending,
+                "appended": self.appended,
+                "batches": self.batches,
+                "completed": self.completed,
+                "compactions": self.compactions}
@@ -0,0 +1,94 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import threading
+import time
+
+from wafflehaus.neutron.nova_interaction import breaker as cb
+
+
+class _Call(object):
+    def __init__(self, event):
+        self.event = event
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight(object):
+    """Lets concurrent callers asking for the same key share one call.
+
+       The first caller for a key runs func, callers arriving while it is
+       in flight wait for it and get the same result, or the same
+       exception. Nothing is kept once the call returns, so this only
+       deduplicates and never serves stale answers. Results are shared
+       between callers and must not be modified.
+
+       A deadline keyword argument is passed on to func and also bounds
+       how long a caller waits for a call in flight; one that runs out gets
+       (None, DeadlineExceededError) like a connection call past its
+       deadline.
+
+       With green set waiting yields to other greenthreads even without
+       monkey patching.
+    """
+
+    def __init__(self, green=False):
+        if green:
+            from eventlet.green import threading as green_threading
+            self.event_class = green_threading.Event
+        else:
+            self.event_class = threading.Event
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.leaders = 0
+        self.shared = 0
+
+    def do(self, key, func, *args, **kwargs):
+        """Returns func(*args, **kwargs), sharing any call in flight."""
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call(self.event_class())
+                self.calls[key] = call
+                self.leaders += 1
+            else:
+                call.waiters += 1
+                self.shared += 1
+        if not leader:
+            deadline = kwargs.get('deadline')
+            if deadline is None:
+                call.event.wait()
+            elif not call.event.wait(deadline - time.time()):
+                return None, cb.DeadlineExceededError(
+                    "Deadline passed waiting for a shared call")
+        else:
+            try:
+                call.result = func(*args, **kwargs)
+            except Exception as e:
+                call.error = e
+            finally:
+                with self.lock:
+                    del self.calls[key]
+                call.event.set()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def stats(self):
+        return {"in_flight": len(self.calls),
+                "calls": self.leaders,
+                "shared": self.shared}
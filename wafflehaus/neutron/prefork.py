@@ -0,0 +1,64 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+import contextlib
+import gc
+import os
+
+
+# The process whose heap was frozen, and how many hosts are building
+_frozen_pid = None
+_hosting = 0
+
+
+def freeze_supported():
+    return hasattr(gc, 'freeze')
+
+
+@contextlib.contextmanager
+def hosting():
+    """Builds the filters another hosts without freezing for each of them,
+       the host freezes once when they are all built.
+    """
+    global _hosting
+    _hosting += 1
+    try:
+        yield
+    finally:
+        _hosting -= 1
+
+
+def warm_up(filter):
+    """Finishes filter in the process neutron-server forks workers from.
+
+       An enabled filter's warm_up, if it has one, loads what its first
+       requests would, so workers share it copy-on-write instead of each
+       building its own. Unless gc_freeze is false, the heap is then
+       collected and, where Python has gc.freeze, moved out of the
+       collector's reach, so collections in a worker never write to the
+       pages it shares with the parent. That is done once per process.
+       Returns filter.
+    """
+    global _frozen_pid
+    if not filter.enabled:
+        return filter
+    if hasattr(filter, 'warm_up'):
+        filter.warm_up()
+    if (_hosting or _frozen_pid == os.getpid() or not freeze_supported() or
+            filter.conf.get('gc_freeze', True) not in filter.truths):
+        return filter
+    gc.collect()
+    gc.freeze()
+    _frozen_pid = os.getpid()
+    return filter
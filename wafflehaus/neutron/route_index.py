@@ -0,0 +1,239 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+import re
+import threading
+
+from routes import Mapper
+import webob.dec
+
+
+MATCH_KEY = 'wafflehaus.neutron.route_matches'
+_VARIABLE = re.compile(r'^(?:\{\w+\}|:\w+)(?:\{\.format\})?$')
+_FORMAT = '{.format}'
+
+
+class _Node(object):
+    __slots__ = ('children', 'formats', 'variable', 'entries', 'fallbacks')
+
+    def __init__(self):
+        self.children = {}
+        self.formats = {}
+        self.variable = None
+        self.entries = []
+        self.fallbacks = []
+
+
+class RouteIndex(object):
+    """Matches a request against the resources of many filters at once.
+
+       Resources are given as rf.parse_resources returns them, mapping a
+       routes path template to the methods it is for. Templates are
+       compiled into a trie of path segments, so a match walks the path
+       once however many templates there are. Segments of a literal, a
+       {name} or :name variable, either followed by {.format}, are
+       matched as routes would match them. A template with any other
+       segment is matched with its own routes Mapper, once the path got
+       to that segment. A template of None matches every path.
+    """
+
+    def __init__(self):
+        self.root = _Node()
+        self.any_path = []
+        self.mappers = {}
+        self.generation = 0
+
+    def add(self, template, methods, value):
+        """Makes match return value for methods on template's paths.
+
+           methods of None means every method.
+        """
+        if methods is not None:
+            methods = frozenset(m.upper() for m in methods)
+        entry = (methods, value)
+        self.generation += 1
+        if template is None:
+            self.any_path.append(entry)
+            return
+        node = self.root
+        for segment in template.split('/'):
+            if '{' not in segment and ':' not in segment and (
+                    '*' not in segment):
+                node = node.children.setdefault(segment, _Node())
+            elif segment.endswith(_FORMAT) and '{' not in segment[
+                    :-len(_FORMAT)] and ':' not in segment and (
+                    '*' not in segment):
+                node = node.formats.setdefault(segment[:-len(_FORMAT)],
+                                               _Node())
+            elif _VARIABLE.match(segment):
+                if node.variable is None:
+                    node.variable = _Node()
+                node = node.variable
+            else:
+                if template not in self.mappers:
+                    mapper = Mapper()
+                    mapper.connect(None, template)
+                    # Compiled now, before any worker is forked
+                    mapper.create_regs()
+                    self.mappers[template] = (mapper, [])
+                    node.fallbacks.append(self.mappers[template])
+                self.mappers[template][1].append(entry)
+                return
+        node.entries.append(entry)
+
+    def add_resources(self, resources, value):
+        for template, methods in resources.items():
+            self.add(template, methods, value)
+
+    def _collect(self, entries, method, values):
+        for methods, value in entries:
+            if methods is None or method in methods:
+                values.add(value)
+
+    def match(self, method, path):
+        """Returns the set of values added for method and path."""
+        method = method.upper()
+        values = set()
+        self._collect(self.any_path, method, values)
+        nodes = [self.root]
+        for segment in path.split('/'):
+            next_nodes = []
+            for node in nodes:
+                for mapper, entries in node.fallbacks:
+                    if mapper.routematch(path) is not None:
+                        self._collect(entries, method, values)
+                child = node.children.get(segment)
+                if child is not None:
+                    next_nodes.append(child)
+                if node.formats:
+                    child = node.formats.get(segment)
+                    if child is None:
+                        base, dot, extension = segment.rpartition('.')
+                        if dot and extension:
+                            child = node.formats.get(base)
+                    if child is not None:
+                        next_nodes.append(child)
+                if node.variable is not None and segment:
+                    next_nodes.append(node.variable)
+            nodes = next_nodes
+            if not nodes:
+                return values
+        for node in nodes:
+            for mapper, entries in node.fallbacks:
+                if mapper.routematch(path) is not None:
+                    self._collect(entries, method, values)
+            self._collect(node.entries, method, values)
+        return values
+
+
+_shared = RouteIndex()
+_shared_lock = threading.Lock()
+_keys = [0]
+
+
+def register(resources, methods=None):
+    """Adds resources to the index every filter shares, returning a key.
+
+       matched(req, key) is then whether req is for resources. None for
+       resources means every path, limited to methods if given.
+    """
+    with _shared_lock:
+        _keys[0] += 1
+        key = _keys[0]
+        if resources is None:
+            _shared.add(None, methods, key)
+        else:
+            _shared.add_resources(resources, key)
+    return key
+
+
+def matches(req):
+    """Returns the keys of the registered resources req is for.
+
+       The result is kept in req's environ for every filter it passes,
+       until the method, path or registered resources change.
+    """
+    environ = req.environ
+    # The raw environ values are cheaper to compare than req.path
+    raw = (environ.get('REQUEST_METHOD'), environ.get('SCRIPT_NAME'),
+           environ.get('PATH_INFO'))
+    cached = environ.get(MATCH_KEY)
+    if cached is not None and cached[0] == _shared.generation and (
+            cached[1] == raw):
+        return cached[2]
+    keys = _shared.match(req.method, req.path)
+    environ[MATCH_KEY] = (_shared.generation, raw, keys)
+    return keys
+
+
+def matched(req, key):
+    """Returns whether req is for the resources registered as key."""
+    return key in matches(req)
+
+
+def static_prefix(template):
+    """Returns the literal start every path matching template has."""
+    for i, c in enumerate(template):
+        if c in '{:*':
+            return template[:i]
+    return template
+
+
+class PathFilter(object):
+    """Rules out requests for other resources from the raw WSGI environ.
+
+       It tests the method and the literal start of each template, so a
+       request it lets through may still not match resources. None for
+       resources lets every path through, limited to methods if given.
+    """
+
+    def __init__(self, resources, methods=None):
+        prefixes = {}
+        if resources is None:
+            prefixes[''] = methods
+        else:
+            for template, template_methods in resources.items():
+                prefix = static_prefix(template)
+                known = prefixes.setdefault(prefix, set())
+                known.update(m.upper() for m in template_methods)
+        self.prefixes = tuple(
+            (prefix, None if methods is None else frozenset(methods))
+            for prefix, methods in sorted(prefixes.items()))
+
+    def __call__(self, environ):
+        method = environ.get('REQUEST_METHOD', 'GET')
+        path = environ.get('SCRIPT_NAME', '') + environ.get('PATH_INFO', '')
+        for prefix, methods in self.prefixes:
+            if path.startswith(prefix) and (methods is None or
+                                            method in methods):
+                return True
+        return False
+
+
+class wsgify(webob.dec.wsgify):
+    """webob's wsgify for the __call__ of a WafflehausBase filter.
+
+       A WSGI call the filter's fast_path rules out, or any while it is
+       disabled, goes straight to the filter's app without a Request
+       being built. Filters reconfigurable by header always take the
+       full path, as do calls made with a Request.
+    """
+
+    def __call__(self, req, *args, **kw):
+        if isinstance(req, dict) and len(args) == 1:
+            filter = getattr(self.func, '__self__', None)
+            if filter is not None and not filter.reconfigure and (
+                    not filter.enabled or not filter.fast_path(req)):
+                return filter.app(req, args[0])
+        return super(wsgify, self).__call__(req, *args, **kw)
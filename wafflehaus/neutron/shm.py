@@ -0,0 +1,330 @@
+# Copyright 2013 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+import fcntl
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+import zlib
+
+
+MAGIC = b'WHSHM001'
+# Magic, slots, slot size, ways, stripes
+_HEADER = struct.Struct('<8sIIII')
+_HEADER_SIZE = 64
+# Version, crc of key and value, key hash, key length, value length, expiry
+_SLOT = struct.Struct('<IIIHHd')
+_VERSION = struct.Struct('<I')
+# A slot's fields after its version
+_SLOT_REST = struct.Struct('<IIHHd')
+_EMPTY = 0.0
+_READ_ATTEMPTS = 3
+
+
+def _hash(key):
+    return zlib.crc32(key) & 0xffffffff
+
+
+class SharedTable(object):
+    """A fixed-size hash table in a memory-mapped file.
+
+       Keys and values are byte strings. A key hashes to one bucket of
+       ways slots and lives in one of them, so a lookup reads at most
+       ways slots and a full bucket evicts the entry closest to expiry.
+       Readers take no lock: each slot has a version a writer makes odd
+       while it writes, and a read seeing it odd or changed, or data not
+       matching the slot's crc, is retried. Writers lock one of stripes
+       locks, a thread lock and a byte range lock of the file, so the
+       table is shared by threads and by processes. A slot left odd by a
+       writer that was killed is missed by readers until it is written
+       again, which makes its version even.
+
+       Processes forked after the table is built share it, as do
+       processes opening the same path with the same geometry. Opening a
+       path made for another geometry raises ValueError, the file is left
+       as it is for whoever still maps it. Without a path the file is
+       unlinked as soon as it is mapped.
+    """
+
+    def __init__(self, path=None, slots=4096, slot_size=256, ways=8,
+                 stripes=64):
+        if slot_size <= _SLOT.size:
+            raise ValueError("Shared table slots must be larger than %d "
+                             "bytes" % _SLOT.size)
+        self.ways = max(1, ways)
+        self.buckets = max(1, (slots + self.ways - 1) // self.ways)
+        self.slots = self.buckets * self.ways
+        self.slot_size = slot_size
+        self.stripes = max(1, stripes)
+        self.length = _HEADER_SIZE + self.slots * self.slot_size
+        # The key hash and expiry of every slot of a bucket, in one call
+        self.bucket_fields = struct.Struct('<' + ('8xI4xd%dx' % (
+            slot_size - _SLOT.size)) * self.ways)
+        self.path = path
+        if path is None:
+            directory = '/dev/shm' if os.path.isdir('/dev/shm') else None
+            fd, path = tempfile.mkstemp(prefix='wafflehaus-', dir=directory)
+            os.unlink(path)
+        else:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        self.fd = fd
+        try:
+            self._open()
+        except Exception:
+            os.close(fd)
+            raise
+        self.pid = None
+        self._thread_locks()
+        self.expired = 0
+        self.evictions = 0
+        self.oversize = 0
+        self.retries = 0
+
+    def _open(self):
+        header = _HEADER.pack(MAGIC, self.slots, self.slot_size, self.ways,
+                              self.stripes)
+        # The byte after the stripes' guards the file's initialization
+        fcntl.lockf(self.fd, fcntl.LOCK_EX, 1, self.stripes)
+        try:
+            size = os.fstat(self.fd).st_size
+            os.lseek(self.fd, 0, os.SEEK_SET)
+            current = os.read(self.fd, _HEADER.size)
+            # Other processes may have it mapped, so only a file nobody
+            # finished initializing is sized and written
+            if current.strip(b'\0'):
+                self._check(current, header, size)
+            else:
+                os.ftruncate(self.fd, self.length)
+                os.lseek(self.fd, 0, os.SEEK_SET)
+                os.write(self.fd, header)
+            self.map = mmap.mmap(self.fd, self.length)
+        finally:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN, 1, self.stripes)
+
+    def _check(self, current, header, size):
+        """Raises ValueError unless current is header, for a file of
+           the table's length.
+        """
+        if current == header and size >= self.length:
+            return
+        wanted = ("%d slots of %d bytes, %d ways, %d stripes" %
+                  (self.slots, self.slot_size, self.ways, self.stripes))
+        if len(current) < _HEADER.size or (
+                _HEADER.unpack(current)[0] != MAGIC):
+            raise ValueError("%s is not a shared table, wanted %s" %
+                             (self.path, wanted))
+        _, slots, slot_size, ways, stripes = _HEADER.unpack(current)
+        raise ValueError("Shared table %s holds %d slots of %d bytes, %d "
+                         "ways, %d stripes, wanted %s" %
+                         (self.path, slots, slot_size, ways, stripes,
+                          wanted))
+
+    def _thread_locks(self):
+        # A forked child gets copies of its parent's thread locks, maybe
+        # held by a thread it does not have
+        self.locks = [threading.Lock() for _ in range(self.stripes)]
+        self.pid = os.getpid()
+
+    def _acquire(self, bucket):
+        if self.pid != os.getpid():
+            self._thread_locks()
+        stripe = bucket % self.stripes
+        self.locks[stripe].acquire()
+        try:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX, 1, stripe)
+        except Exception:
+            self.locks[stripe].release()
+            raise
+        return stripe
+
+    def _release(self, stripe):
+        try:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN, 1, stripe)
+        finally:
+            self.locks[stripe].release()
+
+    def _bucket(self, key_hash):
+        bucket = key_hash % self.buckets
+        return bucket, _HEADER_SIZE + bucket * self.ways * self.slot_size
+
+    def _read(self, offset, key, key_hash, locked=False):
+        """Returns (found, value, expiry) for key in the slot at offset.
+
+           With the slot's stripe locked no write is under way, so an odd
+           version was left by a writer that died and the slot is read if
+           its crc still matches.
+        """
+        table = self.map
+        for _ in range(_READ_ATTEMPTS):
+            (version, crc, slot_hash, key_len, value_len,
+             expires) = _SLOT.unpack_from(table, offset)
+            if version & 1 and not locked:
+                self.retries += 1
+                continue
+            if slot_hash != key_hash or expires == _EMPTY:
+                return False, None, None
+            start = offset + _SLOT.size
+            data = table[start:start + key_len + value_len]
+            if _VERSION.unpack_from(table, offset)[0] != version or (
+                    zlib.crc32(data) & 0xffffffff) != crc:
+                self.retries += 1
+                continue
+            if data[:key_len] != key:
+                return False, None, None
+            return True, data[key_len:], expires
+        return False, None, None
+
+    def get(self, key):
+        """Returns the value of key, or None if absent or expired."""
+        key_hash = _hash(key)
+        _, offset = self._bucket(key_hash)
+        fields = self.bucket_fields.unpack_from(self.map, offset)
+        for way in range(self.ways):
+            if fields[2 * way] != key_hash:
+                continue
+            found, value, expires = self._read(
+                offset + way * self.slot_size, key, key_hash)
+            if found:
+                if expires < time.time():
+                    self.expired += 1
+                    return None
+                return value
+        return None
+
+    def _write(self, offset, key, key_hash, value, expires):
+        table = self.map
+        # Made even first, so a writer killed between the two stores
+        # below does not leave the slot odd for good
+        version = _VERSION.unpack_from(table, offset)[0] & ~1
+        _VERSION.pack_into(table, offset, (version + 1) & 0xffffffff)
+        data = key + value
+        start = offset + _SLOT.size
+        table[start:start + len(data)] = data
+        _SLOT_REST.pack_into(table, offset + _VERSION.size,
+                             zlib.crc32(data) & 0xffffffff, key_hash,
+                             len(key), len(value), expires)
+        _VERSION.pack_into(table, offset, (version + 2) & 0xffffffff)
+
+    def _slot_for(self, offset, key, key_hash, now):
+        """Returns the offset of key's slot in the bucket at offset.
+
+           That is the slot holding key, else the first empty or expired
+           one, else the one closest to expiry. The bucket's stripe must
+           be locked.
+        """
+        free = None
+        soonest = None
+        fields = self.bucket_fields.unpack_from(self.map, offset)
+        for way in range(self.ways):
+            slot = offset + way * self.slot_size
+            slot_hash, expires = fields[2 * way], fields[2 * way + 1]
+            if slot_hash == key_hash and expires != _EMPTY:
+                key_len = _SLOT.unpack_from(self.map, slot)[3]
+                start = slot + _SLOT.size
+                if self.map[start:start + key_len] == key:
+                    return slot
+            if free is None and (expires == _EMPTY or expires < now):
+                free = slot
+            if soonest is None or expires < soonest[0]:
+                soonest = (expires, slot)
+        if free is not None:
+            return free
+        self.evictions += 1
+        return soonest[1]
+
+    def set(self, key, value, ttl):
+        """Stores value for key for ttl seconds.
+
+           Returns False, storing nothing, when they do not fit a slot.
+        """
+        if _SLOT.size + len(key) + len(value) > self.slot_size:
+            self.oversize += 1
+            return False
+        key_hash = _hash(key)
+        bucket, offset = self._bucket(key_hash)
+        now = time.time()
+        stripe = self._acquire(bucket)
+        try:
+            slot = self._slot_for(offset, key, key_hash, now)
+            self._write(slot, key, key_hash, value, now + ttl)
+        finally:
+            self._release(stripe)
+        return True
+
+    def update(self, key, func, ttl):
+        """Stores func(value) for key, atomically, and returns it.
+
+           func is given the current value of key, or None, and must
+           return the new one, which is kept for ttl seconds. It runs
+           with the key's stripe locked, so it should be quick.
+        """
+        key_hash = _hash(key)
+        bucket, offset = self._bucket(key_hash)
+        now = time.time()
+        stripe = self._acquire(bucket)
+        try:
+            slot = self._slot_for(offset, key, key_hash, now)
+            found, value, expires = self._read(slot, key, key_hash,
+                                               locked=True)
+            if not found or expires < now:
+                value = None
+            value = func(value)
+            if _SLOT.size + len(key) + len(value) > self.slot_size:
+                self.oversize += 1
+                raise ValueError("Value does not fit a shared table slot")
+            self._write(slot, key, key_hash, value, now + ttl)
+        finally:
+            self._release(stripe)
+        return value
+
+    def delete(self, key):
+        key_hash = _hash(key)
+        bucket, offset = self._bucket(key_hash)
+        stripe = self._acquire(bucket)
+        try:
+            for way in range(self.ways):
+                slot = offset + way * self.slot_size
+                found, _, _ = self._read(slot, key, key_hash, locked=True)
+                if found:
+                    self._write(slot, b'', 0, b'', _EMPTY)
+                    return
+        finally:
+            self._release(stripe)
+
+    def __len__(self):
+        """Returns how many unexpired entries the table holds."""
+        now = time.time()
+        count = 0
+        for slot in range(self.slots):
+            expires = _SLOT.unpack_from(
+                self.map, _HEADER_SIZE + slot * self.slot_size)[5]
+            if expires != _EMPTY and expires >= now:
+                count += 1
+        return count
+
+    def close(self):
+        self.map.close()
+        os.close(self.fd)
+
+    def stats(self):
+        """Returns this process' counts of the table's work."""
+        return {"slots": self.slots,
+                "size": len(self),
+                "expired": self.expired,
+                "evictions": self.evictions,
+                "oversize": self.oversize,
+                "retries": self.retries}